@@ -9,6 +9,105 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        POSTS_PER_PAGE=20,        # Number of posts shown on each index page.
+        INDEX_STREAMING=False,    # Stream the index page while it is rendered.
+        DENORMALIZED_AUTHOR=True,  # Read post.author_name instead of joining user.
+        # Render post bodies as Markdown when they are saved, and show an
+        # excerpt of each on the index (see flaskr.rendering).
+        MARKDOWN=False,
+        EXCERPT_LENGTH=200,       # Characters of plain text in an excerpt.
+        DB_POOL_SIZE=5,           # Connections each process keeps open.
+        DB_POOL_TIMEOUT=30,       # Seconds to wait for a free connection.
+        DB_READ_POOL_SIZE=5,      # Read-only connections for SELECTs; 0 disables.
+        DB_WRITE_QUEUE=False,     # Group-commit writes on a single writer thread.
+        DB_WRITE_BATCH=64,        # Most writes committed in one transaction.
+        DB_LOCK_RETRIES=3,        # Retries of a write that found the database locked.
+        # SQLite pragmas applied to each new connection (None keeps the default).
+        SQLITE_JOURNAL_MODE='wal',
+        SQLITE_SYNCHRONOUS='normal',
+        SQLITE_BUSY_TIMEOUT=5000,           # Milliseconds to wait for a lock.
+        SQLITE_CACHE_SIZE=-16000,           # Negative values are KiB: 16 MB.
+        SQLITE_MMAP_SIZE=128 * 1024 * 1024,
+        SQLITE_TEMP_STORE='memory',
+        USER_CACHE_SIZE=1024,     # Logged-in users cached per process.
+        USER_CACHE_TTL=60,        # Seconds before a cached user is reloaded.
+        # Rendered index pages: 'memory' (per process), 'sqlite' (shared by
+        # all workers through PAGE_CACHE_DATABASE) or None to disable. Either
+        # way, invalidations are recorded in PAGE_CACHE_DATABASE and checked on
+        # every read, so a write reaches the pages cached by all workers; the
+        # TTL only bounds changes made outside the app.
+        PAGE_CACHE='memory',
+        PAGE_CACHE_SIZE=256,
+        PAGE_CACHE_TTL=300,       # Seconds a cached page is served.
+        PAGE_CACHE_DATABASE=os.path.join(app.instance_path, 'page_cache.sqlite'),
+        # Stored hashes made with other parameters are rehashed on login.
+        PASSWORD_HASH_METHOD='scrypt:32768:8:1',
+        PASSWORD_HASH_WORKERS=2,  # Hashing processes; 0 hashes in the request thread.
+        PASSWORD_HASH_QUEUE=16,   # Pending hashes before requests get a 503.
+        PASSWORD_HASH_TIMEOUT=10,
+        # Where session data lives: None keeps it in the signed cookie, 'memory'
+        # (per process) or 'sqlite' (SESSION_DATABASE, shared by all workers)
+        # store it server-side with only a signed session id in the cookie.
+        SESSION_BACKEND=None,
+        SESSION_DATABASE=os.path.join(app.instance_path, 'sessions.sqlite'),
+        SESSION_CACHE_SIZE=10000,  # Sessions kept in memory per process.
+        SESSION_CACHE_TTL=5,       # Seconds a worker reuses a session read from SQLite.
+        SESSION_SWEEP_INTERVAL=300,  # Seconds between deletions of expired sessions.
+        # Background jobs: None runs them in the request, 'sqlite' queues them
+        # in JOBS_DATABASE for worker threads in each web process (JOBS_WORKERS,
+        # 0 for none) and `flask worker` processes to run.
+        JOBS_BACKEND=None,
+        JOBS_DATABASE=os.path.join(app.instance_path, 'jobs.sqlite'),
+        JOBS_WORKERS=2,
+        JOBS_POLL_INTERVAL=1,     # Seconds an idle worker waits before looking again.
+        JOBS_RETRY_BACKOFF=5,     # Seconds before the first retry; doubles each time.
+        JOBS_LEASE=300,           # Seconds before a running job is taken as abandoned;
+                                  # every job must finish within it.
+        JOBS_KEEP=86400,          # Seconds finished jobs are kept for `flask jobs`.
+        # Requests allowed per client, as '<count>/<period>'. Buckets live in
+        # this process ('memory') or in RATELIMIT_DATABASE ('sqlite'), which
+        # all workers share; None disables rate limiting.
+        RATELIMIT_BACKEND='memory',
+        RATELIMIT_DATABASE=os.path.join(app.instance_path, 'ratelimit.sqlite'),
+        RATELIMIT_MEMORY_SIZE=10000,  # Buckets kept before the idlest are dropped.
+        RATELIMIT_PURGE_INTERVAL=300,  # Seconds between purges of idle sqlite buckets.
+        RATELIMITS={
+            'login': '10/minute',     # Per address, and per username.
+            'register': '10/hour',    # Per address.
+            'create': '30/minute',    # Per user.
+        },
+        SQL_INSTRUMENTATION=True,  # Time queries and send a Server-Timing header.
+        SLOW_QUERY_MS=100,         # Log queries slower than this; None disables.
+        SLOW_QUERY_EXPLAIN=True,   # Flag full table scans in slow queries.
+        METRICS=True,              # Count requests and serve them at /metrics.
+        METRICS_ALLOWED_IPS=(),    # Addresses allowed to read /metrics, e.g. the scraper's.
+        # With several worker processes, set this to a file they all share so
+        # /metrics reports their totals; None reports on the scraped worker only.
+        METRICS_DATABASE=None,
+        METRICS_FLUSH_INTERVAL=5,  # Seconds between a worker's writes to it.
+        # Sample the stacks of a fraction of requests (PROFILE_SAMPLE_RATE), and of
+        # any request with PROFILE_HEADER from PROFILE_ALLOWED_IPS. Profiles are
+        # summed per endpoint in PROFILE_DIR and downloaded from /admin/profiles
+        # by the users in PROFILE_ADMINS.
+        PROFILING=False,
+        PROFILE_SAMPLE_RATE=0.01,
+        PROFILE_HEADER='X-Flaskr-Profile',
+        PROFILE_ALLOWED_IPS=(),   # Behind a proxy, only useful with ProxyFix applied.
+        PROFILE_INTERVAL=0.005,   # Seconds between stack samples.
+        PROFILE_FLUSH_INTERVAL=10,  # Seconds between a worker's writes to PROFILE_DIR.
+        PROFILE_DIR=os.path.join(app.instance_path, 'profiles'),
+        PROFILE_ADMINS=(),        # Usernames allowed to download profiles.
+        # Compiled templates shared by all workers; None disables the cache.
+        TEMPLATE_CACHE_DIR=os.path.join(app.instance_path, 'jinja_cache'),
+        STATIC_MAX_AGE=365 * 24 * 3600,  # Seconds fingerprinted static URLs are cached.
+        # Responses of these types are gzipped (or brotli-compressed, if brotli
+        # is installed) when at least COMPRESS_MIN_SIZE bytes; 0 disables it.
+        COMPRESS_MIN_SIZE=500,
+        COMPRESS_LEVEL=6,
+        COMPRESS_MIMETYPES=(
+            'text/html', 'text/css', 'text/plain', 'application/json',
+            'application/atom+xml', 'application/javascript',
+        ),
     )
 
     if test_config is None:
@@ -28,14 +127,42 @@ def create_app(test_config=None):
     def hello():
         return 'Hello, World!'
     
+    # Commands are registered by name and only imported when one is run.
+    from . import cli
+    app.cli = cli.LazyGroup(app.cli.name, lazy_commands=cli.COMMANDS)
+
+    from . import templating
+    templating.init_app(app)
+
+    from . import sessions
+    sessions.init_app(app)
+
     from . import db
     db.init_app(app)
 
+    from . import instrument
+    instrument.init_app(app)
+
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import jobs
+    jobs.init_app(app)
+
+    from . import profiler
+    profiler.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
     from . import blog
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
+
+    from . import assets
+    assets.init_app(app)
+
+    from . import compress
+    compress.init_app(app)
     
     return app
\ No newline at end of file
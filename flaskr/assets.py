@@ -0,0 +1,122 @@
+import click
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+from flaskr.compress import accepted_encodings, brotli, compress
+
+# Static files worth compressing ahead of time.
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.xml')
+
+# File suffix of each precompressed variant.
+_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+_hash_lock = threading.Lock()
+
+
+# Static URLs carry a hash of the file's content (style.css?v=1a2b3c...). The
+# URL changes whenever the file does, so the file can be cached for a year
+# without browsers ever holding on to a stale copy.
+def init_app(app):
+    app.url_defaults(fingerprint_static)
+    app.view_functions['static'] = serve_static
+
+
+def static_hash(filename):
+    """Returns a short hash of a static file's content, or None if it doesn't exist."""
+    app = current_app._get_current_object()
+    hashes = app.extensions.setdefault('flaskr.static_hashes', {})
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
+    try:
+        # The modification time is part of the key so edits show up in debug mode.
+        key = (filename, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+
+    digest = hashes.get(key)
+    if digest is None:
+        with open(path, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()[:12]
+        with _hash_lock:
+            hashes[key] = digest
+    return digest
+
+
+def fingerprint_static(endpoint, values):
+    if endpoint != 'static' or 'v' in values:
+        return
+    digest = static_hash(values.get('filename', ''))
+    if digest is not None:
+        values['v'] = digest
+
+
+def serve_static(filename):
+    """Serves a static file, preferring a precompressed variant the client accepts."""
+    app = current_app._get_current_object()
+    response = None
+    path = safe_join(app.static_folder, filename)
+    for encoding in accepted_encodings() if path is not None else ():
+        # A variant older than its file was left behind by an earlier deploy.
+        if _is_fresh(path + _SUFFIXES[encoding], path):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(
+                app.static_folder, filename + _SUFFIXES[encoding], mimetype=mimetype
+            )
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+
+    # A fingerprinted URL always refers to the same content.
+    if 'v' in request.args:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+def _is_fresh(variant, path):
+    try:
+        return os.stat(variant).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def precompress_static(static_folder, level=9):
+    """Writes .gz (and .br, if brotli is installed) copies of the static text files."""
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    written = []
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as file:
+                data = file.read()
+            for encoding in encodings:
+                compressed = compress(data, encoding, level if encoding == 'gzip' else 11)
+                # Not worth serving if it doesn't save anything.
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + _SUFFIXES[encoding], 'wb') as file:
+                    file.write(compressed)
+                written.append(path + _SUFFIXES[encoding])
+    return written
+
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static_command():
+    """Write precompressed copies of the static files."""
+    written = precompress_static(current_app.static_folder)
+    for path in written:
+        click.echo(os.path.relpath(path, current_app.static_folder))
+    click.echo(f'Wrote {len(written)} compressed files.')
@@ -1,8 +1,9 @@
 import functools
 
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.local import LocalProxy
 from flask import (
     Blueprint,
+    current_app,
     flash,
     g,
     redirect,
@@ -12,12 +13,16 @@ from flask import (
     url_for
 )
 
-from flaskr.db import get_db
+from flaskr.cache import TTLCache, invalidate_pages
+from flaskr.db import get_db, run_write
+from flaskr.hashing import hash_password, needs_rehash, verify_password
+from flaskr.ratelimit import rate_limit
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
 @bp.route('/register', methods=('GET', 'POST'))
+@rate_limit('register')
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -32,12 +37,13 @@ def register():
             error = 'Password is required'
 
         if error is None:
+            # Hashed before the write, so the write lock isn't held while hashing.
+            pwhash = hash_password(password)
             try:
-                db.execute(
+                run_write(lambda db: db.execute(
                     'INSERT INTO user (username, password) VALUES (?, ?)',
-                    (username, generate_password_hash(password)),
-                )
-                db.commit()
+                    (username, pwhash),
+                ))
             except db.IntegrityError:
                 error = f'User {username} is already registered.'
             else:
@@ -49,6 +55,9 @@ def register():
 
 
 @bp.route('/login', methods=('GET', 'POST'))
+# Limited per address and per account, so neither one client trying many
+# passwords nor many clients trying one account get far.
+@rate_limit('login', keys=('ip', 'username'))
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -62,10 +71,17 @@ def login():
         
         if user is None:
             error = 'Incorrect username.'
-        elif not check_password_hash(user['password'], password):
+        elif not verify_password(user['password'], password):
             error = 'Incorrect password'
 
         if error is None:
+            # Hashes made with older settings are upgraded while the password is at hand.
+            if needs_rehash(user['password']):
+                pwhash = hash_password(password)
+                write_user(user['id'], lambda db: db.execute(
+                    'UPDATE user SET password = ? WHERE id = ?', (pwhash, user['id'])
+                ))
+
             session.clear()
             session['user_id'] = user['id']
             return redirect(url_for('index'))
@@ -81,6 +97,56 @@ def logout():
     return redirect(url_for('index'))
 
 
+# Logged-in users are looked up in a per-process cache, so most requests
+# don't need to query the user table at all. Changes made through
+# write_user drop the user from it at once; changes made outside the app
+# show once the entry expires, after USER_CACHE_TTL.
+def get_user_cache(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    cache = app.extensions.get('flaskr.user_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('flaskr.user_cache', TTLCache(
+            maxsize=app.config['USER_CACHE_SIZE'],
+            ttl=app.config['USER_CACHE_TTL'],
+        ))
+
+    return cache
+
+
+def load_user(user_id):
+    """Returns the id and username of a user, or None if it doesn't exist."""
+    cache = get_user_cache()
+    user = cache.get(user_id)
+
+    if user is None:
+        # Only the columns views and templates use; the password hash stays out.
+        row = get_db().execute(
+            'SELECT id, username FROM user WHERE id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        cache.set(user_id, user)
+
+    return user
+
+
+def invalidate_user(user_id):
+    """Drops a user from the caches; call it whenever a user row changes."""
+    get_user_cache().delete(user_id)
+    # Cached pages show usernames in the nav bar and post bylines.
+    invalidate_pages(f'user:{user_id}')
+
+
+def write_user(user_id, fn):
+    """Runs fn(db) with run_write, then drops the changed user from the caches."""
+    result = run_write(fn)
+    invalidate_user(user_id)
+    return result
+
+
 # Run code before any request in the entire application.
 @bp.before_app_request
 def load_logged_in_user():
@@ -89,9 +155,14 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        # The user is only looked up once a view or template actually uses g.user.
+        g.user = LocalProxy(lambda: _resolve_user(user_id))
+
+
+def _resolve_user(user_id):
+    if '_user' not in g:
+        g._user = load_user(user_id)
+    return g._user
 
 
 def login_required(view):
@@ -102,7 +173,7 @@ def login_required(view):
     # wrapped_view is the function that actually gets called in place of the original view function.
     # It accepts **kwargs to allow the original view function to receive any arguments it might need.
     def wrapped_view(**kwargs):
-        if g.user is None:
+        if not g.user:
             return redirect(url_for('auth.login'))
 
         return view(**kwargs)  # Execute the original view function (view) and returns its response.
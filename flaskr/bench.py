@@ -0,0 +1,293 @@
+import click
+import http.client
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+BENCH_PASSWORD = 'bench'
+
+_WORDS = (
+    'flask sqlite request template cursor index page post user cache worker '
+    'latency query commit session blueprint view render stream pool'
+).split()
+
+
+# A scenario is one endpoint to measure: how to request it, and whether
+# it needs a logged-in user. `path` may depend on the request number.
+class Scenario(object):
+    def __init__(self, name, method, path, data=None, login=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.login = login
+
+    def request(self, n):
+        path = self.path(n) if callable(self.path) else self.path
+        data = self.data(n) if callable(self.data) else self.data
+        return path, data
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def generate_data(db, users, posts, password_hash, seed=0):
+    """Fills an empty database with synthetic users and posts."""
+    rng = random.Random(seed)
+    db.executemany(
+        'INSERT INTO user (username, password) VALUES (?, ?)',
+        [(f'user{n}', password_hash) for n in range(users)]
+    )
+    batch = []
+    for n in range(posts):
+        batch.append((rng.randint(1, users), _text(rng, 6), _text(rng, 80)))
+        if len(batch) == 5000 or n == posts - 1:
+            db.executemany(
+                'INSERT INTO post (author_id, title, body) VALUES (?, ?, ?)', batch
+            )
+            batch = []
+    db.commit()
+
+
+def default_scenarios(db):
+    """The endpoints measured by default, run as user0 where a login is needed."""
+    own_posts = [row['id'] for row in db.execute(
+        'SELECT id FROM post WHERE author_id = 1 ORDER BY id LIMIT 100'
+    )]
+    if not own_posts:
+        db.execute("INSERT INTO post (author_id, title, body) VALUES (1, 'bench', '')")
+        db.commit()
+        own_posts = [db.execute('SELECT max(id) FROM post').fetchone()[0]]
+
+    return [
+        Scenario('index', 'GET', '/'),
+        Scenario('login', 'POST', '/auth/login',
+                 {'username': 'user0', 'password': BENCH_PASSWORD}),
+        Scenario('create', 'POST', '/create',
+                 lambda n: {'title': f'bench {n}', 'body': 'created by flask bench'},
+                 login=True),
+        Scenario('update', 'POST', lambda n: f'/{own_posts[n % len(own_posts)]}/update',
+                 lambda n: {'title': f'updated {n}', 'body': 'updated by flask bench'},
+                 login=True),
+    ]
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (nearest rank) of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(name, mode, latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    return {
+        'endpoint': name,
+        'mode': mode,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB, if known."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_test_client(app, scenario, requests):
+    """Measures a scenario through Flask's test client, one request at a time."""
+    client = app.test_client()
+    if scenario.login:
+        client.post('/auth/login', data={'username': 'user0', 'password': BENCH_PASSWORD})
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for n in range(requests):
+        path, data = scenario.request(n)
+        began = time.perf_counter()
+        response = client.open(path, method=scenario.method, data=data)
+        latencies.append(time.perf_counter() - began)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - start
+
+    return summarize(scenario.name, 'client', latencies, elapsed, errors)
+
+
+def _http_request(port, method, path, data=None, cookie=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {}
+    body = None
+    if data is not None:
+        body = urlencode(data)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if cookie:
+        headers['Cookie'] = cookie
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response
+    finally:
+        conn.close()
+
+
+class _QuietHandler(WSGIRequestHandler):
+    # Logging every request would drown the results and slow the server down.
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def run_server(app, scenario, requests, concurrency):
+    """Measures a scenario over HTTP against a threaded WSGI server."""
+    server = make_server(
+        '127.0.0.1', 0, app, threaded=True, request_handler=_QuietHandler
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        cookie = None
+        if scenario.login:
+            response = _http_request(
+                server.port, 'POST', '/auth/login',
+                {'username': 'user0', 'password': BENCH_PASSWORD}
+            )
+            cookie = response.getheader('Set-Cookie', '').split(';')[0]
+
+        def one(n):
+            path, data = scenario.request(n)
+            began = time.perf_counter()
+            response = _http_request(server.port, scenario.method, path, data, cookie)
+            return time.perf_counter() - began, response.status >= 400
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(one, range(requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        thread.join()
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(error for _, error in results)
+    return summarize(scenario.name, f'server x{concurrency}', latencies, elapsed, errors)
+
+
+def run_benchmarks(config, users=100, posts=10000, requests=200, concurrency=8,
+                   server=True, endpoints=None, progress=None):
+    """Builds a throwaway app with synthetic data and measures its endpoints."""
+    from flaskr import create_app
+    from flaskr.db import close_pool, get_db, init_db
+
+    directory = tempfile.mkdtemp(prefix='flaskr-bench-')
+    # The app under test uses the current configuration, but keeps everything
+    # it writes - database, caches, sessions, jobs, metrics and profiles - in
+    # a directory of its own, so the real data is never touched.
+    def path(name):
+        return os.path.join(directory, name)
+
+    app = create_app(dict(
+        config,
+        DATABASE=path('flaskr.sqlite'),
+        PAGE_CACHE_DATABASE=path('page_cache.sqlite'),
+        SESSION_DATABASE=path('sessions.sqlite'),
+        JOBS_DATABASE=path('jobs.sqlite'),
+        RATELIMIT_DATABASE=path('ratelimit.sqlite'),
+        # Left off when off, so the run measures the configured setup.
+        METRICS_DATABASE=config['METRICS_DATABASE'] and path('metrics.sqlite'),
+        PROFILE_DIR=path('profiles'),
+        TEMPLATE_CACHE_DIR=config['TEMPLATE_CACHE_DIR'] and path('jinja_cache'),
+        RATELIMIT_BACKEND=None,  # The benchmark client would be throttled.
+    ))
+
+    try:
+        with app.app_context():
+            init_db()
+            db = get_db()
+            pwhash = generate_password_hash(
+                BENCH_PASSWORD, app.config['PASSWORD_HASH_METHOD']
+            )
+            generate_data(db, users, posts, pwhash)
+            scenarios = default_scenarios(db)
+
+        results = []
+        for scenario in scenarios:
+            if endpoints and scenario.name not in endpoints:
+                continue
+            results.append(run_test_client(app, scenario, requests))
+            if progress is not None:
+                progress(results[-1])
+            if server:
+                results.append(run_server(app, scenario, requests, concurrency))
+                if progress is not None:
+                    progress(results[-1])
+        return results
+    finally:
+        # Job threads started by the run would go on polling a deleted file.
+        _, worker = app.extensions.get('flaskr.job_worker', (None, None))
+        if worker is not None:
+            worker.stop()
+        close_pool(app)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_result(result):
+    return (
+        f"{result['endpoint']:<8} {result['mode']:<10} {result['requests']:>6}"
+        f" {result['errors']:>6} {result['rps']:>9.1f}"
+        f" {result['p50']:>8.2f} {result['p95']:>8.2f} {result['p99']:>8.2f}"
+    )
+
+
+@click.command('bench')
+@click.option('--users', default=100, show_default=True, help='Synthetic users to create.')
+@click.option('--posts', default=10000, show_default=True, help='Synthetic posts to create.')
+@click.option('--requests', default=200, show_default=True, help='Requests per endpoint and mode.')
+@click.option('--concurrency', default=8, show_default=True, help='Parallel clients against the server.')
+@click.option('--server/--no-server', default=True, help='Also measure through a real WSGI server.')
+@click.option('--endpoint', 'endpoints', multiple=True,
+              type=click.Choice(['index', 'login', 'create', 'update']),
+              help='Only measure these endpoints.')
+@with_appcontext
+def bench_command(users, posts, requests, concurrency, server, endpoints):
+    """Measure request latency and throughput on synthetic data."""
+    click.echo(
+        f"{'endpoint':<8} {'mode':<10} {'reqs':>6} {'errors':>6} {'req/s':>9}"
+        f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    run_benchmarks(
+        current_app.config, users, posts, requests, concurrency, server, endpoints,
+        progress=lambda result: click.echo(format_result(result))
+    )
+
+    rss = peak_rss_mb()
+    if rss is not None:
+        click.echo(f'Peak RSS: {rss:.1f} MB')
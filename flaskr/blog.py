@@ -1,29 +1,95 @@
+import base64
+import binascii
+import functools
+import hashlib
+import json
+import re
+
+from collections import namedtuple
+
+from markupsafe import escape, Markup
 from werkzeug.exceptions import abort
+from werkzeug.http import is_resource_modified
 from flask import (
     Blueprint,
+    current_app,
     flash,
     g,
+    make_response,
     redirect,
     render_template,
     request,
+    session,
+    stream_template,
     url_for
 )
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.cache import get_page_cache, invalidate_pages
+from flaskr.db import get_db, migration_applied, run_write
+from flaskr.jobs import enqueue, get_job_queue, task
+from flaskr.ratelimit import rate_limit
+from flaskr.rendering import RENDERER_VERSION, render_markdown, render_post
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library encoder is used instead.
+    orjson = None
 
 bp = Blueprint('blog', __name__)
 
+# The largest page the JSON API returns, whatever the client asks for.
+API_MAX_LIMIT = 100
+
+
+# Posts carry a copy of their author's username in author_name, kept up to
+# date by triggers, so reads don't need to join the user table. Rows an
+# in-place upgrade hasn't backfilled yet fall back to a lookup of their own,
+# and until the upgrade has added the column at all, every read joins.
+def author_sql():
+    """Returns the SQL selecting a post's author as `username`, and the join it needs."""
+    if current_app.config['DENORMALIZED_AUTHOR'] and has_author_name():
+        return (
+            'COALESCE(p.author_name,'
+            ' (SELECT username FROM user u WHERE u.id = p.author_id)) AS username',
+            ''
+        )
+    return 'u.username', ' JOIN user u ON p.author_id = u.id'
+
+
+# The rendered columns are only read with MARKDOWN on, so a database that
+# hasn't been upgraded with them yet can still be served with it off.
+def rendered_sql(columns):
+    """Returns the SQL selecting some of a post's rendered columns, if MARKDOWN is on."""
+    if not current_app.config['MARKDOWN']:
+        return ''
+    return f', {columns}'
+
+
+def has_author_name():
+    """Tells whether the post table has the author_name column yet."""
+    # Only a column found is remembered, so a process notices the upgrade.
+    if current_app.extensions.get('flaskr.author_name'):
+        return True
+    # A SELECT rather than the PRAGMA itself, so it goes to a read connection
+    # and the request's later reads aren't routed to the writer.
+    found = get_db().execute(
+        "SELECT 1 FROM pragma_table_info('post') WHERE name = 'author_name'"
+    ).fetchone() is not None
+    current_app.extensions['flaskr.author_name'] = found
+    return found
+
 
 # The check_author argument is defined so that the function can be used to get a post 
 # without checking the author. This would be useful if you wrote a view to show an individual 
 # post on a page, where the user doesn’t matter because they’re not modifying the post.
 def get_post(id, check_author=True):
     """Fetches a specific post from the database by id."""
-    # The post is retrieved by joining the post and user tables (to get the username of the author).
+    author, join = author_sql()
     post = get_db().execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
+        f'SELECT p.id, title, body, created, author_id, {author}'
+        f"{rendered_sql('p.body_html, p.render_version')}"
+        f' FROM post p{join}'
         ' WHERE p.id = ?',
         (id,)
     ).fetchone()
@@ -39,21 +105,414 @@ def get_post(id, check_author=True):
     return post
 
 
+# A cursor identifies the last post shown on a page. The next page starts strictly
+# after that (created, id) pair, so SQLite can seek straight to it through the
+# post_created_id index instead of counting past every earlier row like OFFSET would.
+def encode_cursor(post):
+    """Builds an opaque pagination cursor from a post row."""
+    raw = f"{post['created'].isoformat(' ')}|{post['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the (created, id) pair stored in a cursor, or aborts with 400."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created, id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        return created, int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400, 'Invalid page cursor.')  # Bad Request
+
+
+# One page of the index. post_ids also includes the extra row fetched to
+# find out whether an older page exists, since the page depends on it too.
+Page = namedtuple('Page', 'posts next_cursor post_ids')
+
+
+def get_posts_page(cursor=None, per_page=None, author_id=None):
+    """Fetches one page of posts, newest first, and the cursor of the next page."""
+    if per_page is None:
+        per_page = current_app.config['POSTS_PER_PAGE']
+
+    author, join = author_sql()
+    query = (
+        f"SELECT p.id, title, body, created, author_id, {author}{rendered_sql('p.excerpt')}"
+        f' FROM post p{join}'
+    )
+    where = []
+    params = []
+    # One author's posts are read in order from the post_author_created index.
+    if author_id is not None:
+        where.append('p.author_id = ?')
+        params.append(author_id)
+    if cursor is not None:
+        where.append('(p.created, p.id) < (?, ?)')
+        params.extend(decode_cursor(cursor))
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    # One extra row is fetched only to find out whether an older page exists.
+    query += ' ORDER BY p.created DESC, p.id DESC LIMIT ?'
+    params.append(per_page + 1)
+
+    posts = get_db().execute(query, params).fetchall()
+    post_ids = [post['id'] for post in posts]
+
+    next_cursor = None
+    if len(posts) > per_page:
+        posts = posts[:per_page]
+        next_cursor = encode_cursor(posts[-1])
+
+    return Page(posts, next_cursor, post_ids)
+
+
+# With MARKDOWN on, a post is rendered once, when it is saved, and pages show
+# the stored HTML. With it off the rendered columns are left alone, like they
+# are for reads, so a database without them can still be written to; a
+# trigger marks the stored HTML of an edited post as stale instead, for
+# `flask rerender-posts` to pick up once MARKDOWN is turned on.
+def rendered_columns(body):
+    """Returns the rendered columns to save with a post, by name."""
+    if not current_app.config['MARKDOWN']:
+        return {}
+    if render_deferred():
+        values = (None, None, None)
+    else:
+        values = render_post(body, current_app.config['EXCERPT_LENGTH'])
+    return dict(zip(('body_html', 'excerpt', 'render_version'), values))
+
+
+# With a job queue, posts are saved unrendered and a job renders them after
+# the response is sent; until then pages show the body as it was typed.
+def render_deferred():
+    return current_app.config['MARKDOWN'] and get_job_queue() is not None
+
+
+@task()
+def render_post_job(id):
+    """Renders and stores the body of a post saved with rendering deferred."""
+    post = get_db().execute('SELECT body FROM post WHERE id = ?', (id,)).fetchone()
+    if post is None:
+        return  # Deleted since.
+
+    columns = render_post(post['body'], current_app.config['EXCERPT_LENGTH'])
+    # Skipped if the post was edited meanwhile; that edit queued its own job.
+    run_write(lambda db: db.execute(
+        'UPDATE post SET body_html = ?, excerpt = ?, render_version = ?'
+        ' WHERE id = ? AND body = ?',
+        (*columns, id, post['body'])
+    ))
+    # Pages cached in memory by other processes are left to expire.
+    invalidate_pages(f'post:{id}')
+
+
+@bp.route('/<int:id>')
+def post(id):
+    """Displays a single post."""
+    post = get_post(id, check_author=False)
+
+    body_html = None
+    if current_app.config['MARKDOWN']:
+        body_html = post['body_html']
+        # Posts saved before MARKDOWN was turned on, or by an older renderer,
+        # are rendered here until `flask rerender-posts` catches up.
+        if body_html is None or post['render_version'] != RENDERER_VERSION:
+            body_html = render_markdown(post['body'])
+        body_html = Markup(body_html)
+
+    return render_template('blog/post.html', post=post, body_html=body_html)
+
+
 @bp.route('/')
 def index():
-    """Displays all blog posts."""
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY created DESC'
+    """Displays one page of blog posts."""
+    cursor = request.args.get('before')
+
+    # A streamed response sends the page header to the client while the
+    # posts are still being rendered.
+    if current_app.config['INDEX_STREAMING']:
+        page = get_posts_page(cursor)
+        return stream_template(
+            'blog/index.html', posts=page.posts, next_cursor=page.next_cursor
+        )
+
+    # Pages showing flashed messages are one-offs and are never cached.
+    cache = get_page_cache()
+    if cache is None or '_flashes' in session:
+        page = get_posts_page(cursor)
+        return render_template(
+            'blog/index.html', posts=page.posts, next_cursor=page.next_cursor
+        )
+
+    # Pages differ per user (the nav bar and Edit links), so the user is part of the key.
+    key = f"index:{session.get('user_id', '')}:{cursor or ''}"
+    cached = cache.get(key)
+    if cached is None:
+        # Taken before reading the posts: if they change while the page is
+        # rendered, the page is stored as already stale.
+        snapshot = cache.begin()
+        page = get_posts_page(cursor)
+        body = render_template(
+            'blog/index.html', posts=page.posts, next_cursor=page.next_cursor
+        )
+        etag = hashlib.sha1(body.encode()).hexdigest()
+
+        tags = [f'post:{id}' for id in page.post_ids]
+        # Usernames appear in the nav bar and post bylines.
+        tags.extend({f"user:{post['author_id']}" for post in page.posts})
+        if 'user_id' in session:
+            tags.append(f"user:{session['user_id']}")
+        if cursor is None:
+            tags.append('index:first')  # New posts always land on the first page.
+        cache.set(key, (etag, body), tags, snapshot)
+    else:
+        etag, body = cached
+
+    # Clients revalidate with If-None-Match and get a 304 while the page is unchanged.
+    response = make_response(body)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+# Views reading tables that a migration adds answer 503 until it has been
+# applied, instead of failing with a 500 on the missing table.
+def requires_migration(version):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            if not migration_applied(version):
+                abort(503, 'The database needs upgrading: run `flask db-upgrade`.')
+            return view(**kwargs)
+
+        return wrapped_view
+
+    return decorator
+
+
+# Feeds and the API are polled, mostly to find nothing new. Their validators
+# come from the post_change counters, which the triggers bump on every post
+# write, so an unchanged feed is answered with a 304 before any post is read.
+def get_change(author_id=0):
+    """Returns the (version, modified) pair of an author's posts, 0 for all posts."""
+    row = get_db().execute(
+        'SELECT version, modified FROM post_change WHERE author_id = ?',
+        (author_id,)
+    ).fetchone()
+    if row is None:
+        return 0, None
+    return row['version'], row['modified']
+
+
+def conditional(author_id, build, key=None):
+    """Returns a 304 if the client's copy is current, else the response of build().
+
+    key tells apart resources that share a version, such as single posts.
+    """
+    version, modified = get_change(author_id)
+    etag = f'{author_id}.{version}' if key is None else f'{author_id}.{version}.{key}'
+
+    # Only the version decides. Last-Modified has one-second resolution, so two
+    # changes within a second would share it; it is sent for feed readers to
+    # show, but If-Modified-Since alone never gets a 304.
+    if not is_resource_modified(request.environ, etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+    # Clients may keep a copy, but must check it is current before using it.
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def dumps(obj):
+    """Serializes an API response as compact JSON, with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def json_response(obj):
+    return current_app.response_class(dumps(obj), mimetype='application/json')
+
+
+def post_to_json(post):
+    return {
+        'id': post['id'],
+        'title': post['title'],
+        'body': post['body'],
+        'created': post['created'].isoformat() + 'Z',
+        'author_id': post['author_id'],
+        'author': post['username'],
+    }
+
+
+def api_limit():
+    limit = request.args.get('limit', current_app.config['POSTS_PER_PAGE'], type=int)
+    if not 1 <= limit <= API_MAX_LIMIT:
+        abort(400, f'limit must be between 1 and {API_MAX_LIMIT}.')  # Bad Request
+    return limit
+
+
+def get_author(author_id):
+    """Returns the username of an author, or aborts with 404."""
+    user = get_db().execute(
+        'SELECT username FROM user WHERE id = ?', (author_id,)
+    ).fetchone()
+    if user is None:
+        abort(404, f'Author id {author_id} does not exist.')  # Not Found
+    return user['username']
+
+
+def get_author_stats(author_id):
+    """Returns an author's username, post count and latest post, or aborts with 404."""
+    author = get_db().execute(
+        'SELECT u.id, u.username, COALESCE(s.post_count, 0) AS post_count,'
+        ' p.id AS latest_id, p.title AS latest_title, p.created AS latest_created'
+        ' FROM user u'
+        ' LEFT JOIN author_stats s ON s.author_id = u.id'
+        ' LEFT JOIN post p ON p.id = s.latest_post_id'
+        ' WHERE u.id = ?',
+        (author_id,)
+    ).fetchone()
+    if author is None:
+        abort(404, f'Author id {author_id} does not exist.')  # Not Found
+    return author
+
+
+@bp.route('/authors/<int:author_id>')
+@requires_migration(6)
+def author(author_id):
+    """Displays an author's post count, latest post and one page of their posts."""
+    author = get_author_stats(author_id)
+    page = get_posts_page(request.args.get('before'), author_id=author_id)
+    return render_template(
+        'blog/author.html', author=author, posts=page.posts, next_cursor=page.next_cursor
+    )
+
+
+def _posts_json(author_id=None):
+    page = get_posts_page(request.args.get('before'), api_limit(), author_id)
+    return json_response({
+        'posts': [post_to_json(post) for post in page.posts],
+        'next': page.next_cursor,
+    })
+
+
+@bp.route('/api/posts')
+@requires_migration(4)
+def api_posts():
+    """Returns one page of posts as JSON, newest first."""
+    return conditional(0, _posts_json)
+
+
+@bp.route('/api/posts/<int:id>')
+@requires_migration(4)
+def api_post(id):
+    """Returns a single post as JSON."""
+    # Fetched first: a post that doesn't exist is a 404, never a 304.
+    post = get_post(id, check_author=False)
+    return conditional(0, lambda: json_response(post_to_json(post)), key=f'post-{id}')
+
+
+@bp.route('/api/authors/<int:author_id>/posts')
+@requires_migration(4)
+def api_author_posts(author_id):
+    """Returns one page of an author's posts as JSON, newest first."""
+    get_author(author_id)
+    return conditional(author_id, lambda: _posts_json(author_id))
+
+
+def _atom_feed(author_id=None, author=None):
+    page = get_posts_page(author_id=author_id)
+    body = render_template(
+        'blog/feed.xml', posts=page.posts, author=author,
+        updated=get_change(author_id or 0)[1]
+    )
+    return current_app.response_class(body, mimetype='application/atom+xml')
+
+
+@bp.route('/feed.xml')
+@requires_migration(4)
+def feed():
+    """Returns the latest posts as an Atom feed."""
+    return conditional(0, _atom_feed)
+
+
+@bp.route('/authors/<int:author_id>/feed.xml')
+@requires_migration(4)
+def author_feed(author_id):
+    """Returns an author's latest posts as an Atom feed."""
+    author = get_author(author_id)
+    return conditional(author_id, lambda: _atom_feed(author_id, author))
+
+
+# Matches are wrapped in these control characters by SQLite, then swapped for
+# <mark> tags once the rest of the text has been HTML-escaped.
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+
+def _highlight(text):
+    return Markup(
+        str(escape(text))
+        .replace(_MARK_START, '<mark>')
+        .replace(_MARK_END, '</mark>')
+    )
+
+
+def search_posts(terms, page=1, per_page=None):
+    """Returns one page of posts matching all terms, best match first."""
+    if per_page is None:
+        per_page = current_app.config['POSTS_PER_PAGE']
+
+    # Every term is quoted, so user input can't be read as FTS5 query syntax.
+    query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    author, join = author_sql()
+    rows = get_db().execute(
+        f'SELECT p.id, p.created, p.author_id, {author},'
+        ' highlight(post_fts, 0, ?, ?) AS title,'
+        " snippet(post_fts, 1, ?, ?, '...', 24) AS excerpt"
+        ' FROM post_fts'
+        f' JOIN post p ON p.id = post_fts.rowid{join}'
+        ' WHERE post_fts MATCH ?'
+        # Title matches weigh more than body matches.
+        ' ORDER BY bm25(post_fts, 5.0, 1.0)'
+        ' LIMIT ? OFFSET ?',
+        (_MARK_START, _MARK_END, _MARK_START, _MARK_END, query,
+         per_page + 1, (page - 1) * per_page)
     ).fetchall()
 
-    return render_template('blog/index.html', posts=posts)
+    results = [
+        dict(post, title=_highlight(post['title']), excerpt=_highlight(post['excerpt']))
+        for post in rows[:per_page]
+    ]
+    return results, len(rows) > per_page
+
+
+@bp.route('/search')
+@requires_migration(2)
+def search():
+    """Displays the posts matching a full-text query."""
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400, 'Invalid page number.')  # Bad Request
+
+    terms = re.findall(r'\w+', q)
+    results, has_next = search_posts(terms, page) if terms else ([], False)
+
+    return render_template(
+        'blog/search.html', q=q, page=page, results=results, has_next=has_next
+    )
 
 
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
+@rate_limit('create', keys=('user',))
 def create():
     """Allows authenticated users to create a new blog post."""
     if request.method == 'POST':
@@ -67,13 +526,17 @@ def create():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO post(title, body, author_id)'
-                'VALUES (?, ?, ?)',
-                (title, body, g.user['id'])
-            )
-            db.commit()
+            author_id = g.user['id']
+            columns = dict(title=title, body=body, author_id=author_id)
+            columns.update(rendered_columns(body))
+            id = run_write(lambda db: db.execute(
+                f'INSERT INTO post({", ".join(columns)})'
+                f' VALUES ({", ".join("?" * len(columns))})',
+                tuple(columns.values())
+            ).lastrowid)
+            invalidate_pages('index:first')
+            if render_deferred():
+                enqueue(render_post_job, id)
 
             return redirect(url_for('blog.index'))
         
@@ -97,13 +560,16 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE post SET title = ?, body = ?'
-                'WHERE id = ?',
-                (title, body, id)
-            )
-            db.commit()
+            columns = dict(title=title, body=body)
+            columns.update(rendered_columns(body))
+            run_write(lambda db: db.execute(
+                f'UPDATE post SET {", ".join(f"{name} = ?" for name in columns)}'
+                ' WHERE id = ?',
+                (*columns.values(), id)
+            ))
+            invalidate_pages(f'post:{id}')
+            if render_deferred():
+                enqueue(render_post_job, id)
             return redirect(url_for('blog.index'))
         
     return render_template('blog/update.html', post=post)
@@ -114,7 +580,6 @@ def update(id):
 def delete(id):
     """Allows the post author to delete a post."""
     get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id = ?', (id,))
-    db.commit()
+    run_write(lambda db: db.execute('DELETE FROM post WHERE id = ?', (id,)))
+    invalidate_pages(f'post:{id}')
     return redirect(url_for('blog.index'))
\ No newline at end of file
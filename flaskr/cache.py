@@ -0,0 +1,412 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from flask import current_app
+
+
+# A small in-process cache shared by the threads of one worker. Entries are
+# evicted least-recently-used first once the cache is full, and are treated
+# as missing once they are older than the time-to-live.
+class TTLCache(object):
+    """A thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires, value), oldest first.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._data[key]
+                self._removed(key, entry[1])
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._removed(key, old[1])
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                evicted, (_, evicted_value) = self._data.popitem(last=False)
+                self._removed(evicted, evicted_value)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._cleared()
+
+    # Hooks for subclasses, called with the lock held.
+    def _removed(self, key, value):
+        pass
+
+    def _cleared(self):
+        pass
+
+    def stats(self):
+        """Returns the hit/miss counters and current size of the cache."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+
+# Invalidation goes by version, so it reaches every worker and can't be
+# undone by a render that was already under way. Each invalidation takes the
+# next number of a counter kept in an SQLite file and records it against its
+# tags. A page is stored with the counter as it was when its render began, and
+# a read treats it as missing once any of its tags has a newer number. The
+# special tag '*' is carried by every page, so clear() uses it too.
+class TagVersions(object):
+    """Invalidation numbers per tag, shared by every process through an SQLite file."""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache_counter ('
+        ' id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO cache_counter (id, version) VALUES (0, 0)',
+        'CREATE TABLE IF NOT EXISTS cache_tag_version ('
+        ' tag TEXT PRIMARY KEY, version INTEGER NOT NULL, updated REAL NOT NULL)'
+        ' WITHOUT ROWID',
+    )
+
+    def __init__(self, path, keep=600.0):
+        self.path = path
+        # Seconds a tag's number is kept; no page may live longer than that.
+        self.keep = keep
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._bumps = 0
+
+        with self._connect() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = normal')
+        return db
+
+    def current(self):
+        """Returns the number of the latest invalidation."""
+        return self._connect().execute(
+            'SELECT version FROM cache_counter'
+        ).fetchone()[0]
+
+    def newest(self, tags):
+        """Returns the number of the latest invalidation of any of the tags, or 0."""
+        tags = ['*', *tags]
+        marks = ', '.join('?' * len(tags))
+        return self._connect().execute(
+            f'SELECT MAX(version) FROM cache_tag_version WHERE tag IN ({marks})', tags
+        ).fetchone()[0] or 0
+
+    def bump(self, tags):
+        """Records an invalidation of the tags."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE cache_counter SET version = version + 1')
+            version = db.execute('SELECT version FROM cache_counter').fetchone()[0]
+            db.executemany(
+                'INSERT OR REPLACE INTO cache_tag_version (tag, version, updated)'
+                ' VALUES (?, ?, ?)', [(tag, version, now) for tag in tags]
+            )
+
+        with self._lock:
+            self._bumps += 1
+            purge = self._bumps % 100 == 0
+        if purge:
+            with self._connect() as db:
+                db.execute(
+                    'DELETE FROM cache_tag_version WHERE updated < ?',
+                    (time.time() - self.keep,)
+                )
+
+
+# A render takes a Snapshot before reading anything, and stores its page with it.
+Snapshot = namedtuple('Snapshot', 'version started')
+
+
+# The page caches store (etag, body) pairs under tags naming what the page was
+# built from, e.g. 'post:3'. Invalidating a tag drops every page carrying it,
+# so a change only evicts the pages it actually affects.
+class TaggedCache(TTLCache):
+    """An in-memory TTLCache whose entries can also be invalidated by tag.
+
+    Without `versions`, invalidations only reach this process.
+    """
+
+    def __init__(self, maxsize=256, ttl=300.0, versions=None):
+        super().__init__(maxsize, ttl)
+        self.versions = versions
+        self._tags = {}  # tag -> keys of the entries carrying it.
+
+    def begin(self):
+        """Returns the snapshot to store a page rendered from now on with."""
+        return _begin(self.versions)
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        value, tags, version = entry
+        if version is not None and self.versions.newest(tags) > version:
+            # Invalidated, maybe by another process, since it was rendered.
+            self.delete(key)
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return default
+        return value
+
+    def set(self, key, value, tags=(), snapshot=None):
+        tags = tuple(tags)
+        if not _fresh(snapshot, self.ttl):
+            return
+        if snapshot is None:
+            snapshot = self.begin()
+        # Drop any previous entry first, so its tags don't outlive it.
+        self.delete(key)
+        with self._lock:
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+        super().set(key, (value, tags, snapshot and snapshot.version))
+
+    def invalidate(self, tags):
+        """Drops every entry carrying any of the given tags."""
+        tags = list(tags)
+        if self.versions is not None and tags:
+            self.versions.bump(tags)
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        if self.versions is not None:
+            self.versions.bump(['*'])
+        super().clear()
+
+    def _removed(self, key, value):
+        for tag in value[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _cleared(self):
+        self._tags.clear()
+
+
+def _begin(versions):
+    if versions is None:
+        return None
+    return Snapshot(versions.current(), time.time())
+
+
+def _fresh(snapshot, ttl):
+    # A render slower than the TTL isn't stored: its page could outlive the
+    # invalidation numbers it is checked against.
+    return snapshot is None or time.time() - snapshot.started < ttl
+
+
+# The same interface backed by an SQLite file, shared by every worker process
+# on the machine, so a page rendered by one worker is served by all of them.
+# Pages are stored as JSON, so the file holds data and never code.
+class SQLiteTaggedCache(object):
+    """A TaggedCache whose entries live in a separate SQLite database."""
+
+    SCHEMA = (
+        'DROP TABLE IF EXISTS cache_entry',  # Held pickled pages; superseded.
+        'CREATE TABLE IF NOT EXISTS cache_page ('
+        ' key TEXT PRIMARY KEY, value TEXT NOT NULL, tags TEXT NOT NULL,'
+        ' version INTEGER NOT NULL, expires REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS cache_tag ('
+        ' tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))'
+        ' WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS cache_tag_key ON cache_tag (key)',
+    )
+
+    def __init__(self, path, maxsize=10000, ttl=300.0, versions=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.versions = versions or TagVersions(path, keep=2 * ttl)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sets = 0
+        self.hits = 0
+        self.misses = 0
+
+        with self._connect() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = normal')
+        return db
+
+    def begin(self):
+        """Returns the snapshot to store a page rendered from now on with."""
+        return _begin(self.versions)
+
+    def get(self, key, default=None):
+        row = self._connect().execute(
+            'SELECT value, tags, version FROM cache_page WHERE key = ? AND expires > ?',
+            (key, time.time())
+        ).fetchone()
+        if row is not None and self.versions.newest(json.loads(row[1])) > row[2]:
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, tags=(), snapshot=None):
+        tags = tuple(tags)
+        if not _fresh(snapshot, self.ttl):
+            return
+        if snapshot is None:
+            snapshot = self.begin()
+        with self._connect() as db:
+            db.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+            db.execute(
+                'INSERT OR REPLACE INTO cache_page (key, value, tags, version, expires)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(value), json.dumps(tags), snapshot.version,
+                 time.time() + self.ttl)
+            )
+            db.executemany(
+                'INSERT OR IGNORE INTO cache_tag (tag, key) VALUES (?, ?)',
+                [(tag, key) for tag in tags]
+            )
+
+        with self._lock:
+            self._sets += 1
+            purge = self._sets % 100 == 0
+        if purge:
+            self.purge()
+
+    def delete(self, key):
+        with self._connect() as db:
+            db.execute('DELETE FROM cache_page WHERE key = ?', (key,))
+            db.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+
+    def invalidate(self, tags):
+        """Drops every entry carrying any of the given tags."""
+        tags = list(tags)
+        if not tags:
+            return
+        self.versions.bump(tags)
+        marks = ', '.join('?' * len(tags))
+        with self._connect() as db:
+            keys = [row[0] for row in db.execute(
+                f'SELECT DISTINCT key FROM cache_tag WHERE tag IN ({marks})', tags
+            )]
+            db.executemany('DELETE FROM cache_page WHERE key = ?', [(k,) for k in keys])
+            db.executemany('DELETE FROM cache_tag WHERE key = ?', [(k,) for k in keys])
+
+    def purge(self):
+        """Removes expired entries, then the oldest ones beyond maxsize."""
+        with self._connect() as db:
+            db.execute('DELETE FROM cache_page WHERE expires <= ?', (time.time(),))
+            db.execute(
+                'DELETE FROM cache_page WHERE key IN (SELECT key FROM cache_page'
+                ' ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.maxsize,)
+            )
+            db.execute(
+                'DELETE FROM cache_tag WHERE key NOT IN (SELECT key FROM cache_page)'
+            )
+
+    def clear(self):
+        self.versions.bump(['*'])
+        with self._connect() as db:
+            db.execute('DELETE FROM cache_page')
+            db.execute('DELETE FROM cache_tag')
+
+    def stats(self):
+        size = self._connect().execute('SELECT COUNT(*) FROM cache_page').fetchone()[0]
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': size,
+                'maxsize': self.maxsize,
+            }
+
+
+# Rendered index pages are cached per process in memory or, with PAGE_CACHE set
+# to 'sqlite', in a file shared by all workers. Each page is tagged with the
+# posts it shows, so writes only evict the pages they change.
+def get_page_cache(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    backend = app.config['PAGE_CACHE']
+    if not backend:
+        return None
+
+    cache = app.extensions.get('flaskr.page_cache')
+    if cache is None:
+        # Either way, invalidations reach every worker through the file.
+        ttl = app.config['PAGE_CACHE_TTL']
+        versions = TagVersions(app.config['PAGE_CACHE_DATABASE'], keep=2 * ttl)
+        if backend == 'sqlite':
+            cache = SQLiteTaggedCache(
+                app.config['PAGE_CACHE_DATABASE'],
+                maxsize=app.config['PAGE_CACHE_SIZE'], ttl=ttl, versions=versions,
+            )
+        else:
+            cache = TaggedCache(
+                maxsize=app.config['PAGE_CACHE_SIZE'], ttl=ttl, versions=versions,
+            )
+        cache = app.extensions.setdefault('flaskr.page_cache', cache)
+
+    return cache
+
+
+def invalidate_pages(*tags):
+    """Drops the cached pages carrying any of the given tags."""
+    cache = get_page_cache()
+    if cache is not None:
+        cache.invalidate(tags)
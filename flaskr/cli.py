@@ -0,0 +1,43 @@
+import importlib
+
+from flask.cli import AppGroup
+
+# Every flask command of the app, as 'module:attribute' of its click command.
+# Web workers never run a command, so the modules are only imported when the
+# flask command looks one up.
+COMMANDS = {
+    'init-db': 'flaskr.commands:init_db_command',
+    'db-tune': 'flaskr.commands:db_tune_command',
+    'reindex': 'flaskr.commands:reindex_command',
+    'recount': 'flaskr.commands:recount_command',
+    'rerender-posts': 'flaskr.commands:rerender_posts_command',
+    'export-posts': 'flaskr.commands:export_posts_command',
+    'import-posts': 'flaskr.commands:import_posts_command',
+    'export-users': 'flaskr.commands:export_users_command',
+    'import-users': 'flaskr.commands:import_users_command',
+    'db-upgrade': 'flaskr.migrate:db_upgrade_command',
+    'db-status': 'flaskr.migrate:db_status_command',
+    'precompile-templates': 'flaskr.templating:precompile_templates_command',
+    'compress-static': 'flaskr.assets:compress_static_command',
+    'bench': 'flaskr.bench:bench_command',
+    'worker': 'flaskr.jobs:worker_command',
+    'jobs': 'flaskr.jobs:jobs_command',
+    'import-profile': 'flaskr.startup:import_profile_command',
+}
+
+
+class LazyGroup(AppGroup):
+    """An AppGroup that imports its commands the first time they are used."""
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = dict(lazy_commands or {})
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.lazy_commands:
+            module, attribute = self.lazy_commands[name].split(':')
+            self.add_command(getattr(importlib.import_module(module), attribute), name)
+        return super().get_command(ctx, name)
@@ -0,0 +1,160 @@
+import click
+import contextlib
+import sqlite3
+import time
+
+from flask.cli import with_appcontext
+
+from flaskr import db
+from flaskr.cache import get_page_cache
+from flaskr.rendering import rerender_posts
+
+# The database commands. They are only imported when the flask command runs
+# one of them, see flaskr.cli; web workers never load this module.
+
+
+# Defines a command line command called init-db that calls the init_db function 
+# and shows a success message to the user.
+@click.command('init-db')
+def init_db_command():
+    """Clear the existing data and create new tables."""
+    db.init_db()
+    click.echo('Initialized the database.')
+
+
+@click.command('reindex')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Posts indexed per transaction.')
+@click.option('--full', is_flag=True, help='Drop the index and rebuild it from scratch.')
+@with_appcontext
+def reindex_command(batch_size, full):
+    """Build the full-text search index for existing posts."""
+    try:
+        indexed = db.reindex_posts(
+            batch_size, full,
+            progress=lambda last_id, n: click.echo(f'Indexed {n} posts (up to id {last_id}).')
+        )
+    except sqlite3.OperationalError as e:
+        raise click.ClickException(f'Could not update the search index: {e}')
+    click.echo(f'Search index up to date, {indexed} posts added.')
+
+
+@click.command('recount')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Authors recounted per transaction.')
+@with_appcontext
+def recount_command(batch_size):
+    """Rebuild the per-author post counts from the posts."""
+    start = time.perf_counter()
+    count = db.recount_author_stats(
+        batch_size, progress=lambda n: _report('Recounted', n, start)
+    )
+    _report('Recounted', count, start)
+
+
+@click.command('rerender-posts')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Posts rendered per transaction.')
+@click.option('--workers', default=None, type=click.IntRange(min=0),
+              help='Rendering processes; 0 renders in this one. Defaults to one per CPU.')
+@click.option('--full', is_flag=True, help='Render every post, not only stale ones.')
+@with_appcontext
+def rerender_posts_command(batch_size, workers, full):
+    """Render post bodies saved without Markdown or by an older renderer."""
+    start = time.perf_counter()
+    count = rerender_posts(
+        batch_size, workers, full, progress=lambda n: _report('Rendered', n, start)
+    )
+    _report('Rendered', count, start)
+
+    # Cached index pages show the old excerpts.
+    cache = get_page_cache()
+    if count and cache is not None:
+        cache.clear()
+
+
+def _open_transfer_file(path, mode):
+    # '-' stands for standard input or output, so data can be piped.
+    if path == '-':
+        return contextlib.nullcontext(
+            click.get_text_stream('stdin' if mode == 'r' else 'stdout')
+        )
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _transfer_format(path, format):
+    if format is None:
+        format = 'csv' if path.endswith('.csv') else 'jsonl'
+    return format
+
+
+def _make_export_command(table, name):
+    @click.command(name)
+    @click.argument('path', type=click.Path(allow_dash=True))
+    @click.option('--format', type=click.Choice(['jsonl', 'csv']),
+                  help='File format, guessed from the file name by default.')
+    @with_appcontext
+    def command(path, format):
+        start = time.perf_counter()
+        with _open_transfer_file(path, 'w') as file:
+            count = db.export_rows(table, file, _transfer_format(path, format))
+        _report('Exported', count, start)
+
+    command.help = f'Export every {table} row to a JSONL or CSV file.'
+    return command
+
+
+def _make_import_command(table, name):
+    @click.command(name)
+    @click.argument('path', type=click.Path(exists=True, allow_dash=True))
+    @click.option('--format', type=click.Choice(['jsonl', 'csv']),
+                  help='File format, guessed from the file name by default.')
+    @click.option('--batch-size', default=5000, show_default=True,
+                  help='Rows inserted per transaction.')
+    @click.option('--defer-indexes', is_flag=True,
+                  help='Drop indexes during the import and rebuild them at the end.')
+    @with_appcontext
+    def command(path, format, batch_size, defer_indexes):
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if defer_indexes:
+                # Entered first, so the recount runs once the indexes are back.
+                if table == 'post':
+                    stack.enter_context(db.deferred_author_stats())
+                stack.enter_context(db.deferred_indexes(table))
+                if table == 'post':
+                    stack.enter_context(db.deferred_search_index())
+            file = stack.enter_context(_open_transfer_file(path, 'r'))
+            count = db.import_rows(
+                table, db.read_rows(file, _transfer_format(path, format)), batch_size,
+                progress=lambda n: _report('Imported', n, start)
+            )
+        _report('Imported', count, start)
+
+        # Pages cached in the shared tier may no longer match the data.
+        cache = get_page_cache()
+        if cache is not None:
+            cache.clear()
+
+    command.help = f'Import {table} rows from a JSONL or CSV file in batches.'
+    return command
+
+
+def _report(action, count, start):
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed else 0
+    click.echo(f'{action} {count} rows in {elapsed:.2f}s ({rate:.0f} rows/s).', err=True)
+
+
+export_posts_command = _make_export_command('post', 'export-posts')
+import_posts_command = _make_import_command('post', 'import-posts')
+export_users_command = _make_export_command('user', 'export-users')
+import_users_command = _make_import_command('user', 'import-users')
+
+
+@click.command('db-tune')
+@with_appcontext
+def db_tune_command():
+    """Show the SQLite settings in effect for new connections."""
+    for pragma, value in db.pragma_report(db.get_db()).items():
+        click.echo(f'{pragma} = {value}')
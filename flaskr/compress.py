@@ -0,0 +1,64 @@
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # Optional; responses are only gzipped without it.
+    brotli = None
+
+
+def accepted_encodings():
+    """Returns the encodings this app can produce that the client accepts, best first."""
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return [encoding for encoding in encodings if request.accept_encodings[encoding]]
+
+
+def compress(data, encoding, level=6):
+    if encoding == 'br':
+        # Brotli's quality goes up to 11; its middle settings match gzip's speed.
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def init_app(app):
+    app.after_request(compress_response)
+
+
+# Text compresses to a fraction of its size, which matters most to clients on
+# slow connections. Small bodies are left alone: they fit in a packet or two
+# anyway, and compressing them costs more than it saves.
+def compress_response(response):
+    config = current_app.config
+    if (
+        not config['COMPRESS_MIN_SIZE']
+        or response.status_code != 200
+        or response.mimetype not in config['COMPRESS_MIMETYPES']
+        # Streamed pages and files (sent straight from disk) are skipped;
+        # static files come precompressed instead, see flaskr.assets.
+        or response.is_streamed
+        or response.direct_passthrough
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encodings = accepted_encodings()
+    if not encodings:
+        return response
+
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.set_data(compress(data, encodings[0], config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = encodings[0]
+
+    # The compressed body is a different sequence of bytes, so a strong ETag
+    # must not be reused. A weak one still matches If-None-Match, which keeps
+    # the 304s working.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
@@ -1,22 +1,27 @@
-import click
+import contextlib
+import csv
+import itertools
+import json
+import os
+import pathlib
+import re
 import sqlite3
+import threading
+import time
 
 from datetime import datetime
 from flask import current_app, g
 
+from flaskr.instrument import instrument
+from flaskr.pool import ConnectionPool, PooledConnection, RoutingConnection
+from flaskr.writequeue import WriteQueue
+
+_pool_lock = threading.Lock()
+
+
 def init_app(app):
     # Tells Flask to call that function when cleaning up after returning the response.
     app.teardown_appcontext(close_db)
-    # Adds a new command that can be called with the flask command.
-    app.cli.add_command(init_db_command)
-
-# Defines a command line command called init-db that calls the init_db function 
-# and shows a success message to the user.
-@click.command('init-db')
-def init_db_command():
-    """Clear the existing data and create new tables."""
-    init_db()
-    click.echo('Initialized the database.')
 
 
 def init_db():
@@ -27,22 +32,466 @@ def init_db():
         script = file.read().decode('utf-8')
         db.executescript(script)
 
+    # The schema is already the latest one; later changes come from migrations.
+    from flaskr.migrate import stamp
+    stamp(db)
+
+
+def migration_applied(version):
+    """Tells whether schema migration `version` has been applied to the database."""
+    # Only an applied one is remembered, so a process notices `flask db-upgrade`.
+    applied = current_app.extensions.setdefault('flaskr.migrations_applied', set())
+    if version in applied:
+        return True
+    try:
+        row = get_db().execute(
+            'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # No schema_version table: the database predates migrations.
+        row = None
+    if row is not None:
+        applied.add(version)
+    return row is not None
+
+
+def reindex_posts(batch_size=1000, full=False, progress=None):
+    """Adds every post missing from the search index, one batch at a time.
+
+    Each batch is committed on its own, so writers are only held up for the
+    duration of one batch. Posts already indexed are skipped, which makes it
+    safe to stop and resume the command at any point.
+    """
+    db = get_db()
+    if full:
+        db.execute('DELETE FROM post_fts')
+        db.commit()
+
+    last_id = 0
+    indexed = 0
+    while True:
+        ids = db.execute(
+            'SELECT id FROM post WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not ids:
+            break
+
+        first_id, last_id = ids[0]['id'], ids[-1]['id']
+        cursor = db.execute(
+            'INSERT INTO post_fts (rowid, title, body)'
+            ' SELECT id, title, body FROM post p'
+            ' WHERE id BETWEEN ? AND ?'
+            ' AND NOT EXISTS (SELECT 1 FROM post_fts f WHERE f.rowid = p.id)',
+            (first_id, last_id)
+        )
+        db.commit()
+        indexed += cursor.rowcount
+        if progress is not None:
+            progress(last_id, indexed)
+
+    return indexed
+
+
+# Larger than any author id; the last batch of a recount reaches up to it.
+_MAX_ID = 2 ** 63 - 1
+
+
+def recount_author_stats(batch_size=1000, progress=None):
+    """Rebuilds author_stats from the posts, one batch of authors at a time.
+
+    Each batch is deleted and recounted in a single transaction, so its rows
+    match the posts even while they are being written, and writers are only
+    held up for the duration of one batch.
+    """
+    db = get_db()
+    last_id = 0
+    recounted = 0
+    while last_id < _MAX_ID:
+        ids = db.execute(
+            'SELECT id FROM user WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        # The last batch also covers posts whose author is no longer a user.
+        first_id, last_id = last_id, ids[-1]['id'] if len(ids) == batch_size else _MAX_ID
+
+        db.execute(
+            'DELETE FROM author_stats WHERE author_id > ? AND author_id <= ?',
+            (first_id, last_id)
+        )
+        cursor = db.execute(
+            'INSERT INTO author_stats (author_id, post_count, latest_post_id)'
+            ' SELECT author_id, COUNT(*),'
+            ' (SELECT id FROM post l WHERE l.author_id = p.author_id'
+            '  ORDER BY created DESC, id DESC LIMIT 1)'
+            ' FROM post p WHERE author_id > ? AND author_id <= ?'
+            ' GROUP BY author_id',
+            (first_id, last_id)
+        )
+        db.commit()
+        recounted += cursor.rowcount
+        if progress is not None:
+            progress(recounted)
+
+    return recounted
+
+
+# The columns moved by the import and export commands, per table.
+TRANSFER_COLUMNS = {
+    'post': ('id', 'author_id', 'created', 'title', 'body'),
+    'user': ('id', 'username', 'password'),
+}
+
+
+def export_rows(table, file, format='jsonl'):
+    """Writes every row of a table to a file, streaming it in constant memory."""
+    columns = TRANSFER_COLUMNS[table]
+    cursor = get_db().execute(
+        f'SELECT {", ".join(columns)} FROM {table} ORDER BY id'
+    )
+    cursor.arraysize = 1000
+
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+    count = 0
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        for row in rows:
+            if format == 'csv':
+                writer.writerow(tuple(row))
+            else:
+                file.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+        count += len(rows)
+
+    return count
+
+
+def read_rows(file, format='jsonl'):
+    """Yields the records of a JSONL or CSV file one at a time."""
+    if format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+@contextlib.contextmanager
+def deferred_indexes(table):
+    """Drops a table's secondary indexes and builds them again afterwards.
+
+    Building an index once over all the rows is much faster than updating
+    it row by row while they are inserted.
+    """
+    db = get_db()
+    indexes = db.execute(
+        "SELECT name, sql FROM sqlite_master"
+        " WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)
+    ).fetchall()
+    for index in indexes:
+        db.execute(f'DROP INDEX {index["name"]}')
+    db.commit()
+
+    try:
+        yield
+    finally:
+        for index in indexes:
+            db.execute(index['sql'])
+        db.commit()
+
+
+@contextlib.contextmanager
+def deferred_search_index():
+    """Pauses the search index triggers and indexes the new posts afterwards."""
+    db = get_db()
+    triggers = db.execute(
+        "SELECT name, sql FROM sqlite_master"
+        " WHERE type = 'trigger' AND name LIKE 'post_fts_%'"
+    ).fetchall()
+    for trigger in triggers:
+        db.execute(f'DROP TRIGGER {trigger["name"]}')
+    db.commit()
+
+    try:
+        yield
+    finally:
+        for trigger in triggers:
+            db.execute(trigger['sql'])
+        db.commit()
+        if triggers:
+            reindex_posts()
+
+
+@contextlib.contextmanager
+def deferred_author_stats():
+    """Pauses the author_stats triggers and recounts every author afterwards.
+
+    The triggers look up each author's latest post through post_author_created,
+    which deferred_indexes drops, so they would scan the post table per row.
+    """
+    db = get_db()
+    triggers = db.execute(
+        "SELECT name, sql FROM sqlite_master"
+        " WHERE type = 'trigger' AND name LIKE 'author_stats_%'"
+    ).fetchall()
+    for trigger in triggers:
+        db.execute(f'DROP TRIGGER {trigger["name"]}')
+    db.commit()
+
+    try:
+        yield
+    finally:
+        for trigger in triggers:
+            db.execute(trigger['sql'])
+        db.commit()
+        if triggers:
+            recount_author_stats()
+
+
+def import_rows(table, records, batch_size=5000, progress=None):
+    """Inserts records into a table with one executemany per transaction."""
+    columns = TRANSFER_COLUMNS[table]
+    values = ', '.join(
+        # Rows without a creation time get the same default as the column.
+        'COALESCE(?, CURRENT_TIMESTAMP)' if column == 'created' else '?'
+        for column in columns
+    )
+    db = get_db()
+
+    count = 0
+    records = iter(records)
+    while True:
+        batch = [
+            tuple(_import_value(record, column) for column in columns)
+            for record in itertools.islice(records, batch_size)
+        ]
+        if not batch:
+            break
+
+        with db:
+            db.executemany(
+                f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({values})',
+                batch
+            )
+        count += len(batch)
+        if progress is not None:
+            progress(count)
+
+    return count
+
+
+def _import_value(record, column):
+    value = record.get(column)
+    # CSV files can't tell a missing id or creation time from an empty one.
+    if value == '' and column in ('id', 'created'):
+        return None
+    return value
+
+
+# The pragmas applied to every new connection, each set by the config key next to
+# it (a value of None leaves SQLite's default alone). WAL lets readers carry on
+# while one writer commits, and busy_timeout makes a writer wait for the lock
+# instead of failing straight away with "database is locked".
+PRAGMAS = (
+    ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+    ('synchronous', 'SQLITE_SYNCHRONOUS'),
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+    ('cache_size', 'SQLITE_CACHE_SIZE'),
+    ('mmap_size', 'SQLITE_MMAP_SIZE'),
+    ('temp_store', 'SQLITE_TEMP_STORE'),
+)
+
+# SQLite reports these pragmas as numbers; the names are easier to read.
+_PRAGMA_NAMES = {
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory'),
+}
+
+
+def apply_pragmas(db, config, readonly=False):
+    """Applies the configured pragma profile to a connection."""
+    for pragma, key in PRAGMAS:
+        value = config.get(key)
+        # The journal mode is a property of the database file, which
+        # a read-only connection isn't allowed to change.
+        if value is None or (readonly and pragma == 'journal_mode'):
+            continue
+        # Pragma values can't be bound as parameters, so only plain
+        # words and numbers are let through.
+        if not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'Invalid value for {key}: {value!r}')
+        db.execute(f'PRAGMA {pragma} = {value}')
+
+
+def pragma_report(db):
+    """Returns the effective value of each tuned pragma on a connection."""
+    report = {}
+    for pragma, _ in PRAGMAS:
+        value = db.execute(f'PRAGMA {pragma}').fetchone()[0]
+        names = _PRAGMA_NAMES.get(pragma)
+        if names is not None and 0 <= value < len(names):
+            value = names[value]
+        report[pragma] = value
+    return report
+
+
+def connect(app, readonly=False):
+    """Opens a new connection to the app's database."""
+    database = app.config['DATABASE']
+    if readonly:
+        # SQLite itself refuses writes on this connection.
+        database = pathlib.Path(os.path.abspath(database)).as_uri() + '?mode=ro'
+
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # Pooled connections are handed from one request thread to the next.
+        check_same_thread=False,
+        uri=readonly,
+    )
+    # Tells the connection to return rows that behave like dicts. 
+    # This allows accessing the columns by name.
+    db.row_factory = sqlite3.Row
+    apply_pragmas(db, app.config, readonly)
+    if readonly:
+        db.execute('PRAGMA query_only = 1')
+    return db
+
+
+# Each app keeps one pool of write connections per process, plus one of
+# read-only connections unless DB_READ_POOL_SIZE is 0. They are created on
+# first use, so a worker forked from a preloaded master builds its own.
+def get_pool(app=None, readonly=False):
+    if app is None:
+        app = current_app._get_current_object()
+
+    key = 'flaskr.db_read_pool' if readonly else 'flaskr.db_pool'
+    pool = app.extensions.get(key)
+    if pool is None:
+        size = app.config['DB_READ_POOL_SIZE' if readonly else 'DB_POOL_SIZE']
+        if not size:
+            return None
+        with _pool_lock:
+            pool = app.extensions.get(key)
+            if pool is None:
+                pool = app.extensions[key] = ConnectionPool(
+                    lambda: connect(app, readonly),
+                    size=size,
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                )
+
+    return pool
+
+
+def pool_stats(app=None, readonly=False):
+    """Returns the connection pool counters of this process."""
+    return get_pool(app, readonly).stats()
+
+
+def close_pool(app):
+    """Closes the app's idle pooled connections."""
+    # Read-only connections first: only a write connection, closed last, can
+    # checkpoint the WAL and remove the -wal and -shm files.
+    for key in ('flaskr.db_read_pool', 'flaskr.db_pool'):
+        pool = app.extensions.pop(key, None)
+        if pool is not None:
+            pool.close()
+
+
+def get_write_queue(app=None):
+    """Returns the app's single-writer queue, or None unless DB_WRITE_QUEUE is set."""
+    if app is None:
+        app = current_app._get_current_object()
+
+    if not app.config['DB_WRITE_QUEUE']:
+        return None
+
+    queue = app.extensions.get('flaskr.write_queue')
+    if queue is None:
+        with _pool_lock:
+            queue = app.extensions.get('flaskr.write_queue')
+            if queue is None:
+                queue = app.extensions['flaskr.write_queue'] = WriteQueue(
+                    lambda: connect(app),
+                    max_batch=app.config['DB_WRITE_BATCH'],
+                )
+
+    return queue
+
+
+def run_write(fn):
+    """Runs fn(db) in a transaction, commits it and returns fn's result.
+
+    With DB_WRITE_QUEUE set, the work is handed to the writer thread and
+    committed together with whatever other writes are waiting.
+    """
+    queue = get_write_queue()
+    if queue is not None:
+        return queue.submit(fn)
+
+    db = get_db()
+    retries = current_app.config['DB_LOCK_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            result = fn(db)
+            db.commit()
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            # busy_timeout already waited for the lock; a few more tries with
+            # a short backoff get through a long checkpoint or bulk import.
+            if not is_locked_error(e) or attempt == retries:
+                raise
+            count_lock_retry()
+            time.sleep(0.05 * 2 ** attempt)
+        except Exception:
+            db.rollback()
+            raise
+        else:
+            return result
+
+
+def is_locked_error(e):
+    return isinstance(e, sqlite3.OperationalError) and 'database is locked' in str(e)
+
+
+def count_lock_retry(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    with _pool_lock:
+        stats = app.extensions.setdefault('flaskr.db_stats', {'lock_retries': 0})
+        stats['lock_retries'] += 1
+
+
+def db_stats(app=None):
+    """Returns the database counters of this process, such as lock retries."""
+    if app is None:
+        app = current_app._get_current_object()
+    return dict(app.extensions.get('flaskr.db_stats', {'lock_retries': 0}))
+
 
 # get_db will be called when the application has been created and 
 # is handling a request, so current_app can be used.
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        # Tells the connection to return rows that behave like dicts. 
-        # This allows accessing the columns by name.
-        g.db.row_factory = sqlite3.Row
+        pool = get_pool()
+        read_pool = get_pool(readonly=True)
+        if read_pool is None:
+            g.db = PooledConnection(pool, pool.acquire())
+        else:
+            g.db = RoutingConnection(read_pool, pool)
+        if current_app.config['SQL_INSTRUMENTATION']:
+            g.db = instrument(g.db)
 
     return g.db
 
 
+# Gives the connection back to the pool instead of closing it; anything
+# the request left uncommitted is rolled back first.
 def close_db(e=None):
     db = g.pop('db', None)
 
@@ -53,4 +502,4 @@ def close_db(e=None):
 # Tells Python how to interpret timestamp values in the database.
 sqlite3.register_converter(
     "timestamp", lambda v: datetime.fromisoformat(v.decode())
-)
\ No newline at end of file
+)
@@ -0,0 +1,121 @@
+import atexit
+import functools
+import os
+import threading
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Password hashes are deliberately slow to compute. Running them on a small pool
+# of worker processes keeps a burst of logins from starving every other request
+# thread of CPU, and the bounded queue in front of it turns an overload into a
+# quick 503 instead of a pile of requests that all time out.
+class HashingPool(object):
+    """A process pool that runs at most `max_pending` hashing jobs at a time."""
+
+    def __init__(self, workers, max_pending):
+        # Imported here: most processes never hash a password.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Processes are spawned rather than forked: forking a process that
+        # runs request threads can copy locks held by those threads.
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, fn, *args, timeout=None):
+        """Runs fn(*args) in the pool, or aborts with 503 when it is full."""
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable(
+                'Too many password checks in progress.', retry_after=1
+            )
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Already imported by the executor.
+        from concurrent.futures import TimeoutError
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # The pool is too backed up to answer in time; same as a full queue.
+            raise ServiceUnavailable(
+                'Password checks are taking too long.', retry_after=1
+            )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+@atexit.register
+def _shutdown_pools():
+    # Shut down while the interpreter is still whole; the executors' own
+    # cleanup fails once modules are being torn down.
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+# The pool isn't tied to one app: every app in the process with the same
+# settings shares it, so the number of hashing processes stays bounded.
+def get_hashing_pool(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if not workers:
+        return None
+
+    key = (workers, app.config['PASSWORD_HASH_QUEUE'])
+    with _pools_lock:
+        # A forked worker can't use its parent's pool, so each process has its own.
+        pool = _pools.get((os.getpid(),) + key)
+        if pool is None:
+            pool = _pools[(os.getpid(),) + key] = HashingPool(*key)
+
+    return pool
+
+
+def _run(fn, *args):
+    pool = get_hashing_pool()
+    if pool is None:
+        return fn(*args)
+    return pool.run(fn, *args, timeout=current_app.config['PASSWORD_HASH_TIMEOUT'])
+
+
+def hash_password(password):
+    """Hashes a password with the configured method and parameters."""
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pwhash, password):
+    """Checks a password against a stored hash."""
+    return _run(check_password_hash, pwhash, password)
+
+
+# A method may leave out its parameters ('scrypt', 'pbkdf2:sha256'), in which
+# case werkzeug fills in its defaults. What it actually stores is read off a
+# hash made with it, once per method.
+@functools.lru_cache(maxsize=8)
+def stored_method(method):
+    """Returns the method and parameters werkzeug writes into hashes made with method."""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def needs_rehash(pwhash):
+    """Tells whether a stored hash was made with outdated parameters."""
+    return pwhash.split('$', 1)[0] != stored_method(current_app.config['PASSWORD_HASH_METHOD'])
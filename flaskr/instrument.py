@@ -0,0 +1,178 @@
+import time
+
+from flask import current_app, g, request
+
+
+# One executed statement. Its duration covers the execute call and the time
+# spent fetching its rows afterwards, since SQLite does most of the work lazily.
+class QueryRecord(object):
+    __slots__ = ('sql', 'params', 'duration', 'rows')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.duration = 0.0
+        self.rows = 0
+
+
+class InstrumentedCursor(object):
+    """Wraps a cursor to add fetch time and fetched rows to a QueryRecord."""
+
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def _timed(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._record.duration += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None:
+            self._record.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(self._cursor.fetchmany, *args)
+        self._record.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._record.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+class InstrumentedConnection(object):
+    """Wraps a connection and records every statement run through it."""
+
+    def __init__(self, conn, queries):
+        self._conn = conn
+        self.queries = queries
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def _run(self, method, sql, params):
+        record = QueryRecord(sql, params)
+        self.queries.append(record)
+        start = time.perf_counter()
+        try:
+            cursor = method(sql, params)
+        finally:
+            record.duration += time.perf_counter() - start
+        return InstrumentedCursor(cursor, record)
+
+    def execute(self, sql, params=()):
+        return self._run(self._conn.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        cursor = self._run(self._conn.executemany, sql, seq_of_params)
+        cursor._record.params = None  # Often a one-shot iterator; not kept.
+        return cursor
+
+    def executescript(self, script):
+        return self._run(lambda sql, _: self._conn.executescript(sql), script, None)
+
+    def close(self):
+        self._conn.close()
+
+
+def get_queries():
+    """Returns the statements recorded so far in this app context."""
+    if 'sql_queries' not in g:
+        g.sql_queries = []
+    return g.sql_queries
+
+
+def instrument(conn):
+    """Wraps a connection so its statements are recorded in this app context."""
+    return InstrumentedConnection(conn, get_queries())
+
+
+def find_table_scans(conn, sql, params):
+    """Returns the EXPLAIN QUERY PLAN steps of a statement that scan a whole table."""
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE')):
+        return []
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()
+    # 'SCAN post' reads every row; 'SCAN post USING INDEX ...' walks an
+    # index in order and stops early, which is what the index page does.
+    return [
+        step['detail'] for step in plan
+        if step['detail'].startswith('SCAN ') and ' USING ' not in step['detail']
+    ]
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_report_queries)
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+# Adds the query count and time to the response as a Server-Timing header, which
+# browser dev tools show next to the request, and logs the slow statements.
+def _report_queries(response):
+    queries = g.get('sql_queries', ())
+    db_time = sum(query.duration for query in queries) * 1000
+    total = (time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000
+
+    response.headers.add(
+        'Server-Timing', f'db;dur={db_time:.2f};desc="{len(queries)} queries"'
+    )
+    response.headers.add('Server-Timing', f'total;dur={total:.2f}')
+
+    threshold = current_app.config['SLOW_QUERY_MS']
+    if threshold is not None:
+        # A copy, since explaining a query records one more statement.
+        for query in list(queries):
+            if query.duration * 1000 >= threshold:
+                _log_slow_query(query)
+
+    return response
+
+
+def _log_slow_query(query):
+    current_app.logger.warning(
+        'Slow query (%.1f ms, %d rows) in %s: %s',
+        query.duration * 1000, query.rows, request.endpoint, query.sql
+    )
+
+    if not current_app.config['SLOW_QUERY_EXPLAIN'] or query.params is None:
+        return
+    if 'db' not in g:
+        return
+    try:
+        scans = find_table_scans(g.db, query.sql, query.params)
+    except Exception as e:  # The plan is a diagnostic; never fail the request.
+        current_app.logger.debug('Could not explain %r: %s', query.sql, e)
+        return
+    for scan in scans:
+        current_app.logger.warning('Full table scan (%s) in: %s', scan, query.sql)
@@ -0,0 +1,415 @@
+import click
+import importlib
+import json
+import os
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+
+from collections import namedtuple
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+# Work that doesn't have to finish before a response is sent - rendering a
+# post, say - is queued as a job instead, and a worker runs it later. Jobs are
+# rows in an SQLite file, so they survive restarts and any process on the
+# machine can run them: worker threads in each web process, a separate
+# `flask worker` process, or both.
+def task(retries=3):
+    """Marks a function as a job that can be queued with enqueue().
+
+    A job that raises is tried again, up to `retries` more times, after a
+    delay that doubles with every attempt. A job must finish within
+    JOBS_LEASE seconds: past that it is taken as abandoned and handed to
+    another worker, so a slow one would run twice at the same time.
+    """
+    def decorator(fn):
+        # Workers find the function again by its import path.
+        fn.task_name = f'{fn.__module__}:{fn.__qualname__}'
+        fn.max_attempts = retries + 1
+        return fn
+
+    return decorator
+
+
+def get_task(name):
+    """Returns the function of a task by name; only functions marked with @task qualify."""
+    module, attribute = name.split(':')
+    fn = getattr(importlib.import_module(module), attribute, None)
+    if getattr(fn, 'task_name', None) != name:
+        raise LookupError(f'{name} is not a task.')
+    return fn
+
+
+# A job claimed by a worker; args and kwargs are the ones given to enqueue().
+Job = namedtuple('Job', 'id task args kwargs attempts max_attempts')
+
+
+class SQLiteJobQueue(object):
+    """Jobs in an SQLite file, shared by every process on the machine."""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS job ('
+        ' id INTEGER PRIMARY KEY,'
+        ' task TEXT NOT NULL,'
+        ' args TEXT NOT NULL,'
+        " status TEXT NOT NULL DEFAULT 'queued',"  # queued, running, done or failed.
+        ' attempts INTEGER NOT NULL DEFAULT 0,'
+        ' max_attempts INTEGER NOT NULL,'
+        ' run_at REAL NOT NULL,'
+        ' created REAL NOT NULL,'
+        ' started REAL,'
+        ' finished REAL,'
+        ' error TEXT)',
+        'CREATE INDEX IF NOT EXISTS job_status_run_at ON job (status, run_at)',
+    )
+
+    def __init__(self, path, lease=300, keep=86400, purge_batch=500):
+        self.path = path
+        # A job running for longer than `lease` seconds is taken to belong to
+        # a worker that died, and is handed to another one - or marked failed,
+        # if that was its last attempt. Jobs must finish well within it.
+        self.lease = lease
+        self.keep = keep  # Seconds finished jobs are kept for inspection.
+        self.purge_batch = purge_batch
+        self._local = threading.local()
+
+        db = self._connect()
+        for statement in self.SCHEMA:
+            db.execute(statement)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = normal')
+        return db
+
+    def put(self, task, args=(), kwargs=None, max_attempts=1, delay=0):
+        """Queues a job and returns its id."""
+        now = time.time()
+        return self._connect().execute(
+            'INSERT INTO job (task, args, max_attempts, run_at, created)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (task, json.dumps([list(args), kwargs or {}]), max_attempts, now + delay, now)
+        ).lastrowid
+
+    def claim(self):
+        """Marks the next job that is due as running and returns it, or None."""
+        now = time.time()
+        db = self._connect()
+        # Claim under the write lock, so two workers can't take the same job.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # An abandoned job counts as a failed attempt: one that hangs or
+            # kills its worker every time must not be retried forever.
+            db.execute(
+                "UPDATE job SET status = 'failed', finished = ?,"
+                " error = 'Lease expired before the job finished.'"
+                " WHERE status = 'running' AND started < ? AND attempts >= max_attempts",
+                (now, now - self.lease)
+            )
+            db.execute(
+                "UPDATE job SET status = 'queued'"
+                " WHERE status = 'running' AND started < ?", (now - self.lease,)
+            )
+            row = db.execute(
+                'SELECT id, task, args, attempts, max_attempts FROM job'
+                " WHERE status = 'queued' AND run_at <= ?"
+                ' ORDER BY run_at, id LIMIT 1', (now,)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE job SET status = 'running', attempts = attempts + 1,"
+                    ' started = ? WHERE id = ?', (now, row['id'])
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+        args, kwargs = json.loads(row['args'])
+        return Job(
+            row['id'], row['task'], args, kwargs, row['attempts'] + 1, row['max_attempts']
+        )
+
+    def complete(self, id):
+        self._connect().execute(
+            "UPDATE job SET status = 'done', finished = ?, error = NULL WHERE id = ?",
+            (time.time(), id)
+        )
+
+    def fail(self, id, error, retry_delay=None):
+        """Records a failed attempt; the job runs again after retry_delay, if given."""
+        now = time.time()
+        if retry_delay is None:
+            self._connect().execute(
+                "UPDATE job SET status = 'failed', finished = ?, error = ? WHERE id = ?",
+                (now, error, id)
+            )
+        else:
+            self._connect().execute(
+                "UPDATE job SET status = 'queued', run_at = ?, error = ? WHERE id = ?",
+                (now + retry_delay, error, id)
+            )
+
+    def get(self, id):
+        """Returns a job's row as a dict, or None."""
+        row = self._connect().execute('SELECT * FROM job WHERE id = ?', (id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def counts(self):
+        """Returns the number of jobs in each status."""
+        return dict(self._connect().execute(
+            'SELECT status, COUNT(*) FROM job GROUP BY status'
+        ).fetchall())
+
+    def failed(self, limit=10):
+        """Returns the most recently failed jobs, newest first."""
+        return [dict(row) for row in self._connect().execute(
+            "SELECT * FROM job WHERE status = 'failed' ORDER BY finished DESC LIMIT ?",
+            (limit,)
+        )]
+
+    def purge(self):
+        """Deletes jobs finished more than `keep` seconds ago; returns how many."""
+        db = self._connect()
+        deleted = 0
+        while True:
+            cursor = db.execute(
+                'DELETE FROM job WHERE id IN (SELECT id FROM job'
+                " WHERE status IN ('done', 'failed') AND finished < ? LIMIT ?)",
+                (time.time() - self.keep, self.purge_batch)
+            )
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.purge_batch:
+                return deleted
+
+
+def retry_delay(attempt, backoff, max_delay=3600):
+    """Returns the seconds to wait before trying a job again after `attempt` failed."""
+    return min(backoff * 2 ** (attempt - 1), max_delay)
+
+
+class Worker(object):
+    """Threads that run queued jobs, each inside an app context."""
+
+    def __init__(self, app, queue, threads=1, poll_interval=1.0, purge_interval=600):
+        self.app = app
+        self.queue = queue
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self.stopping = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+        self._purged = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for n in range(self.threads):
+            # Daemon threads don't hold up shutdown. A job cut short by it
+            # is run again once its lease runs out.
+            thread = threading.Thread(
+                target=self._run, name=f'flaskr-job-{n}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        """Lets the running jobs finish, then stops the threads."""
+        self.stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def wake(self):
+        """Makes an idle thread look for jobs now, rather than at its next poll."""
+        self._wake.set()
+
+    def run_once(self):
+        """Runs the next job that is due; returns False if there was none."""
+        job = self.queue.claim()
+        if job is None:
+            return False
+
+        try:
+            fn = get_task(job.task)
+            with self.app.app_context():
+                fn(*job.args, **job.kwargs)
+        except Exception:
+            retry = job.attempts < job.max_attempts
+            self.app.logger.warning(
+                'Job %d (%s) failed on attempt %d of %d.',
+                job.id, job.task, job.attempts, job.max_attempts, exc_info=True
+            )
+            self.queue.fail(
+                job.id, traceback.format_exc(),
+                retry_delay(job.attempts, self.app.config['JOBS_RETRY_BACKOFF'])
+                if retry else None
+            )
+        else:
+            self.queue.complete(job.id)
+        return True
+
+    def run_until_empty(self):
+        """Runs jobs until none is due; returns how many ran."""
+        count = 0
+        while self.run_once():
+            count += 1
+        return count
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+                self._maybe_purge()
+            except Exception:
+                # The queue itself failed (a locked or missing file); try later.
+                self.app.logger.exception('Job worker error.')
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _maybe_purge(self):
+        with self._lock:
+            if time.monotonic() - self._purged < self.purge_interval:
+                return
+            self._purged = time.monotonic()
+        self.queue.purge()
+
+
+def get_job_queue(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    if not app.config['JOBS_BACKEND']:
+        return None
+
+    queue = app.extensions.get('flaskr.job_queue')
+    if queue is None:
+        queue = SQLiteJobQueue(
+            app.config['JOBS_DATABASE'],
+            lease=app.config['JOBS_LEASE'],
+            keep=app.config['JOBS_KEEP'],
+        )
+        queue = app.extensions.setdefault('flaskr.job_queue', queue)
+
+    return queue
+
+
+_worker_lock = threading.Lock()
+
+
+# The worker threads of a web process start with its first request, not in
+# create_app: a preforking server builds the app before forking, and threads
+# don't survive a fork. Each forked process starts its own.
+def get_worker(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    if not app.config['JOBS_WORKERS'] or get_job_queue(app) is None:
+        return None
+
+    with _worker_lock:
+        pid, worker = app.extensions.get('flaskr.job_worker', (None, None))
+        if pid != os.getpid():
+            worker = Worker(
+                app, get_job_queue(app), app.config['JOBS_WORKERS'],
+                app.config['JOBS_POLL_INTERVAL']
+            ).start()
+            app.extensions['flaskr.job_worker'] = (os.getpid(), worker)
+
+    return worker
+
+
+def enqueue(fn, *args, **kwargs):
+    """Queues fn(*args, **kwargs) to run in the background and returns the job id.
+
+    With no JOBS_BACKEND the job runs right away instead, and None is returned.
+    """
+    queue = get_job_queue()
+    if queue is None:
+        fn(*args, **kwargs)
+        return None
+
+    id = queue.put(fn.task_name, args, kwargs, fn.max_attempts)
+    worker = get_worker()
+    if worker is not None:
+        worker.wake()
+    return id
+
+
+def _start_worker():
+    get_worker()
+
+
+def init_app(app):
+    if app.config['JOBS_BACKEND'] and app.config['JOBS_WORKERS']:
+        app.before_request(_start_worker)
+
+
+@click.command('worker')
+@click.option('--threads', default=2, show_default=True, help='Jobs run at once.')
+@click.option('--burst', is_flag=True, help='Run the jobs that are due, then exit.')
+@with_appcontext
+def worker_command(threads, burst):
+    """Run queued background jobs until stopped."""
+    queue = get_job_queue()
+    if queue is None:
+        raise click.ClickException('JOBS_BACKEND is not set; jobs run in the request.')
+
+    app = current_app._get_current_object()
+    worker = Worker(app, queue, threads, app.config['JOBS_POLL_INTERVAL'])
+    if burst:
+        click.echo(f'Ran {worker.run_until_empty()} jobs.')
+        return
+
+    # SIGTERM, as sent by process managers, stops the worker like Ctrl+C does.
+    signal.signal(signal.SIGTERM, lambda *_: worker.stopping.set())
+    worker.start()
+    click.echo(f'Running jobs with {threads} threads.')
+    try:
+        while not worker.stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    click.echo('Waiting for running jobs to finish.')
+    worker.stop()
+
+
+@click.command('jobs')
+@click.argument('id', type=int, required=False)
+@with_appcontext
+def jobs_command(id):
+    """Show how many jobs are in each state, or the details of one job."""
+    queue = get_job_queue()
+    if queue is None:
+        raise click.ClickException('JOBS_BACKEND is not set; jobs run in the request.')
+
+    if id is not None:
+        job = queue.get(id)
+        if job is None:
+            raise click.ClickException(f'Job {id} does not exist.')
+        for key, value in job.items():
+            click.echo(f'{key}: {value}')
+        return
+
+    counts = queue.counts()
+    for status in ('queued', 'running', 'done', 'failed'):
+        click.echo(f'{status:>8}: {counts.get(status, 0)}')
+    for job in queue.failed():
+        error = (job['error'] or '').strip().splitlines()[-1:]
+        click.echo(f"Job {job['id']} ({job['task']}) failed: {''.join(error)}")
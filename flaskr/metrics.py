@@ -0,0 +1,332 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import abort, current_app, g, request
+
+from flaskr.cache import get_page_cache
+from flaskr.db import db_stats, get_pool
+
+# Upper bounds of the request latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help). Metrics are defined here rather than on first use so
+# that /metrics always lists them, even before anything has been counted.
+METRICS = {
+    'flaskr_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'flaskr_request_duration_seconds': ('histogram', 'Time spent handling requests.'),
+    'flaskr_requests_in_flight': ('gauge', 'Requests being handled right now.'),
+    'flaskr_db_lock_retries_total': ('counter', 'Writes retried after "database is locked".'),
+    'flaskr_db_pool_connections': ('gauge', 'Pooled database connections, by pool and state.'),
+    'flaskr_db_pool_events_total': ('counter', 'Connection pool checkouts, waits and timeouts.'),
+    'flaskr_cache_requests_total': ('counter', 'Cache lookups, by cache and result.'),
+}
+
+_process_ids = {}
+
+
+def process_id():
+    """Returns an id for this process that a later process reusing its pid won't have."""
+    # Looked up by pid, so workers forked from a preloaded app get ids of their own.
+    pid = os.getpid()
+    if pid not in _process_ids:
+        _process_ids[pid] = f'{pid}-{uuid.uuid4().hex[:8]}'
+    return _process_ids[pid]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+# Each worker process counts in memory, which costs a dict update under a lock.
+# Values are cumulative, so the totals of several workers are simply their sum.
+class Registry(object):
+    """The counters, gauges and histograms of one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self, buckets=LATENCY_BUCKETS):
+        """Returns (sample name, labels, value) triples in exposition terms."""
+        with self._lock:
+            values = list(self._values.items())
+            histograms = [(key, list(counts)) for key, counts in self._histograms.items()]
+
+        samples = [(name, labels, value) for (name, labels), value in values]
+        for (name, labels), counts in histograms:
+            # Prometheus buckets are cumulative: each counts everything below it.
+            total = 0
+            for bound, count in zip(buckets + (float('inf'),), counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f'{name}_bucket', labels + (('le', le),), total))
+            samples.append((f'{name}_sum', labels, counts[-1]))
+            samples.append((f'{name}_count', labels, total))
+        return samples
+
+
+# With several worker processes, each one scraped alone would only report its
+# own share. Workers write their samples to a shared SQLite file every few
+# seconds and at each scrape, and /metrics adds up the rows of every process.
+class SQLiteMetricsStore(object):
+    """Per-process metric samples in an SQLite file shared by all workers."""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS metric_sample ('
+        ' process TEXT NOT NULL, pid INTEGER NOT NULL, sample TEXT NOT NULL,'
+        ' labels TEXT NOT NULL, value REAL NOT NULL,'
+        ' PRIMARY KEY (process, sample, labels)) WITHOUT ROWID'
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute(self.SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = off')  # Rebuilt by the next flush.
+        return db
+
+    def flush(self, samples, process=None):
+        """Replaces the stored samples of this process."""
+        with self._connect() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO metric_sample (process, pid, sample, labels, value)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                [(process or process_id(), os.getpid(), name, json.dumps(labels), value)
+                 for name, labels, value in samples]
+            )
+
+    def collect(self):
+        """Returns the samples of every process, summed."""
+        rows = self._connect().execute(
+            'SELECT pid, sample, labels, value FROM metric_sample'
+        ).fetchall()
+        alive = {}
+        totals = {}
+        for pid, name, labels, value in rows:
+            # Counters of exited workers still count towards the totals, but
+            # their gauges (say, requests in flight) no longer mean anything.
+            if _metric_type(name) == 'gauge':
+                if pid not in alive:
+                    alive[pid] = _is_alive(pid)
+                if not alive[pid]:
+                    continue
+            key = (name, tuple(tuple(pair) for pair in json.loads(labels)))
+            totals[key] = totals.get(key, 0) + value
+        return [(name, labels, value) for (name, labels), value in totals.items()]
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _metric_name(sample):
+    """Returns the metric a sample belongs to, e.g. the histogram of a _bucket."""
+    for suffix in ('_bucket', '_sum', '_count'):
+        if sample.endswith(suffix) and sample[:-len(suffix)] in METRICS:
+            return sample[:-len(suffix)]
+    return sample
+
+
+def _metric_type(sample):
+    return METRICS.get(_metric_name(sample), ('untyped',))[0]
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(samples):
+    """Formats samples in the Prometheus text exposition format."""
+    by_metric = {name: [] for name in METRICS}
+    for sample in samples:
+        by_metric.setdefault(_metric_name(sample[0]), []).append(sample)
+
+    lines = []
+    for metric, metric_samples in by_metric.items():
+        kind, help = METRICS.get(metric, ('untyped', ''))
+        lines.append(f'# HELP {metric} {help}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, labels, value in sorted(metric_samples, key=_sort_key):
+            if labels:
+                pairs = ','.join(
+                    '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels
+                )
+                lines.append(f'{name}{{{pairs}}} {_format_value(value)}')
+            else:
+                lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+_SUFFIX_ORDER = {'_bucket': 0, '_sum': 1, '_count': 2}
+
+
+def _sort_key(sample):
+    # Groups the samples of each series together, with histogram buckets
+    # in order of their bounds followed by the sum and count.
+    name, labels, _ = sample
+    series = tuple(pair for pair in labels if pair[0] != 'le')
+    le = dict(labels).get('le')
+    return series, _SUFFIX_ORDER.get(name[len(_metric_name(name)):], 0), float(le or 0)
+
+
+def get_registry(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+    registry = app.extensions.get('flaskr.metrics')
+    if registry is None:
+        registry = app.extensions.setdefault('flaskr.metrics', Registry())
+    return registry
+
+
+def get_metrics_store(app=None):
+    """Returns the shared store, or None when each process reports on its own."""
+    if app is None:
+        app = current_app._get_current_object()
+    if not app.config['METRICS_DATABASE']:
+        return None
+    store = app.extensions.get('flaskr.metrics_store')
+    if store is None:
+        store = app.extensions.setdefault(
+            'flaskr.metrics_store', SQLiteMetricsStore(app.config['METRICS_DATABASE'])
+        )
+    return store
+
+
+def collect_process_samples(app=None):
+    """Returns this process's samples, including the pool and cache readings."""
+    if app is None:
+        app = current_app._get_current_object()
+    samples = get_registry(app).samples()
+
+    samples.append(('flaskr_db_lock_retries_total', (), db_stats(app)['lock_retries']))
+    for pool_name, readonly in (('write', False), ('read', True)):
+        pool = get_pool(app, readonly)
+        if pool is None:
+            continue
+        stats = pool.stats()
+        for state in ('open', 'idle', 'in_use'):
+            samples.append((
+                'flaskr_db_pool_connections',
+                (('pool', pool_name), ('state', state)), stats[state]
+            ))
+        for event in ('checkouts', 'waits', 'timeouts'):
+            samples.append((
+                'flaskr_db_pool_events_total',
+                (('event', event), ('pool', pool_name)), stats[event]
+            ))
+
+    caches = [('page', get_page_cache(app))]
+    if 'flaskr.user_cache' in app.extensions:
+        caches.append(('user', app.extensions['flaskr.user_cache']))
+    for cache_name, cache in caches:
+        if cache is None:
+            continue
+        stats = cache.stats()
+        for result, counter in (('hit', 'hits'), ('miss', 'misses')):
+            samples.append((
+                'flaskr_cache_requests_total',
+                (('cache', cache_name), ('result', result)), stats[counter]
+            ))
+    return samples
+
+
+def init_app(app):
+    if not app.config['METRICS']:
+        return
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    get_registry().inc('flaskr_requests_in_flight')
+
+
+def _record_request(response):
+    started = g.get('metrics_started')
+    if started is None:
+        return response
+
+    # The rule's endpoint rather than the path, so /1/update and /2/update
+    # are one series; unmatched URLs would otherwise add a series each.
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    registry = get_registry()
+    registry.observe(
+        'flaskr_request_duration_seconds', time.perf_counter() - started,
+        endpoint=endpoint
+    )
+    registry.inc(
+        'flaskr_requests_total',
+        endpoint=endpoint, method=request.method, status=str(response.status_code)
+    )
+
+    store = get_metrics_store()
+    if store is not None:
+        now = time.monotonic()
+        last = current_app.extensions.get('flaskr.metrics_flushed', 0)
+        if now - last >= current_app.config['METRICS_FLUSH_INTERVAL']:
+            current_app.extensions['flaskr.metrics_flushed'] = now
+            store.flush(collect_process_samples())
+    return response
+
+
+def _finish_request(e=None):
+    if g.pop('metrics_started', None) is not None:
+        get_registry().inc('flaskr_requests_in_flight', -1)
+
+
+def metrics_view():
+    """Reports the metrics of every worker in the Prometheus text format."""
+    # Endpoint names and traffic are for the scraper only. The address is the
+    # one the server sees; behind a proxy, wrap the app in werkzeug's ProxyFix
+    # first.
+    if request.remote_addr not in current_app.config['METRICS_ALLOWED_IPS']:
+        abort(403)  # Forbidden
+    samples = collect_process_samples()
+    store = get_metrics_store()
+    if store is not None:
+        store.flush(samples)
+        samples = store.collect()
+    return current_app.response_class(
+        render(samples), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
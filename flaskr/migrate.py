@@ -0,0 +1,146 @@
+import click
+import collections
+import importlib
+import os
+import re
+import time
+
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+_MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+
+Migration = collections.namedtuple('Migration', 'version name filename')
+
+
+def find_migrations():
+    """Returns every migration shipped with the app, oldest first."""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = _MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(Migration(int(match[1]), match[2], filename))
+    return sorted(migrations)
+
+
+def ensure_version_table(db):
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        ' version INTEGER PRIMARY KEY,'
+        ' name TEXT NOT NULL,'
+        ' applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+    )
+    db.commit()
+
+
+def applied_versions(db):
+    """Returns the versions already applied to the database."""
+    # A database created before migrations existed has no schema_version
+    # table, so nothing counts as applied and every migration checks for itself.
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ).fetchone()
+    if exists is None:
+        return set()
+    return {row['version'] for row in db.execute('SELECT version FROM schema_version')}
+
+
+def pending_migrations(db, target=None):
+    applied = applied_versions(db)
+    return [
+        migration for migration in find_migrations()
+        if migration.version not in applied
+        and (target is None or migration.version <= target)
+    ]
+
+
+def apply_migration(db, migration, batch_size=1000, progress=None):
+    """Runs one migration and records it in schema_version."""
+    stem, kind = os.path.splitext(migration.filename)
+    if kind == '.sql':
+        with open(os.path.join(MIGRATIONS_DIR, migration.filename), encoding='utf-8') as file:
+            db.executescript(file.read())
+    else:
+        module = importlib.import_module(f'flaskr.migrations.{stem}')
+        module.upgrade(db, batch_size, progress)
+
+    db.execute(
+        'INSERT INTO schema_version (version, name) VALUES (?, ?)',
+        (migration.version, migration.name)
+    )
+    db.commit()
+
+
+def upgrade(target=None, batch_size=1000, progress=None, started=None):
+    """Applies the pending migrations up to target, returning the ones applied.
+
+    Each migration commits its own work as it goes, so a large backfill only
+    holds the write lock one batch at a time. An interrupted upgrade picks up
+    again from the migration that didn't finish.
+    """
+    db = get_db()
+    ensure_version_table(db)
+
+    applied = []
+    for migration in pending_migrations(db, target):
+        if started is not None:
+            started(migration)
+        apply_migration(db, migration, batch_size, progress)
+        applied.append(migration)
+    return applied
+
+
+def check_schema(db):
+    """Raises RuntimeError, saying what to run, if any migration is pending."""
+    pending = pending_migrations(db)
+    if pending:
+        names = ', '.join(f'{m.version:04d} {m.name}' for m in pending)
+        raise RuntimeError(
+            f'The database schema is out of date (pending: {names}).'
+            ' Run `flask db-upgrade` (or `flask init-db` for a new database)'
+            ' before starting the app.'
+        )
+
+
+def stamp(db):
+    """Marks every migration as applied, for a database created from schema.sql."""
+    ensure_version_table(db)
+    db.executemany(
+        'INSERT OR IGNORE INTO schema_version (version, name) VALUES (?, ?)',
+        [(migration.version, migration.name) for migration in find_migrations()]
+    )
+    db.commit()
+
+
+@click.command('db-upgrade')
+@click.option('--target', type=int, help='Stop after this version (default: latest).')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Rows backfilled per transaction.')
+@with_appcontext
+def db_upgrade_command(target, batch_size):
+    """Apply pending schema migrations without dropping any data."""
+    start = time.perf_counter()
+    applied = upgrade(
+        target, batch_size,
+        progress=lambda n: click.echo(f'  {n} rows done.'),
+        started=lambda m: click.echo(f'Applying {m.version:04d} {m.name}...'),
+    )
+    if not applied:
+        click.echo('Database is up to date.')
+    else:
+        elapsed = time.perf_counter() - start
+        click.echo(f'Applied {len(applied)} migrations in {elapsed:.2f}s.')
+
+
+@click.command('db-status')
+@with_appcontext
+def db_status_command():
+    """Show which schema migrations have been applied."""
+    applied = applied_versions(get_db())
+    for migration in find_migrations():
+        state = 'applied' if migration.version in applied else 'pending'
+        click.echo(f'{migration.version:04d} {migration.name:<24} {state}')
+    click.echo(f'Current version: {max(applied, default=0):04d}')
@@ -0,0 +1,2 @@
+-- Serves the index ordering and its keyset pagination (newest first).
+CREATE INDEX IF NOT EXISTS post_created_id ON post (created DESC, id DESC);
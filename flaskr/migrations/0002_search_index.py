@@ -0,0 +1,29 @@
+from flaskr.db import reindex_posts
+
+# Adds the full-text search index, then indexes the existing posts in batches.
+SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    " title, body, tokenize = 'unicode61 remove_diacritics 2')",
+    'CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN'
+    ' INSERT INTO post_fts (rowid, title, body) VALUES (new.id, new.title, new.body);'
+    ' END',
+    'CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, body ON post BEGIN'
+    ' DELETE FROM post_fts WHERE rowid = old.id;'
+    ' INSERT INTO post_fts (rowid, title, body) VALUES (new.id, new.title, new.body);'
+    ' END',
+    'CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN'
+    ' DELETE FROM post_fts WHERE rowid = old.id; END',
+)
+
+
+def upgrade(db, batch_size=1000, progress=None):
+    for statement in SEARCH_INDEX:
+        db.execute(statement)
+    db.commit()
+
+    # The triggers cover new writes from here on; posts written in between are
+    # skipped by reindex_posts since they are already in the index.
+    return reindex_posts(
+        batch_size,
+        progress=progress and (lambda last_id, n: progress(n)),
+    )
@@ -0,0 +1,52 @@
+# Adds post.author_name to a database created before it existed, while the app
+# keeps serving it. Adding a column is instant in SQLite, the triggers take care
+# of new writes from then on, and the existing rows are backfilled in small
+# committed batches so writers are never blocked for long.
+# Until a row is backfilled, reads fall back to looking its author up.
+AUTHOR_NAME = (
+    'CREATE INDEX IF NOT EXISTS post_author_created'
+    ' ON post (author_id, created DESC, id DESC)',
+    'CREATE TRIGGER IF NOT EXISTS post_author_name_insert AFTER INSERT ON post BEGIN'
+    ' UPDATE post SET author_name = (SELECT username FROM user WHERE id = new.author_id)'
+    ' WHERE id = new.id; END',
+    'CREATE TRIGGER IF NOT EXISTS post_author_name_update'
+    ' AFTER UPDATE OF author_id ON post BEGIN'
+    ' UPDATE post SET author_name = (SELECT username FROM user WHERE id = new.author_id)'
+    ' WHERE id = new.id; END',
+    'CREATE TRIGGER IF NOT EXISTS user_username_update'
+    ' AFTER UPDATE OF username ON user BEGIN'
+    ' UPDATE post SET author_name = new.username WHERE author_id = new.id; END',
+)
+
+
+def upgrade(db, batch_size=1000, progress=None):
+    columns = [row['name'] for row in db.execute('PRAGMA table_info(post)')]
+    if 'author_name' not in columns:
+        db.execute('ALTER TABLE post ADD COLUMN author_name TEXT')
+    for statement in AUTHOR_NAME:
+        db.execute(statement)
+    db.commit()
+
+    filled = 0
+    last_id = 0
+    while True:
+        ids = db.execute(
+            'SELECT id FROM post WHERE id > ? AND author_name IS NULL ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not ids:
+            break
+
+        first_id, last_id = ids[0]['id'], ids[-1]['id']
+        cursor = db.execute(
+            'UPDATE post SET author_name ='
+            ' (SELECT username FROM user WHERE id = post.author_id)'
+            ' WHERE id BETWEEN ? AND ? AND author_name IS NULL',
+            (first_id, last_id)
+        )
+        db.commit()
+        filled += cursor.rowcount
+        if progress is not None:
+            progress(filled)
+
+    return filled
@@ -0,0 +1,29 @@
+-- A version counter per author (and 0 for all posts) that changes whenever one
+-- of their posts does. Feeds and the JSON API derive their ETag and
+-- Last-Modified from it, so a poller with nothing new gets a 304 from a single
+-- primary key lookup.
+CREATE TABLE IF NOT EXISTS post_change (
+  author_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL,
+  modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER IF NOT EXISTS post_change_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_change (author_id, version) VALUES (0, 1), (new.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_change_update AFTER UPDATE ON post BEGIN
+  INSERT INTO post_change (author_id, version)
+  VALUES (0, 1), (old.author_id, 1), (new.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_change_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_change (author_id, version) VALUES (0, 1), (old.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+-- Existing posts start every feed at version 1.
+INSERT OR IGNORE INTO post_change (author_id, version)
+SELECT 0, 1 UNION ALL SELECT DISTINCT author_id, 1 FROM post;
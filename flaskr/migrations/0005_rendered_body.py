@@ -0,0 +1,23 @@
+# Adds the columns holding each post's body rendered from Markdown. They start
+# out empty; `flask rerender-posts` fills them in batches once MARKDOWN is on.
+RENDERED_COLUMNS = (
+    ('body_html', 'TEXT'),
+    ('excerpt', 'TEXT'),
+    ('render_version', 'INTEGER'),
+)
+
+# Marks the stored HTML as stale when a body is edited without new HTML.
+RENDERED_STALE = (
+    'CREATE TRIGGER IF NOT EXISTS post_rendered_stale AFTER UPDATE OF body ON post'
+    ' WHEN new.body IS NOT old.body AND new.body_html IS old.body_html BEGIN'
+    ' UPDATE post SET render_version = NULL WHERE id = new.id; END'
+)
+
+
+def upgrade(db, batch_size=1000, progress=None):
+    columns = [row['name'] for row in db.execute('PRAGMA table_info(post)')]
+    for name, type in RENDERED_COLUMNS:
+        if name not in columns:
+            db.execute(f'ALTER TABLE post ADD COLUMN {name} {type}')
+    db.execute(RENDERED_STALE)
+    db.commit()
@@ -0,0 +1,50 @@
+from flaskr.db import recount_author_stats
+
+# Adds the per-author post counts, then counts the existing posts in batches.
+AUTHOR_STATS = (
+    'CREATE TABLE IF NOT EXISTS author_stats ('
+    ' author_id INTEGER PRIMARY KEY,'
+    ' post_count INTEGER NOT NULL,'
+    ' latest_post_id INTEGER)',
+    'CREATE TRIGGER IF NOT EXISTS author_stats_insert AFTER INSERT ON post BEGIN'
+    ' INSERT INTO author_stats (author_id, post_count, latest_post_id)'
+    ' VALUES (new.author_id, 1, new.id)'
+    ' ON CONFLICT (author_id) DO UPDATE SET'
+    ' post_count = post_count + 1,'
+    ' latest_post_id = (SELECT id FROM post WHERE author_id = new.author_id'
+    ' ORDER BY created DESC, id DESC LIMIT 1);'
+    ' END',
+    'CREATE TRIGGER IF NOT EXISTS author_stats_update'
+    ' AFTER UPDATE OF author_id, created ON post BEGIN'
+    ' UPDATE author_stats SET'
+    ' post_count = post_count - 1,'
+    ' latest_post_id = (SELECT id FROM post WHERE author_id = old.author_id'
+    ' ORDER BY created DESC, id DESC LIMIT 1)'
+    ' WHERE author_id = old.author_id;'
+    ' INSERT INTO author_stats (author_id, post_count, latest_post_id)'
+    ' VALUES (new.author_id, 1, new.id)'
+    ' ON CONFLICT (author_id) DO UPDATE SET'
+    ' post_count = post_count + 1,'
+    ' latest_post_id = (SELECT id FROM post WHERE author_id = new.author_id'
+    ' ORDER BY created DESC, id DESC LIMIT 1);'
+    ' END',
+    'CREATE TRIGGER IF NOT EXISTS author_stats_delete AFTER DELETE ON post BEGIN'
+    ' UPDATE author_stats SET'
+    ' post_count = post_count - 1,'
+    ' latest_post_id = CASE WHEN latest_post_id = old.id'
+    ' THEN (SELECT id FROM post WHERE author_id = old.author_id'
+    ' ORDER BY created DESC, id DESC LIMIT 1)'
+    ' ELSE latest_post_id END'
+    ' WHERE author_id = old.author_id;'
+    ' END',
+)
+
+
+def upgrade(db, batch_size=1000, progress=None):
+    for statement in AUTHOR_STATS:
+        db.execute(statement)
+    db.commit()
+
+    # Each batch of authors is recounted in one transaction, so posts written
+    # while this runs are counted once: by the triggers or by the recount.
+    return recount_author_stats(batch_size, progress)
@@ -0,0 +1,7 @@
+# Numbered schema migrations, applied in order by `flask db-upgrade`.
+#
+# A migration is either NNNN_name.sql, run as a script, or NNNN_name.py with an
+# upgrade(db, batch_size, progress) function for changes that need to backfill
+# or re-index existing rows in batches. Databases created before migrations
+# existed may already have some of the changes, so every migration must be safe
+# to run against a database that is partly or fully up to date.
@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no connection becomes free within the checkout timeout."""
+
+
+# The pool keeps open SQLite connections around between requests, so a request
+# doesn't pay for opening the file, parsing the schema and warming the page cache.
+class ConnectionPool(object):
+    """A thread-safe pool holding at most `size` connections made by `connect`."""
+
+    def __init__(self, connect, size=5, timeout=30.0, ping_after=60.0):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        # Idle connections are pinged before reuse once they have sat unused
+        # for this many seconds, so a broken connection is never handed out.
+        self.ping_after = ping_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, time it was returned) pairs, newest last.
+        self._open = 0   # Connections created and not yet closed.
+        self._pid = os.getpid()
+        self._closed = False
+        self._stats = dict.fromkeys(
+            ('checkouts', 'returns', 'created', 'discarded', 'waits', 'timeouts'), 0
+        )
+
+    def _check_fork(self):
+        # Connections must not be shared with a forked child (e.g. gunicorn
+        # workers forked from a preloaded master); the child starts empty.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._open = 0
+
+    def acquire(self):
+        """Checks out a connection, waiting up to `timeout` seconds for one."""
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            with self._cond:
+                self._check_fork()
+                if self._closed:
+                    raise sqlite3.ProgrammingError('Cannot operate on a closed pool.')
+
+                waited = False
+                while not self._idle and self._open >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'No database connection available after {self.timeout}s.'
+                        )
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, returned = self._idle.pop()
+                else:
+                    conn, returned = None, None
+                    self._open += 1
+                self._stats['checkouts'] += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+                return conn
+
+            if time.monotonic() - returned < self.ping_after or self._ping(conn):
+                return conn
+
+            # The connection failed its health check; drop it and try again.
+            self._discard(conn)
+
+    def release(self, conn):
+        """Returns a connection, rolling back anything left uncommitted."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            if self._closed or self._pid != os.getpid():
+                self._open = max(self._open - 1, 0)
+                conn.close()
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._stats['returns'] += 1
+            self._cond.notify()
+
+    def close(self):
+        """Closes every idle connection and refuses further checkouts."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """Returns a snapshot of the pool counters, useful for sizing the pool."""
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self.size,
+                open=self._open,
+                idle=len(self._idle),
+                in_use=self._open - len(self._idle),
+            )
+
+    def _ping(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._forget(discarded=True)
+
+    def _forget(self, discarded=False):
+        with self._cond:
+            self._open = max(self._open - 1, 0)
+            if discarded:
+                self._stats['discarded'] += 1
+            self._cond.notify()
+
+
+# What get_db hands to the views. It behaves like the sqlite3 connection it wraps,
+# but closing it gives the connection back to the pool, after which it can no
+# longer be used - just like a connection that has really been closed.
+class PooledConnection(object):
+    """A checked-out connection that is returned to its pool on close()."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return self._conn
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+
+# What get_db hands to the views when a read-only pool is configured. Reads go
+# to read-only connections, so they never wait behind the write lock; anything
+# else goes to a write connection. Once a request has written, its reads follow
+# the write connection too, so it always sees its own changes.
+class RoutingConnection(object):
+    """Picks a read-only or a write connection for each statement."""
+
+    READ_STATEMENTS = ('SELECT', 'EXPLAIN')
+
+    def __init__(self, read_pool, write_pool):
+        self._read_pool = read_pool
+        self._write_pool = write_pool
+        self._reader = None
+        self._writer = None
+        self._wrote = False
+        self._closed = False
+
+    def _check_open(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+
+    @property
+    def writer(self):
+        self._check_open()
+        if self._writer is None:
+            self._writer = PooledConnection(self._write_pool, self._write_pool.acquire())
+        return self._writer
+
+    @property
+    def reader(self):
+        self._check_open()
+        if self._wrote or (self._writer is not None and self._writer.in_transaction):
+            return self._writer
+        if self._reader is None:
+            self._reader = PooledConnection(self._read_pool, self._read_pool.acquire())
+        return self._reader
+
+    def route(self, sql):
+        """Returns the connection a statement should run on."""
+        if sql.lstrip()[:7].upper().startswith(self.READ_STATEMENTS):
+            return self.reader
+        self._wrote = True
+        return self.writer
+
+    def execute(self, sql, params=()):
+        return self.route(sql).execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._wrote = True
+        return self.writer.executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        self._wrote = True
+        return self.writer.executescript(script)
+
+    def commit(self):
+        self._check_open()
+        if self._writer is not None:
+            self._writer.commit()
+
+    def rollback(self):
+        self._check_open()
+        if self._writer is not None:
+            self._writer.rollback()
+
+    @property
+    def in_transaction(self):
+        self._check_open()
+        return self._writer is not None and self._writer.in_transaction
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def __enter__(self):
+        self._wrote = True
+        return self.writer.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.writer.__exit__(*exc_info)
+
+    def close(self):
+        self._closed = True
+        for conn in (self._reader, self._writer):
+            if conn is not None:
+                conn.close()
+        self._reader = self._writer = None
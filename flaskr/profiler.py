@@ -0,0 +1,288 @@
+import atexit
+import functools
+import os
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from flask import abort, current_app, g, request
+
+from flaskr.metrics import process_id
+
+# Frames deeper than this are cut off, keeping the outermost ones.
+MAX_DEPTH = 128
+
+
+# A sampling profiler: while a profiled request runs, a background thread looks
+# at the stack of the thread serving it every PROFILE_INTERVAL seconds and
+# counts the stack it finds. Nothing is hooked into the function calls
+# themselves, so a profiled request runs at full speed, and requests that
+# aren't profiled pay only for the decision. Requests shorter than the interval
+# are mostly missed individually, but show up in proportion over many of them.
+class Profiler(object):
+    """Samples the stacks of the threads registered with it, counted per endpoint."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # endpoint -> Counter of collapsed stacks.
+        self._threads = {}  # thread id -> endpoint, for the requests profiled now.
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._sampler = None
+
+    def start(self, endpoint):
+        """Starts sampling the calling thread, counting its stacks under endpoint."""
+        with self._lock:
+            self._threads[threading.get_ident()] = endpoint
+            self._active.set()
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._run, name='flaskr-profiler', daemon=True
+                )
+                self._sampler.start()
+
+    def stop(self):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+            if not self._threads:
+                self._active.clear()
+
+    def sample(self):
+        """Counts the current stack of every registered thread once."""
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, endpoint in self._threads.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack = self.stacks.setdefault(endpoint, Counter())
+                    stack[collapse(frame)] += 1
+
+    def take(self):
+        """Returns the stacks counted so far and starts counting afresh."""
+        with self._lock:
+            stacks, self.stacks = self.stacks, {}
+        return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+def collapse(frame):
+    """Returns a stack as 'outer;...;inner', one name per frame."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+@functools.lru_cache(maxsize=4096)
+def short_path(filename):
+    """Returns a source file's path relative to the sys.path entry it was imported from."""
+    roots = [path for path in sys.path if path and filename.startswith(path + os.sep)]
+    if not roots:
+        return filename
+    return os.path.relpath(filename, max(roots, key=len))
+
+
+_write_lock = threading.Lock()
+
+
+# Each process adds its samples to files of its own, one per endpoint, named
+# '<endpoint>@<process id>.collapsed'. The download view adds them all up, so
+# the profile covers every worker on the machine.
+def write_profiles(directory, stacks):
+    """Adds this process's newly counted stacks to its files in directory."""
+    if not stacks:
+        return
+    os.makedirs(directory, exist_ok=True)
+    with _write_lock:
+        _write_profiles(directory, stacks)
+
+
+def _write_profiles(directory, stacks):
+    for endpoint, new_counts in stacks.items():
+        path = os.path.join(directory, f'{endpoint}@{process_id()}.collapsed')
+        counts = read_collapsed(path)
+        counts.update(new_counts)
+        # Written whole and renamed into place, so a reader never sees half a file.
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(format_collapsed(counts))
+        os.replace(path + '.tmp', path)
+
+
+def read_collapsed(path):
+    counts = Counter()
+    try:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack:
+                    counts[stack] += int(count)
+    except FileNotFoundError:
+        pass
+    return counts
+
+
+def format_collapsed(counts):
+    """Renders stack counts in the collapsed format read by flamegraph.pl."""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items()))
+
+
+def load_profiles(directory):
+    """Returns the stack counts of every process in directory, added up per endpoint."""
+    profiles = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return profiles
+    for name in names:
+        if name.endswith('.collapsed') and '@' in name:
+            endpoint = name.rpartition('@')[0]
+            counts = profiles.setdefault(endpoint, Counter())
+            counts.update(read_collapsed(os.path.join(directory, name)))
+    return profiles
+
+
+def to_speedscope(endpoint, counts, interval):
+    """Converts stack counts to a speedscope 'sampled' profile, weighted in seconds."""
+    frames = {}
+    samples = []
+    weights = []
+    for stack, count in sorted(counts.items()):
+        samples.append([frames.setdefault(name, len(frames)) for name in stack.split(';')])
+        weights.append(count * interval)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': endpoint,
+        'exporter': 'flaskr',
+        'shared': {'frames': [{'name': name} for name in frames]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': endpoint,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+    }
+
+
+_profilers = {}
+_profilers_lock = threading.Lock()
+
+
+@atexit.register
+def _flush_profilers():
+    # Samples taken since the last flush would be lost with the process.
+    for (pid, directory), profiler in list(_profilers.items()):
+        if pid == os.getpid():
+            write_profiles(directory, profiler.take())
+
+
+def get_profiler(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    key = (os.getpid(), app.config['PROFILE_DIR'])
+    with _profilers_lock:
+        # The sampler thread doesn't survive a fork, so each process has its own.
+        profiler = _profilers.get(key)
+        if profiler is None:
+            profiler = _profilers[key] = Profiler(app.config['PROFILE_INTERVAL'])
+    return profiler
+
+
+def should_profile():
+    """Decides whether the current request is profiled."""
+    config = current_app.config
+    header = config['PROFILE_HEADER']
+    if header and header in request.headers:
+        # Asking for a profile is only honoured from the allowed addresses.
+        # The address is the one the server sees; behind a proxy, every
+        # request comes from the proxy's, so wrap the app in werkzeug's
+        # ProxyFix first.
+        return request.remote_addr in config['PROFILE_ALLOWED_IPS']
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def _start_profile():
+    if should_profile():
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        get_profiler().start(endpoint)
+        g.profiling = True
+
+
+def _finish_profile(e=None):
+    if not g.pop('profiling', False):
+        return
+    profiler = get_profiler()
+    profiler.stop()
+
+    now = time.monotonic()
+    last = current_app.extensions.get('flaskr.profiles_flushed', 0)
+    if now - last >= current_app.config['PROFILE_FLUSH_INTERVAL']:
+        current_app.extensions['flaskr.profiles_flushed'] = now
+        write_profiles(current_app.config['PROFILE_DIR'], profiler.take())
+
+
+def admin_required():
+    if not g.user or g.user['username'] not in current_app.config['PROFILE_ADMINS']:
+        abort(403)  # Forbidden
+
+
+def profiles_view():
+    """Lists the profiled endpoints and how many samples each has."""
+    admin_required()
+    directory = current_app.config['PROFILE_DIR']
+    write_profiles(directory, get_profiler().take())
+    return {
+        endpoint: sum(counts.values())
+        for endpoint, counts in sorted(load_profiles(directory).items())
+    }
+
+
+def profile_view(endpoint, format):
+    """Downloads the profile of an endpoint as collapsed stacks or for speedscope."""
+    admin_required()
+    directory = current_app.config['PROFILE_DIR']
+    write_profiles(directory, get_profiler().take())
+    counts = load_profiles(directory).get(endpoint)
+    if counts is None:
+        abort(404, f'No profile of {endpoint}.')  # Not Found
+
+    if format == 'collapsed':
+        response = current_app.response_class(
+            format_collapsed(counts), mimetype='text/plain'
+        )
+        filename = f'{endpoint}.collapsed.txt'
+    else:
+        response = current_app.json.response(
+            to_speedscope(endpoint, counts, current_app.config['PROFILE_INTERVAL'])
+        )
+        filename = f'{endpoint}.speedscope.json'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def init_app(app):
+    if not app.config['PROFILING']:
+        return
+    app.before_request(_start_profile)
+    app.teardown_request(_finish_profile)
+    app.add_url_rule('/admin/profiles', 'profiles', profiles_view)
+    app.add_url_rule(
+        '/admin/profiles/<endpoint>.collapsed.txt', 'profile', profile_view,
+        defaults={'format': 'collapsed'}
+    )
+    app.add_url_rule(
+        '/admin/profiles/<endpoint>.speedscope.json', 'profile_speedscope',
+        profile_view, defaults={'format': 'speedscope'}
+    )
@@ -0,0 +1,223 @@
+import functools
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+_RATE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$')
+
+
+def parse_rate(rate):
+    """Parses a rate like '10/minute' or '100/15minutes' into (count, seconds)."""
+    match = _RATE.match(rate)
+    if match is None:
+        raise ValueError(f'Invalid rate limit: {rate!r}')
+    count, multiple, period = match.groups()
+    return int(count), int(multiple or 1) * _PERIODS[period]
+
+
+# Every client key (an IP address, a username) gets a bucket holding up to
+# `capacity` tokens that refills at a steady rate. Each request takes a token,
+# so a client can burst up to the capacity and is then held to the refill rate,
+# which spreads the limit over a sliding window instead of resetting it at
+# fixed times.
+def _take(tokens, updated, now, capacity, rate):
+    """Refills a bucket and takes one token; returns (tokens left, seconds to wait)."""
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets(object):
+    """Token buckets kept in this process, for single-worker deployments."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated), oldest first.
+        self._lock = threading.Lock()
+
+    def hit(self, key, capacity, rate):
+        """Takes a token from a bucket; returns 0 or the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens, wait = _take(tokens, updated, now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+            # A forgotten bucket is a full one, so dropping the idle ones is safe.
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Keys include whatever usernames clients try to log in as, so idle buckets are
+# purged every `purge_interval` seconds, in small batches. A bucket untouched
+# for `max_age` seconds - the longest configured period - has refilled, and
+# dropping it changes nothing.
+class SQLiteBuckets(object):
+    """Token buckets in an SQLite file, shared by every worker on the machine."""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS rate_bucket ('
+        ' key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+        ' WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS rate_bucket_updated ON rate_bucket (updated)',
+    )
+
+    def __init__(self, path, max_age=86400, purge_interval=300.0, purge_batch=500):
+        self.path = path
+        self.max_age = max_age
+        self.purge_interval = purge_interval
+        self.purge_batch = purge_batch
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._purged = time.monotonic()
+
+        db = self._connect()
+        for statement in self.SCHEMA:
+            db.execute(statement)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = off')  # Losing a bucket is harmless.
+        return db
+
+    def hit(self, key, capacity, rate):
+        """Takes a token from a bucket; returns 0 or the seconds until one is available."""
+        now = time.time()
+        db = self._connect()
+        # Read and update the bucket under the write lock, so two workers
+        # can't both take the last token.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT tokens, updated FROM rate_bucket WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, wait = _take(*(row or (capacity, now)), now, capacity, rate)
+            db.execute(
+                'INSERT OR REPLACE INTO rate_bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        with self._lock:
+            purge = time.monotonic() - self._purged >= self.purge_interval
+            if purge:
+                self._purged = time.monotonic()
+        if purge:
+            self.purge()
+        return wait
+
+    def purge(self):
+        """Removes the buckets untouched for max_age seconds; returns how many."""
+        db = self._connect()
+        deleted = 0
+        while True:
+            # One batch per statement, so the write lock is only held briefly.
+            cursor = db.execute(
+                'DELETE FROM rate_bucket WHERE key IN (SELECT key FROM rate_bucket'
+                ' WHERE updated < ? LIMIT ?)',
+                (time.time() - self.max_age, self.purge_batch)
+            )
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.purge_batch:
+                return deleted
+
+    def clear(self):
+        self._connect().execute('DELETE FROM rate_bucket')
+
+
+def get_limiter(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    backend = app.config['RATELIMIT_BACKEND']
+    if not backend:
+        return None
+
+    limiter = app.extensions.get('flaskr.rate_limiter')
+    if limiter is None:
+        if backend == 'sqlite':
+            limiter = SQLiteBuckets(
+                app.config['RATELIMIT_DATABASE'],
+                max_age=max(
+                    (parse_rate(rate)[1] for rate in app.config['RATELIMITS'].values()),
+                    default=86400
+                ),
+                purge_interval=app.config['RATELIMIT_PURGE_INTERVAL'],
+            )
+        else:
+            limiter = MemoryBuckets(app.config['RATELIMIT_MEMORY_SIZE'])
+        limiter = app.extensions.setdefault('flaskr.rate_limiter', limiter)
+
+    return limiter
+
+
+# What each kind of key identifies the client by. The address is the one the
+# server sees; behind a proxy, wrap the app in werkzeug's ProxyFix first.
+_KEYS = {
+    'ip': lambda: request.remote_addr,
+    'username': lambda: request.form.get('username', '').strip().lower() or None,
+    'user': lambda: session.get('user_id'),
+}
+
+
+def check_rate_limit(name, keys):
+    """Takes a token for each of the keys, or aborts with 429."""
+    limiter = get_limiter()
+    rate = current_app.config['RATELIMITS'].get(name)
+    if limiter is None or rate is None:
+        return
+
+    count, period = parse_rate(rate)
+    wait = 0.0
+    for kind in keys:
+        value = _KEYS[kind]()
+        if value is not None:
+            wait = max(wait, limiter.hit(f'{name}:{kind}:{value}', count, count / period))
+
+    if wait:
+        raise TooManyRequests(
+            'Too many attempts. Please wait a moment and try again.',
+            retry_after=math.ceil(wait)
+        )
+
+
+def rate_limit(name, keys=('ip',)):
+    """Limits POSTs to a view to the rate configured in RATELIMITS[name].
+
+    The check comes before the view runs, so rejected requests cost no
+    database queries or password hashing.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            if request.method == 'POST':
+                check_rate_limit(name, keys)
+            return view(**kwargs)
+
+        return wrapped_view
+
+    return decorator
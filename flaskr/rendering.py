@@ -0,0 +1,196 @@
+import collections
+import functools
+import html
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from markupsafe import Markup, escape
+
+from flaskr.db import get_db
+
+# Bump this whenever the output of render_markdown changes, then run
+# `flask rerender-posts` to bring the stored HTML up to date.
+RENDERER_VERSION = 1
+
+EXCERPT_LENGTH = 200
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*$')
+_BULLET = re.compile(r'^\s*[-*+]\s+(.*)$')
+_NUMBERED = re.compile(r'^\s*\d+[.)]\s+(.*)$')
+_FENCE = re.compile(r'^\s*```')
+_CODE_SPAN = re.compile(r'(`[^`\n]+`)')
+_LINK = re.compile(r'\[([^\]\n]+)\]\(([^)\s]+)\)')
+_STRONG = re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*')
+_EMPHASIS = re.compile(r'(?<![\w*])[*_](?=\S)(.+?)(?<=\S)[*_](?![\w*])')
+# Links may only point to web pages, local paths and mail addresses;
+# javascript: and data: URLs are shown as text.
+_SAFE_URL = re.compile(r'^(https?://|mailto:|/|#)', re.IGNORECASE)
+_TAG = re.compile(r'<[^>]+>')
+
+
+# Post bodies are written in a small subset of Markdown: paragraphs, headings,
+# lists, block quotes, code and links. The text is HTML-escaped before any
+# markup is added, so whatever a post contains, the only tags in the output
+# are the ones produced here. Rendering happens once, when a post is saved,
+# and pages show the stored result.
+def render_markdown(text):
+    """Renders Markdown text to HTML that is safe to show as is."""
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return Markup('\n'.join(_blocks(lines)))
+
+
+def _blocks(lines):
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+
+        if not line.strip():
+            i += 1
+        elif _FENCE.match(line):
+            end = i + 1
+            while end < len(lines) and not _FENCE.match(lines[end]):
+                end += 1
+            code = '\n'.join(lines[i + 1:end])
+            yield f'<pre><code>{escape(code)}</code></pre>'
+            i = end + 1
+        elif _HEADING.match(line):
+            hashes, title = _HEADING.match(line).groups()
+            # Headings start at h2; the post title is the h1.
+            level = min(len(hashes) + 1, 6)
+            yield f'<h{level}>{_inline(title)}</h{level}>'
+            i += 1
+        elif line.lstrip().startswith('>'):
+            quoted = []
+            while i < len(lines) and lines[i].lstrip().startswith('>'):
+                quoted.append(lines[i].lstrip()[1:].removeprefix(' '))
+                i += 1
+            yield '<blockquote>{}</blockquote>'.format('\n'.join(_blocks(quoted)))
+        elif _BULLET.match(line) or _NUMBERED.match(line):
+            pattern, tag = (_BULLET, 'ul') if _BULLET.match(line) else (_NUMBERED, 'ol')
+            items = []
+            while i < len(lines) and pattern.match(lines[i]):
+                items.append(f'<li>{_inline(pattern.match(lines[i]).group(1))}</li>')
+                i += 1
+            yield f'<{tag}>{"".join(items)}</{tag}>'
+        else:
+            paragraph = []
+            while i < len(lines) and lines[i].strip() and not _starts_block(lines[i]):
+                paragraph.append(lines[i])
+                i += 1
+            yield f'<p>{_inline(chr(10).join(paragraph))}</p>'
+
+
+def _starts_block(line):
+    return bool(
+        _FENCE.match(line) or _HEADING.match(line) or line.lstrip().startswith('>')
+        or _BULLET.match(line) or _NUMBERED.match(line)
+    )
+
+
+def _inline(text):
+    parts = []
+    # Code spans are shown literally, so the other rules skip them.
+    for n, part in enumerate(_CODE_SPAN.split(text)):
+        if n % 2:
+            parts.append(f'<code>{escape(part[1:-1])}</code>')
+        else:
+            part = str(escape(part))
+            part = _LINK.sub(_link, part)
+            part = _STRONG.sub(r'<strong>\1</strong>', part)
+            part = _EMPHASIS.sub(r'<em>\1</em>', part)
+            parts.append(part)
+    return ''.join(parts)
+
+
+def _link(match):
+    # Both groups are already escaped, quotes included.
+    label, url = match.groups()
+    if not _SAFE_URL.match(html.unescape(url)):
+        return label
+    return f'<a href="{url}" rel="nofollow">{label}</a>'
+
+
+def make_excerpt(body_html, length=EXCERPT_LENGTH):
+    """Returns the start of a rendered body as plain text, cut at a word."""
+    text = ' '.join(html.unescape(_TAG.sub(' ', body_html)).split())
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0] + '…'
+
+
+def render_post(body, excerpt_length=EXCERPT_LENGTH):
+    """Returns the (body_html, excerpt, render_version) stored with a post."""
+    body_html = str(render_markdown(body))
+    return body_html, make_excerpt(body_html, excerpt_length), RENDERER_VERSION
+
+
+def _render_batch(rows, excerpt_length):
+    # Runs in a worker process; rows are (id, body) pairs. The body rendered is
+    # returned too, so the write can check it is still the post's body.
+    return [(*render_post(body, excerpt_length), id, body) for id, body in rows]
+
+
+def rerender_posts(batch_size=500, workers=None, full=False, progress=None):
+    """Renders every post whose stored HTML is missing or from an older renderer.
+
+    Batches are rendered in parallel by `workers` processes (0 renders them
+    here), and each batch of results is committed on its own.
+    """
+    db = get_db()
+    where = '' if full else ' AND (render_version IS NULL OR render_version != ?)'
+    params = () if full else (RENDERER_VERSION,)
+
+    def batches():
+        last_id = 0
+        while True:
+            rows = db.execute(
+                f'SELECT id, body FROM post WHERE id > ?{where} ORDER BY id LIMIT ?',
+                (last_id, *params, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield [tuple(row) for row in rows]
+
+    render = functools.partial(
+        _render_batch, excerpt_length=current_app.config['EXCERPT_LENGTH']
+    )
+    if workers == 0:
+        results = map(render, batches())
+    else:
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(workers)
+        results = _ordered_results(executor, render, batches(), 2 * workers)
+
+    rendered = 0
+    try:
+        for batch in results:
+            # Posts edited since they were read are skipped: the edit either
+            # rendered them again or left them stale for the next run.
+            cursor = db.executemany(
+                'UPDATE post SET body_html = ?, excerpt = ?, render_version = ?'
+                ' WHERE id = ? AND body = ?', batch
+            )
+            db.commit()
+            rendered += cursor.rowcount
+            if progress is not None:
+                progress(rendered)
+    finally:
+        if workers != 0:
+            executor.shutdown(cancel_futures=True)
+
+    return rendered
+
+
+def _ordered_results(executor, fn, items, window):
+    # Like executor.map, but only `window` items are read ahead, so the posts
+    # are not all loaded into memory before the first batch is written.
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -1,5 +1,17 @@
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
+DROP TABLE IF EXISTS post_fts;
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS post_change;
+DROP TABLE IF EXISTS author_stats;
+
+-- The migrations applied to this database; see flaskr/migrations. A database
+-- created from this file already has all of them, and init-db records that.
+CREATE TABLE schema_version (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -13,5 +25,128 @@ CREATE TABLE post (
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
+  author_name TEXT,  -- Copy of user.username, maintained by the triggers below.
+  -- The body rendered from Markdown, and a plain-text excerpt of it, written
+  -- when the post is saved with MARKDOWN on (see flaskr.rendering).
+  body_html TEXT,
+  excerpt TEXT,
+  render_version INTEGER,
   FOREIGN KEY (author_id) REFERENCES user (id)
-);
\ No newline at end of file
+);
+
+-- Serves the index ordering and its keyset pagination (newest first).
+CREATE INDEX post_created_id ON post (created DESC, id DESC);
+
+-- Serves per-author listings and counts, and finds an author's posts on rename.
+CREATE INDEX post_author_created ON post (author_id, created DESC, id DESC);
+
+CREATE TRIGGER post_author_name_insert AFTER INSERT ON post BEGIN
+  UPDATE post SET author_name = (SELECT username FROM user WHERE id = new.author_id)
+  WHERE id = new.id;
+END;
+
+CREATE TRIGGER post_author_name_update AFTER UPDATE OF author_id ON post BEGIN
+  UPDATE post SET author_name = (SELECT username FROM user WHERE id = new.author_id)
+  WHERE id = new.id;
+END;
+
+CREATE TRIGGER user_username_update AFTER UPDATE OF username ON user BEGIN
+  UPDATE post SET author_name = new.username WHERE author_id = new.id;
+END;
+
+-- A body edited without storing new HTML (say, with MARKDOWN off) keeps its
+-- old HTML, which is then marked as stale for `flask rerender-posts`.
+CREATE TRIGGER post_rendered_stale AFTER UPDATE OF body ON post
+WHEN new.body IS NOT old.body AND new.body_html IS old.body_html BEGIN
+  UPDATE post SET render_version = NULL WHERE id = new.id;
+END;
+
+-- Full-text index over post titles and bodies, used by blog.search.
+-- Its rowid is the id of the post, and the triggers keep it in sync.
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title,
+  body,
+  tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts (rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body ON post BEGIN
+  DELETE FROM post_fts WHERE rowid = old.id;
+  INSERT INTO post_fts (rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN
+  DELETE FROM post_fts WHERE rowid = old.id;
+END;
+
+-- A version counter per author (and 0 for all posts) that changes whenever one
+-- of their posts does. Feeds and the JSON API derive their ETag and
+-- Last-Modified from it, so a poller with nothing new gets a 304 from a single
+-- primary key lookup.
+CREATE TABLE post_change (
+  author_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL,
+  modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER post_change_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_change (author_id, version) VALUES (0, 1), (new.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+CREATE TRIGGER post_change_update AFTER UPDATE ON post BEGIN
+  INSERT INTO post_change (author_id, version)
+  VALUES (0, 1), (old.author_id, 1), (new.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+CREATE TRIGGER post_change_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_change (author_id, version) VALUES (0, 1), (old.author_id, 1)
+  ON CONFLICT (author_id) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+END;
+
+-- Each author's post count and latest post, so profile pages don't count their
+-- posts on every view. The triggers keep it current one post at a time; the
+-- latest post is found again through post_author_created when it changes.
+-- `flask recount` rebuilds it from the posts.
+CREATE TABLE author_stats (
+  author_id INTEGER PRIMARY KEY,
+  post_count INTEGER NOT NULL,
+  latest_post_id INTEGER
+);
+
+CREATE TRIGGER author_stats_insert AFTER INSERT ON post BEGIN
+  INSERT INTO author_stats (author_id, post_count, latest_post_id)
+  VALUES (new.author_id, 1, new.id)
+  ON CONFLICT (author_id) DO UPDATE SET
+    post_count = post_count + 1,
+    latest_post_id = (SELECT id FROM post WHERE author_id = new.author_id
+                      ORDER BY created DESC, id DESC LIMIT 1);
+END;
+
+CREATE TRIGGER author_stats_update AFTER UPDATE OF author_id, created ON post BEGIN
+  UPDATE author_stats SET
+    post_count = post_count - 1,
+    latest_post_id = (SELECT id FROM post WHERE author_id = old.author_id
+                      ORDER BY created DESC, id DESC LIMIT 1)
+  WHERE author_id = old.author_id;
+  INSERT INTO author_stats (author_id, post_count, latest_post_id)
+  VALUES (new.author_id, 1, new.id)
+  ON CONFLICT (author_id) DO UPDATE SET
+    post_count = post_count + 1,
+    latest_post_id = (SELECT id FROM post WHERE author_id = new.author_id
+                      ORDER BY created DESC, id DESC LIMIT 1);
+END;
+
+CREATE TRIGGER author_stats_delete AFTER DELETE ON post BEGIN
+  UPDATE author_stats SET
+    post_count = post_count - 1,
+    latest_post_id = CASE WHEN latest_post_id = old.id
+      THEN (SELECT id FROM post WHERE author_id = old.author_id
+            ORDER BY created DESC, id DESC LIMIT 1)
+      ELSE latest_post_id END
+  WHERE author_id = old.author_id;
+END;
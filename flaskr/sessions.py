@@ -0,0 +1,246 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer
+
+from flaskr.cache import TTLCache
+
+
+# With a server-side store the cookie only carries a random session id, signed
+# so that guessed or tampered ids are turned away before any lookup. The data
+# stays on the server, which means a session can be revoked: deleting its
+# record logs it out, without rotating SECRET_KEY.
+class ServerSideSession(SecureCookieSession):
+    """A session whose data lives in a session store under `sid`."""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.new = sid is None
+        self.sid = sid or new_session_id()
+        self.revoked = []  # Earlier ids of this session, deleted on save.
+
+    def clear(self):
+        # Clearing a session is what login and logout do. Both get a new id,
+        # so an id known from before (say, planted by an attacker) is worthless.
+        super().clear()
+        self.regenerate()
+
+    def regenerate(self):
+        """Moves the session to a new id and revokes the old one."""
+        self.revoked.append(self.sid)
+        self.sid = new_session_id()
+        self.new = True
+        self.modified = True
+
+
+def new_session_id():
+    return secrets.token_urlsafe(16)
+
+
+class MemorySessionStore(object):
+    """Sessions kept in this process, for single-worker deployments."""
+
+    def __init__(self, ttl, maxsize=10000):
+        # The least recently used sessions are dropped once it is full.
+        self._sessions = TTLCache(maxsize, ttl)
+
+    def get(self, sid):
+        return self._sessions.get(sid)
+
+    def set(self, sid, data):
+        self._sessions.set(sid, data)
+
+    def delete(self, sid):
+        self._sessions.delete(sid)
+
+
+# Sessions shared by every worker through an SQLite file. Reads go through a
+# short-lived per-worker cache, since most requests only read their session;
+# a session revoked by another worker stays usable here for at most
+# SESSION_CACHE_TTL seconds. Expired rows are swept in small batches every
+# `sweep_interval` seconds, so no single sweep holds the write lock for long.
+class SQLiteSessionStore(object):
+    """Sessions in an SQLite file, shared by every worker on the machine."""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS session ('
+        ' id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+        ' WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS session_expires ON session (expires)',
+    )
+
+    def __init__(self, path, ttl, cache_size=10000, cache_ttl=5.0,
+                 sweep_interval=300.0, sweep_batch=500):
+        self.path = path
+        self.ttl = ttl
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_ttl else None
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+        with self._connect() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        # A connection must not be used again in a forked child.
+        if db is None or self._local.pid != os.getpid():
+            self._local.pid = os.getpid()
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode = wal')
+            db.execute('PRAGMA synchronous = normal')
+        return db
+
+    def get(self, sid):
+        if self.cache is not None:
+            data = self.cache.get(sid)
+            if data is not None:
+                return data
+
+        row = self._connect().execute(
+            'SELECT data FROM session WHERE id = ? AND expires > ?', (sid, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        if self.cache is not None:
+            self.cache.set(sid, row[0])
+        return row[0]
+
+    def set(self, sid, data):
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO session (id, data, expires) VALUES (?, ?, ?)',
+                (sid, data, time.time() + self.ttl)
+            )
+        if self.cache is not None:
+            self.cache.set(sid, data)
+
+        with self._lock:
+            sweep = time.monotonic() - self._swept >= self.sweep_interval
+            if sweep:
+                self._swept = time.monotonic()
+        if sweep:
+            self.sweep()
+
+    def delete(self, sid):
+        if self.cache is not None:
+            self.cache.delete(sid)
+        with self._connect() as db:
+            db.execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def sweep(self):
+        """Deletes the expired sessions, one batch per transaction; returns how many."""
+        db = self._connect()
+        deleted = 0
+        while True:
+            with db:
+                cursor = db.execute(
+                    'DELETE FROM session WHERE id IN (SELECT id FROM session'
+                    ' WHERE expires <= ? LIMIT ?)', (time.time(), self.sweep_batch)
+                )
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.sweep_batch:
+                return deleted
+
+
+def get_session_store(app=None):
+    if app is None:
+        app = current_app._get_current_object()
+
+    store = app.extensions.get('flaskr.session_store')
+    if store is None:
+        # Sessions are kept as long as a permanent session cookie lasts.
+        ttl = app.permanent_session_lifetime.total_seconds()
+        if app.config['SESSION_BACKEND'] == 'sqlite':
+            store = SQLiteSessionStore(
+                app.config['SESSION_DATABASE'], ttl,
+                cache_size=app.config['SESSION_CACHE_SIZE'],
+                cache_ttl=app.config['SESSION_CACHE_TTL'],
+                sweep_interval=app.config['SESSION_SWEEP_INTERVAL'],
+            )
+        else:
+            store = MemorySessionStore(ttl, app.config['SESSION_CACHE_SIZE'])
+        store = app.extensions.setdefault('flaskr.session_store', store)
+
+    return store
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in a session store and only its signed id in the cookie."""
+
+    serializer = TaggedJSONSerializer()
+
+    def get_signer(self, app):
+        if not app.secret_key:
+            return None
+        return Signer(app.secret_key, salt='flaskr-session')
+
+    def open_session(self, app, request):
+        signer = self.get_signer(app)
+        if signer is None:
+            return None
+
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = signer.unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            data = get_session_store(app).get(sid) if sid else None
+            if data is not None:
+                return ServerSideSession(self.serializer.loads(data), sid)
+
+        # Unknown and expired ids are never reused; the session starts afresh.
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        store = get_session_store(app)
+        for sid in session.revoked:
+            store.delete(sid)
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified:
+                store.delete(session.sid)
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure,
+                    samesite=samesite, httponly=httponly
+                )
+                response.vary.add('Cookie')
+            return
+
+        if not session.modified:
+            return
+
+        store.set(session.sid, self.serializer.dumps(dict(session)))
+        response.set_cookie(
+            name,
+            self.get_signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly, domain=domain, path=path, secure=secure,
+            samesite=samesite,
+        )
+        response.vary.add('Cookie')
+
+
+def init_app(app):
+    if app.config['SESSION_BACKEND']:
+        app.session_interface = ServerSideSessionInterface()
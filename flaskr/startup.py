@@ -0,0 +1,82 @@
+import click
+import gc
+import os
+import subprocess
+import sys
+
+from flaskr.assets import static_hash
+from flaskr.db import close_pool, get_db
+from flaskr.migrate import check_schema
+from flaskr.templating import precompile_templates
+
+# Run in a fresh interpreter, so nothing is imported yet.
+_PROFILE_SCRIPT = (
+    'import time; started = time.perf_counter(); '
+    'from flaskr import create_app; create_app(); '
+    'print(time.perf_counter() - started)'
+)
+
+
+def profile_imports():
+    """Imports the app and builds it in a new interpreter.
+
+    Returns the seconds create_app took, including imports, and a list of
+    (module, self microseconds, cumulative microseconds) for every import.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROFILE_SCRIPT],
+        capture_output=True, text=True, check=True,
+        # The new interpreter must find the same flaskr as this one.
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path))),
+    )
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(own), int(cumulative)))
+    return float(result.stdout.strip().splitlines()[-1]), imports
+
+
+@click.command('import-profile')
+@click.option('--limit', default=15, show_default=True, help='Slowest imports to list.')
+def import_profile_command(limit):
+    """Show how long building the app takes and which imports dominate it."""
+    elapsed, imports = profile_imports()
+    click.echo(f'create_app() took {elapsed * 1000:.1f} ms including imports.')
+
+    click.echo('\nflaskr modules (cumulative ms):')
+    for module, _, cumulative in imports:
+        if module.split('.')[0] == 'flaskr':
+            click.echo(f'  {cumulative / 1000:8.1f}  {module}')
+
+    click.echo(f'\nSlowest {limit} imports (self ms):')
+    for module, own, _ in sorted(imports, key=lambda i: i[1], reverse=True)[:limit]:
+        click.echo(f'  {own / 1000:8.1f}  {module}')
+
+
+# With a preforking server (gunicorn --preload) the app is built once in the
+# master and the workers are forked from it. Whatever the master loaded is
+# shared with every worker, copy-on-write, so the templates and static hashes
+# are loaded up front. Connections, threads and process pools are all created
+# on first use, and each worker creates its own.
+def preload(app):
+    """Warms an app up in the master process, before the workers are forked."""
+    with app.app_context():
+        # Refuse to start rather than fail request by request on missing tables.
+        check_schema(get_db())
+        precompile_templates()
+        for root, _, files in os.walk(app.static_folder):
+            for name in files:
+                static_hash(os.path.relpath(os.path.join(root, name), app.static_folder))
+
+    # Nothing opened so far may be shared with the workers.
+    close_pool(app)
+    # Objects that survive to here live as long as the workers. Moving them out
+    # of the collector's reach stops it from touching, and so copying, their
+    # memory pages in every worker.
+    gc.collect()
+    gc.freeze()
+    return app
+
@@ -0,0 +1,44 @@
+import click
+import os
+
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+
+# Jinja compiles each template to Python code the first time a process renders
+# it. With a bytecode cache the compiled code is written to disk and shared by
+# every worker, so a fresh worker only has to load it. Run precompile-templates
+# at deploy time and not even the first request pays for compiling.
+#
+# Outside debug mode Flask already skips the check (a stat call) for changed
+# template files on every render; TEMPLATES_AUTO_RELOAD can force it either way.
+def init_app(app):
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        # jinja_options is read when Flask first creates the Jinja environment.
+        app.jinja_options = dict(
+            app.jinja_options,
+            bytecode_cache=FileSystemBytecodeCache(directory),
+        )
+
+
+def precompile_templates():
+    """Compiles every template into the bytecode cache, returning their names."""
+    env = current_app.jinja_env
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Compile all templates into the bytecode cache."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set.')
+
+    names = precompile_templates()
+    click.echo(f'Compiled {len(names)} templates into {current_app.config["TEMPLATE_CACHE_DIR"]}.')
@@ -0,0 +1,101 @@
+import os
+import queue
+import sqlite3
+import threading
+
+from concurrent.futures import Future
+
+
+# SQLite lets one connection write at a time, and every commit waits for the
+# disk. Instead of each request thread competing for the write lock, writes can
+# be handed to a single writer thread, which runs whatever has queued up in one
+# transaction and commits it once. Every job gets a savepoint of its own, so a
+# failing job (say, a duplicate username) is rolled back without the others.
+class WriteQueue(object):
+    """A single writer thread that group-commits the jobs submitted to it."""
+
+    def __init__(self, connect, max_batch=64):
+        self._connect = connect
+        self.max_batch = max_batch
+        self._jobs = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.batches = 0
+        self.jobs = 0
+
+    def submit(self, fn, timeout=None):
+        """Runs fn(db) on the writer thread, waits for the commit and returns its result."""
+        future = Future()
+        # Queued under the lock, so a writer thread that fails to start can't
+        # miss the job on its way out.
+        with self._lock:
+            self._ensure_thread()
+            self._jobs.put((fn, future))
+        return future.result(timeout)
+
+    def _ensure_thread(self):
+        # A forked child doesn't inherit the writer thread, and a thread that
+        # couldn't connect has exited; either way, start a new one.
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='flaskr-writer', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        try:
+            db = self._connect()
+        except Exception as e:
+            # The jobs waiting for this thread fail with the error, and the
+            # next submit starts a thread that tries to connect again.
+            with self._lock:
+                self._thread = None
+                while True:
+                    try:
+                        _, future = self._jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    future.set_exception(e)
+            return
+        # Transactions are managed by hand below.
+        db.isolation_level = None
+
+        while True:
+            batch = [self._jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(db, batch)
+
+    def _run_batch(self, db, batch):
+        results = []
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for fn, future in batch:
+                db.execute('SAVEPOINT job')
+                try:
+                    results.append((future, fn(db), None))
+                except Exception as e:
+                    db.execute('ROLLBACK TO job')
+                    results.append((future, None, e))
+                db.execute('RELEASE job')
+            db.execute('COMMIT')
+        except sqlite3.Error as e:
+            # The transaction itself failed, so none of the jobs were saved.
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.jobs += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
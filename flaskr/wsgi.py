@@ -0,0 +1,15 @@
+# Entry point for WSGI servers. With a preforking server, build the app once in
+# the master and fork the workers from it, e.g.:
+#
+#   gunicorn --preload --workers 4 --threads 8 flaskr.wsgi:app
+#
+# Each worker then starts serving straight away instead of importing and
+# configuring the app on its own, and serves as many requests at once as it
+# has threads. SQLite calls block the thread making them, so more concurrency
+# means more threads (or workers). Slow clients are best kept off them by a
+# buffering proxy such as nginx in front, which sends each request on only
+# once it has arrived whole, and takes the response as fast as it is written.
+from flaskr import create_app
+from flaskr.startup import preload
+
+app = preload(create_app())
@@ -3,7 +3,7 @@ import pytest
 import tempfile
 
 from flaskr import create_app
-from flaskr.db import get_db, init_db
+from flaskr.db import close_pool, get_db, init_db
 
 class AuthActions(object):
     # The AuthActions class is a helper for performing authentication-related actions in tests.
@@ -44,7 +44,7 @@ with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as file:
 
 # This fixture creates and configures a new app instance for each test.
 @pytest.fixture
-def app():
+def app(tmp_path):
     # Create a temporary file to act as a mock database for testing.
     db_fd, db_path = tempfile.mkstemp()
 
@@ -52,6 +52,8 @@ def app():
     app = create_app({
         'TESTING': True,        # Enable testing mode (disables error catching).
         'DATABASE': db_path,    # Use the temporary database path.
+        'TEMPLATE_CACHE_DIR': None,  # Don't write compiled templates to the instance folder.
+        'PAGE_CACHE_DATABASE': str(tmp_path / 'page_cache.sqlite'),
     })
 
     # Within the app context, initialize the database and load test data.
@@ -62,9 +64,14 @@ def app():
     # Provide the app instance to the tests, and then clean up.
     yield app
 
-    # Clean up: Close the database file and remove it from the file system.
+    # Clean up: Close the pooled connections, then close the database file
+    # and remove it from the file system.
+    close_pool(app)
     os.close(db_fd)
     os.unlink(db_path)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
 
 
 # This fixture provides a test client for the app, allowing tests 
@@ -0,0 +1,62 @@
+import gzip
+import os
+import shutil
+
+import pytest
+
+from flaskr.assets import precompress_static, static_hash
+
+
+@pytest.fixture
+def static_folder(app, tmp_path):
+    shutil.copy(os.path.join(app.static_folder, 'style.css'), tmp_path)
+    app.static_folder = str(tmp_path)
+    return tmp_path
+
+
+def test_static_urls_are_fingerprinted(client, app, static_folder):
+    with app.test_request_context():
+        digest = static_hash('style.css')
+    assert f'/static/style.css?v={digest}'.encode() in client.get('/').data
+
+    # Changing the file changes its URL.
+    (static_folder / 'style.css').write_text('body { color: red; }')
+    os.utime(static_folder / 'style.css', ns=(0, 0))
+    with app.test_request_context():
+        assert static_hash('style.css') != digest
+        assert static_hash('missing.css') is None
+
+
+def test_fingerprinted_static_is_immutable(client, static_folder):
+    response = client.get('/static/style.css?v=1234')
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 3600
+    response.close()
+
+    response = client.get('/static/style.css')
+    assert not response.cache_control.immutable
+    response.close()
+
+
+def test_precompressed_static(client, runner, static_folder):
+    result = runner.invoke(args=['compress-static'])
+    assert 'style.css.gz' in result.output
+    assert (static_folder / 'style.css.gz').exists()
+
+    response = client.get('/static/style.css', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/css'
+    assert gzip.decompress(response.data) == (static_folder / 'style.css').read_bytes()
+    response.close()
+
+    response = client.get('/static/style.css')
+    assert 'Content-Encoding' not in response.headers
+    response.close()
+
+
+def test_stale_precompressed_variant_is_ignored(client, static_folder):
+    precompress_static(str(static_folder))
+    os.utime(static_folder / 'style.css.gz', ns=(0, 0))
+    response = client.get('/static/style.css', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    response.close()
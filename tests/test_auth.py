@@ -1,5 +1,6 @@
 import pytest
 from flask import g, session
+from flaskr.auth import get_user_cache, write_user
 from flaskr.db import get_db
 
 def test_register(client, app):
@@ -81,3 +82,62 @@ def test_logout(client, auth):
         
         # Verify that the user ID is removed from the session after logging out.
         assert 'user_id' not in session
+
+
+def test_logged_in_user_cached(client, auth, app):
+    auth.login()
+
+    # The first request loads the user from the database, later ones hit the cache.
+    client.get('/create')
+    client.get('/create')
+    with app.app_context():
+        stats = get_user_cache().stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+
+
+def test_logged_in_user_lazy(client, auth, app):
+    auth.login()
+
+    # A view that never touches g.user doesn't look the user up at all.
+    client.get('/hello')
+    with app.app_context():
+        assert get_user_cache().stats()['misses'] == 0
+
+
+def test_logged_in_user_columns(client, auth):
+    auth.login()
+
+    # The password hash isn't loaded into g.user.
+    with client:
+        client.get('/')
+        assert 'password' not in g.user
+        assert g.user['id'] == 1
+
+
+def test_cached_user_expires(client, auth, app):
+    app.config['USER_CACHE_TTL'] = 0
+    auth.login()
+    client.get('/')
+
+    # A changed user is reloaded from the database once its entry expires.
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.commit()
+
+    assert b'renamed' in client.get('/create').data
+
+
+def test_write_user_invalidates(client, auth, app):
+    auth.login()
+    client.get('/')
+
+    # A user changed through write_user is reloaded straight away, on the
+    # cached index page too.
+    with app.app_context():
+        write_user(1, lambda db: db.execute(
+            "UPDATE user SET username = 'renamed' WHERE id = 1"
+        ))
+
+    assert b'renamed' in client.get('/').data
@@ -0,0 +1,44 @@
+from flaskr.bench import percentile, run_benchmarks
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) == 0.0
+
+
+def test_run_benchmarks(app):
+    # Every endpoint is measured through the test client and a real server.
+    results = run_benchmarks(app.config, users=3, posts=20, requests=5, concurrency=2)
+
+    assert {(r['endpoint'], r['mode']) for r in results} == {
+        (name, mode)
+        for name in ('index', 'login', 'create', 'update')
+        for mode in ('client', 'server x2')
+    }
+    for result in results:
+        assert result['requests'] == 5
+        assert result['errors'] == 0
+        assert result['p50'] <= result['p99']
+
+
+def test_run_benchmarks_leaves_real_stores_alone(app, tmp_path):
+    stores = dict(
+        SESSION_BACKEND='sqlite', SESSION_DATABASE=str(tmp_path / 'sessions.sqlite'),
+        JOBS_BACKEND='sqlite', JOBS_DATABASE=str(tmp_path / 'jobs.sqlite'),
+        METRICS_DATABASE=str(tmp_path / 'metrics.sqlite'),
+        PAGE_CACHE='sqlite', PAGE_CACHE_DATABASE=str(tmp_path / 'cache.sqlite'),
+        PROFILE_DIR=str(tmp_path / 'profiles'),
+    )
+    run_benchmarks(dict(app.config, **stores), users=2, posts=5, requests=2, server=False)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_bench_command(runner):
+    result = runner.invoke(args=[
+        'bench', '--users', '2', '--posts', '5', '--requests', '3',
+        '--no-server', '--endpoint', 'index',
+    ])
+    assert 'index    client' in result.output
+    assert 'login' not in result.output
@@ -1,4 +1,8 @@
 import pytest
+import sqlite3
+from flaskr.cache import (
+    SQLiteTaggedCache, TaggedCache, TagVersions, get_page_cache, invalidate_pages
+)
 from flaskr.db import get_db
 
 
@@ -104,3 +108,349 @@ def test_delete(client, auth, app):
         db = get_db()
         post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
         assert post is None  # Ensure the post no longer exists
+
+
+def test_index_pagination(client, app):
+    # Add enough posts to spread the index over several pages of two posts each.
+    app.config['POSTS_PER_PAGE'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created) VALUES (?, ?, 1, ?)',
+            [(f'post {n}', '', '2018-01-02 00:00:00') for n in range(3)]
+        )
+        db.commit()
+
+    # The first page holds the two newest posts and links to the older ones.
+    response = client.get('/')
+    assert b'post 2' in response.data
+    assert b'post 1' in response.data
+    assert b'post 0' not in response.data
+    assert b'Older posts' in response.data
+
+    # Follow the cursor links; posts sharing a timestamp are ordered by id.
+    next_url = response.data.split(b'class="pager" href="')[1].split(b'"')[0]
+    response = client.get(next_url.decode().replace('&amp;', '&'))
+    assert b'post 0' in response.data
+    assert b'test title' in response.data
+    assert b'post 1' not in response.data
+    assert b'Older posts' not in response.data
+
+
+def test_index_invalid_cursor(client):
+    # A cursor that cannot be decoded is rejected instead of raising an error.
+    assert client.get('/?before=not-a-cursor').status_code == 400
+
+
+def test_index_streaming(client, app):
+    # The streamed index renders the same page as the buffered one.
+    app.config['INDEX_STREAMING'] = True
+    response = client.get('/')
+    assert response.is_streamed
+    assert b'test title' in response.data
+
+
+def test_index_cached(client, app):
+    # The second visit is served from the page cache.
+    client.get('/')
+    client.get('/')
+    with app.app_context():
+        stats = get_page_cache().stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+
+
+def test_index_not_modified(client):
+    # A client holding the current ETag gets a 304 without a body.
+    etag = client.get('/').headers['ETag']
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+@pytest.mark.parametrize(('path', 'data', 'expected'), (
+    ('/create', {'title': 'created', 'body': ''}, b'created'),
+    ('/1/update', {'title': 'updated', 'body': ''}, b'updated'),
+    ('/1/delete', {}, b'Posts'),
+))
+def test_index_cache_invalidated(client, auth, path, data, expected):
+    # Creating, updating or deleting a post evicts the cached pages it appears on.
+    auth.login()
+    etag = client.get('/').headers['ETag']
+    client.post(path, data=data)
+
+    response = client.get('/')
+    assert response.headers['ETag'] != etag
+    assert expected in response.data
+    if path == '/1/delete':
+        assert b'test title' not in response.data
+
+
+def test_index_sqlite_cache(client, app, tmp_path):
+    # The shared SQLite tier behaves like the in-memory one.
+    app.config['PAGE_CACHE'] = 'sqlite'
+    app.config['PAGE_CACHE_DATABASE'] = str(tmp_path / 'cache.sqlite')
+
+    first = client.get('/')
+    assert client.get('/').data == first.data
+    with app.app_context():
+        assert get_page_cache().stats()['hits'] == 1
+        invalidate_pages('post:1')
+        assert get_page_cache().stats()['size'] == 0
+
+
+def _page_caches(tmp_path):
+    # Two workers' caches, sharing their invalidations through one file.
+    path = str(tmp_path / 'cache.sqlite')
+    return (
+        TaggedCache(versions=TagVersions(path)), TaggedCache(versions=TagVersions(path)),
+        SQLiteTaggedCache(path),
+    )
+
+
+def test_invalidation_reaches_other_workers(tmp_path):
+    first, second, shared = _page_caches(tmp_path)
+    for cache in (first, second, shared):
+        cache.set('index', ['etag', 'body'], ['post:1'])
+
+    first.invalidate(['post:1'])
+    assert second.get('index') is None
+    assert shared.get('index') is None
+
+    second.set('index', ['etag', 'body'], ['post:1'])
+    assert second.get('index') == ['etag', 'body']
+    first.clear()
+    assert second.get('index') is None
+
+
+@pytest.mark.parametrize('index', (0, 2))
+def test_render_started_before_invalidation(tmp_path, index):
+    # A page rendered from data read before an invalidation is never served.
+    cache = _page_caches(tmp_path)[index]
+    snapshot = cache.begin()
+    cache.invalidate(['post:1'])
+    cache.set('index', ['etag', 'body'], ['post:1'], snapshot)
+    assert cache.get('index') is None
+
+    cache.set('index', ['etag', 'body'], ['post:1'], cache.begin())
+    assert cache.get('index') == ['etag', 'body']
+
+
+def test_sqlite_cache_stores_json(tmp_path):
+    cache = SQLiteTaggedCache(str(tmp_path / 'cache.sqlite'))
+    cache.set('index', ['etag', '<p>body</p>'], ['post:1'])
+    db = sqlite3.connect(str(tmp_path / 'cache.sqlite'))
+    assert db.execute('SELECT value FROM cache_page').fetchone()[0] == '["etag", "<p>body</p>"]'
+
+
+def test_search(client, app):
+    # Posts are found by words in their title or body, with the matches highlighted.
+    response = client.get('/search?q=body')
+    assert b'test title' in response.data
+    assert b'<mark>body</mark>' in response.data
+
+    assert b'No posts match' in client.get('/search?q=missing').data
+
+
+def test_search_escapes_html(client, auth):
+    # Post text is escaped around the highlighted matches.
+    auth.login()
+    client.post('/create', data={'title': 'html', 'body': '<script>needle</script>'})
+
+    response = client.get('/search?q=needle')
+    assert b'&lt;script&gt;<mark>needle</mark>&lt;/script&gt;' in response.data
+
+
+def test_search_follows_writes(client, auth):
+    # The triggers keep the index in sync with updates and deletes.
+    auth.login()
+    client.post('/1/update', data={'title': 'renamed', 'body': ''})
+    assert b'renamed' not in client.get('/search?q=test').data
+    assert b'renamed' in client.get('/search?q=renamed').data
+
+    client.post('/1/delete')
+    assert b'No posts match' in client.get('/search?q=renamed').data
+
+
+def test_search_pagination(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('more', 'body', 1)")
+        db.commit()
+
+    assert b'page=2' in client.get('/search?q=body').data
+    response = client.get('/search?q=body&page=2')
+    assert b'Previous' in response.data
+    assert b'Next' not in response.data
+
+
+def test_reindex_command(runner, app):
+    # Posts missing from the index are added, and rerunning adds nothing new.
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM post_fts')
+        db.commit()
+
+    result = runner.invoke(args=['reindex', '--batch-size', '1'])
+    assert '1 posts added' in result.output
+    assert '0 posts added' in runner.invoke(args=['reindex']).output
+    assert '1 posts added' in runner.invoke(args=['reindex', '--full']).output
+
+    with app.app_context():
+        assert get_db().execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'body'"
+        ).fetchall()[0][0] == 1
+
+
+def test_api_posts(client, app):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created) VALUES (?, ?, 2, ?)',
+            [(f'post {n}', '', f'2019-01-{n + 1:02d} 00:00:00') for n in range(3)]
+        )
+        db.commit()
+
+    data = client.get('/api/posts?limit=2').get_json()
+    assert [post['title'] for post in data['posts']] == ['post 2', 'post 1']
+    assert data['posts'][0]['author'] == 'other'
+    assert data['posts'][0]['created'] == '2019-01-03T00:00:00Z'
+
+    data = client.get(f"/api/posts?limit=2&before={data['next']}").get_json()
+    assert [post['title'] for post in data['posts']] == ['post 0', 'test title']
+    assert data['next'] is None
+
+    data = client.get('/api/authors/1/posts').get_json()
+    assert [post['title'] for post in data['posts']] == ['test title']
+
+    assert client.get('/api/posts/1').get_json()['body'] == 'test\nbody'
+    assert client.get('/api/posts/5').status_code == 404
+    assert client.get('/api/authors/9/posts').status_code == 404
+    assert client.get('/api/posts?limit=1000').status_code == 400
+
+
+@pytest.mark.parametrize('path', ('/api/posts', '/api/authors/1/posts', '/feed.xml'))
+def test_feed_conditional_get(client, auth, path):
+    response = client.get(path)
+    etag = response.headers['ETag']
+    assert response.last_modified is not None
+
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_if_modified_since_alone_is_not_trusted(client, auth, app):
+    # Last-Modified can't tell apart changes made within the same second,
+    # so only the ETag gets a 304.
+    last_modified = client.get('/api/posts').headers['Last-Modified']
+    with app.app_context():
+        modified = get_db().execute('SELECT modified FROM post_change').fetchone()[0]
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    with app.app_context():
+        # As if the update had come within the same second.
+        get_db().execute('UPDATE post_change SET modified = ?', (modified,))
+        get_db().commit()
+
+    response = client.get('/api/posts', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert response.get_json()['posts'][0]['title'] == 'updated'
+
+
+def test_post_conditional_get(client):
+    etag = client.get('/api/posts/1').headers['ETag']
+    assert etag != client.get('/api/posts').headers['ETag']
+    response = client.get('/api/posts/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # A missing post is a 404, whatever ETag the client holds.
+    assert client.get('/api/posts/5', headers={'If-None-Match': etag}).status_code == 404
+    list_etag = client.get('/api/posts').headers['ETag']
+    response = client.get('/api/posts/5', headers={'If-None-Match': list_etag})
+    assert response.status_code == 404
+
+
+def test_author_feed(client, app):
+    response = client.get('/authors/1/feed.xml')
+    assert response.mimetype == 'application/atom+xml'
+    assert b'<title>Flaskr: posts by test</title>' in response.data
+    assert b'<title>test title</title>' in response.data
+    assert b'test title' not in client.get('/authors/2/feed.xml').data
+
+
+def test_feed_unchanged_by_other_authors(client, app):
+    etag = client.get('/api/authors/1/posts').headers['ETag']
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('x', '', 2)")
+        db.commit()
+    response = client.get('/api/authors/1/posts', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def _author_stats(app):
+    with app.app_context():
+        return [tuple(row) for row in get_db().execute(
+            'SELECT author_id, post_count, latest_post_id FROM author_stats'
+            ' ORDER BY author_id'
+        )]
+
+
+def test_author_stats_follow_writes(app):
+    assert _author_stats(app) == [(1, 1, 1)]
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created) VALUES (?, ?, ?, ?)',
+            [('a', '', 1, '2019-01-01 00:00:00'), ('b', '', 2, '2017-01-01 00:00:00'),
+             ('c', '', 1, '2017-06-01 00:00:00')]
+        )
+        db.commit()
+    assert _author_stats(app) == [(1, 3, 2), (2, 1, 3)]
+
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM post WHERE id = 2')
+        db.execute('UPDATE post SET author_id = 2 WHERE id = 4')
+        db.commit()
+    assert _author_stats(app) == [(1, 1, 1), (2, 2, 4)]
+
+
+def test_author_page(client, app):
+    response = client.get('/authors/1')
+    assert b'Posts by test' in response.data
+    assert b'1 post' in response.data
+    assert b'href="/1">test title</a>' in response.data
+
+    assert b'0 posts' in client.get('/authors/2').data
+    assert client.get('/authors/3').status_code == 404
+
+    app.config['POSTS_PER_PAGE'] = 1
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('newer', '', 1)")
+        db.commit()
+    response = client.get('/authors/1')
+    assert b'2 posts' in response.data
+    assert b'latest: <a href="/2">newer</a>' in response.data
+    assert b'Older posts' in response.data
+
+
+def test_recount_command(runner, app):
+    with app.app_context():
+        db = get_db()
+        db.execute('UPDATE author_stats SET post_count = 7')
+        db.execute('INSERT INTO author_stats (author_id, post_count) VALUES (9, 3)')
+        db.commit()
+
+    result = runner.invoke(args=['recount', '--batch-size', '1'])
+    assert 'Recounted 1 rows' in result.output
+    assert _author_stats(app) == [(1, 1, 1)]
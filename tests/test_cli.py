@@ -0,0 +1,38 @@
+import gc
+import sys
+
+from flaskr.cli import COMMANDS
+from flaskr.startup import preload, profile_imports
+
+
+def test_commands_load_lazily(app, runner, monkeypatch):
+    monkeypatch.delitem(sys.modules, 'flaskr.bench', raising=False)
+    with app.app_context():
+        names = app.cli.list_commands(None)
+    assert set(COMMANDS) <= set(names)
+    assert 'flaskr.bench' not in sys.modules
+
+    result = runner.invoke(args=['bench', '--help'])
+    assert 'Measure request latency' in result.output
+    assert 'flaskr.bench' in sys.modules
+
+
+def test_preload(app):
+    try:
+        preload(app)
+        assert gc.get_freeze_count() > 0
+    finally:
+        gc.unfreeze()
+
+    assert 'blog/index.html' in [t.name for t in app.jinja_env.cache.values()]
+    assert app.extensions['flaskr.static_hashes']
+    # No connection is left open for the workers to inherit.
+    assert 'flaskr.db_pool' not in app.extensions
+
+
+def test_profile_imports():
+    elapsed, imports = profile_imports()
+    assert elapsed > 0
+    modules = [module for module, _, _ in imports]
+    assert 'flaskr' in modules
+    assert 'flaskr.commands' not in modules
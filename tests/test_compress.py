@@ -0,0 +1,44 @@
+import gzip
+
+from flaskr.db import get_db
+
+
+def _add_posts(app, count):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [(f'post {n}', 'lorem ipsum ' * 20) for n in range(count)]
+        )
+        db.commit()
+
+
+def test_html_is_gzipped(client, app):
+    _add_posts(app, 5)
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert b'lorem ipsum' in gzip.decompress(response.data)
+
+    # Revalidating with the weakened ETag still gets a 304.
+    assert response.headers['ETag'].startswith('W/')
+    response = client.get('/', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']
+    })
+    assert response.status_code == 304
+
+
+def test_not_compressed(client, app):
+    _add_posts(app, 5)
+    # The client doesn't accept it.
+    response = client.get('/')
+    assert 'Content-Encoding' not in response.headers
+    assert b'lorem ipsum' in response.data
+
+    # Too small to be worth it.
+    response = client.get('/hello', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+    app.config['COMPRESS_MIN_SIZE'] = 0
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
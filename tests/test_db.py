@@ -1,7 +1,12 @@
+import json
 import pytest
 import sqlite3
 
-from flaskr.db import get_db
+from concurrent.futures import ThreadPoolExecutor
+
+from flaskr.db import close_pool, get_db, get_pool, get_write_queue, pool_stats, run_write
+from flaskr.pool import ConnectionPool, PoolTimeout
+from flaskr.writequeue import WriteQueue
 
 # Test that the database connection is correctly created and closed.
 def test_get_close_db(app):
@@ -44,3 +49,240 @@ def test_init_db_command(runner, monkeypatch):
 
     # Confirm that `fake_init_db` was called, indicating the command triggered `init_db`.
     assert Recorder.called
+
+
+def test_pool_reuses_connections(app):
+    # The connection given back at the end of one app context is reused by the next.
+    with app.app_context():
+        first = get_db().connection
+
+    with app.app_context():
+        assert get_db().connection is first
+        stats = pool_stats()
+
+    assert stats['created'] == 1
+    assert stats['checkouts'] >= 2
+
+
+def test_pool_rolls_back_on_return(app):
+    # Uncommitted changes are discarded when the connection returns to the pool.
+    with app.app_context():
+        get_db().execute("INSERT INTO user (username, password) VALUES ('x', 'x')")
+
+    with app.app_context():
+        assert get_db().execute(
+            "SELECT * FROM user WHERE username = 'x'"
+        ).fetchone() is None
+
+
+def test_pool_timeout():
+    # When every connection is checked out, waiting for one eventually fails.
+    pool = ConnectionPool(lambda: sqlite3.connect(':memory:'), size=1, timeout=0.01)
+    conn = pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_pool_discards_broken_connections():
+    # A connection that fails its health check is replaced by a fresh one.
+    pool = ConnectionPool(lambda: sqlite3.connect(':memory:'), size=1, ping_after=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()
+
+    assert pool.acquire() is not conn
+    assert pool.stats()['discarded'] == 1
+
+
+def test_pragmas_applied(app):
+    # Every connection is opened with the configured pragma profile.
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+
+def test_invalid_pragma_value(app):
+    # Values that could smuggle SQL into the pragma statement are refused.
+    app.config['SQLITE_SYNCHRONOUS'] = 'off; DROP TABLE user'
+    close_pool(app)
+    with app.app_context():
+        with pytest.raises(ValueError):
+            get_db().execute('SELECT 1')
+
+
+def test_db_tune_command(runner):
+    # The db-tune command reports the settings in effect.
+    result = runner.invoke(args=['db-tune'])
+    assert 'journal_mode = wal' in result.output
+    assert 'synchronous = normal' in result.output
+    assert 'temp_store = memory' in result.output
+
+
+@pytest.mark.parametrize('filename', ('posts.jsonl', 'posts.csv'))
+def test_export_import_posts(runner, app, tmp_path, filename):
+    # Posts exported to a file can be imported back into an empty table.
+    path = str(tmp_path / filename)
+    result = runner.invoke(args=['export-posts', path])
+    assert 'Exported 1 rows' in result.output
+
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM post')
+        db.commit()
+
+    result = runner.invoke(args=['import-posts', path, '--defer-indexes'])
+    assert 'Imported 1 rows' in result.output
+    assert 'rows/s' in result.output
+
+    with app.app_context():
+        db = get_db()
+        post = db.execute('SELECT * FROM post').fetchone()
+        assert post['title'] == 'test title'
+        assert post['body'] == 'test\nbody'
+        assert post['created'].year == 2018
+        # The deferred indexes and search triggers are back and up to date.
+        assert db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'post_created_id'"
+        ).fetchone() is not None
+        assert db.execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'body'"
+        ).fetchone() is not None
+        # So are the author_stats triggers, and the counts were rebuilt.
+        assert db.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'author_stats_%'"
+        ).fetchone()[0] == 3
+        assert tuple(db.execute(
+            'SELECT author_id, post_count, latest_post_id FROM author_stats'
+        ).fetchone()) == (1, 1, post['id'])
+
+
+def test_import_posts_batches(runner, app, tmp_path):
+    # Records without ids or creation times get the column defaults.
+    path = tmp_path / 'new.jsonl'
+    path.write_text(''.join(
+        json.dumps({'author_id': 2, 'title': f'imported {n}', 'body': ''}) + '\n'
+        for n in range(5)
+    ))
+
+    result = runner.invoke(args=['import-posts', str(path), '--batch-size', '2'])
+    assert 'Imported 5 rows' in result.output
+
+    with app.app_context():
+        count = get_db().execute(
+            'SELECT COUNT(*) FROM post WHERE author_id = 2'
+        ).fetchone()[0]
+        assert count == 5
+
+
+def test_export_import_users(runner, app, tmp_path):
+    path = str(tmp_path / 'users.csv')
+    assert 'Exported 2 rows' in runner.invoke(args=['export-users', path]).output
+
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM user')
+        db.commit()
+
+    assert 'Imported 2 rows' in runner.invoke(args=['import-users', path]).output
+
+
+def test_reads_use_read_only_connections(app):
+    # SELECTs run on a read-only connection until the first write.
+    with app.app_context():
+        db = get_db()
+        db.execute('SELECT * FROM post').fetchall()
+        assert pool_stats(readonly=True)['in_use'] == 1
+        assert pool_stats()['in_use'] == 0
+
+        db.execute("UPDATE post SET title = 'changed'")
+        # Later reads see the request's own uncommitted write.
+        assert db.execute('SELECT title FROM post').fetchone()['title'] == 'changed'
+        db.rollback()
+
+
+def test_index_reads_use_read_only_connections(client, app):
+    # Checking the schema for post.author_name doesn't count as a write.
+    app.config['PAGE_CACHE'] = None
+    with app.app_context():
+        checkouts = pool_stats()['checkouts']
+    client.get('/')
+    with app.app_context():
+        assert pool_stats()['checkouts'] == checkouts
+        assert pool_stats(readonly=True)['checkouts'] == 1
+
+
+def test_read_only_connections_refuse_writes(app):
+    with app.app_context():
+        reader = get_pool(readonly=True).acquire()
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute('DELETE FROM post')
+
+
+def test_write_queue(app):
+    # Writes from many threads are committed by the writer thread in batches,
+    # and a failing write doesn't undo the others.
+    app.config['DB_WRITE_QUEUE'] = True
+
+    def write(n):
+        with app.app_context():
+            try:
+                run_write(lambda db: db.execute(
+                    'INSERT INTO user (username, password) VALUES (?, ?)',
+                    ('test' if n == 0 else f'user{n}', '')
+                ))
+            except sqlite3.IntegrityError:
+                return 'duplicate'
+            return 'ok'
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(write, range(20)))
+
+    assert results.count('duplicate') == 1
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM user').fetchone()[0] == 21
+        queue = get_write_queue()
+        assert queue.jobs == 20
+        assert queue.batches <= 20
+
+
+def test_write_queue_connect_error():
+    # Waiting jobs fail with the error, and the next job gets a fresh thread.
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError('no database')
+        return sqlite3.connect(':memory:', check_same_thread=False)
+
+    queue = WriteQueue(connect)
+    with pytest.raises(OSError):
+        queue.submit(lambda db: None, timeout=5)
+    assert queue.submit(lambda db: db.execute('SELECT 1').fetchone()[0], timeout=5) == 1
+
+
+def test_register_through_write_queue(client, app):
+    app.config['DB_WRITE_QUEUE'] = True
+    client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+    response = client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+    assert b'already registered' in response.data
+
+
+def test_author_name_maintained(app):
+    # The triggers keep the denormalized author name in step with the user table.
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT author_name FROM post').fetchone()[0] == 'test'
+
+        db.execute('UPDATE post SET author_id = 2')
+        assert db.execute('SELECT author_name FROM post').fetchone()[0] == 'other'
+
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 2")
+        assert db.execute('SELECT author_name FROM post').fetchone()[0] == 'renamed'
+        db.commit()
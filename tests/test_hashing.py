@@ -0,0 +1,61 @@
+from werkzeug.security import generate_password_hash
+
+from flaskr.db import get_db
+from flaskr.hashing import hash_password, needs_rehash, verify_password
+
+
+def test_hash_and_verify(app):
+    # Hashes come back from the worker pool in the configured format.
+    with app.app_context():
+        pwhash = hash_password('secret')
+        assert pwhash.startswith('scrypt:32768:8:1$')
+        assert verify_password(pwhash, 'secret')
+        assert not verify_password(pwhash, 'wrong')
+        assert not needs_rehash(pwhash)
+
+
+def test_hash_inline(app):
+    # With no hashing workers the hash is computed in the request thread.
+    app.config['PASSWORD_HASH_WORKERS'] = 0
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    with app.app_context():
+        assert verify_password(hash_password('secret'), 'secret')
+
+
+def test_rehash_on_login(app, auth):
+    # The test users' hashes use old pbkdf2 settings and are upgraded on login.
+    auth.login()
+
+    with app.app_context():
+        pwhash = get_db().execute(
+            'SELECT password FROM user WHERE id = 1'
+        ).fetchone()['password']
+        assert not needs_rehash(pwhash)
+        assert verify_password(pwhash, 'test')
+
+
+def test_needs_rehash_without_parameters(app):
+    # werkzeug fills in its default parameters, which count as up to date.
+    app.config['PASSWORD_HASH_WORKERS'] = 0
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+    with app.app_context():
+        pwhash = hash_password('secret')
+        assert pwhash.count(':') == 2
+        assert not needs_rehash(pwhash)
+        assert needs_rehash(generate_password_hash('secret', 'pbkdf2:sha256:1000'))
+
+
+def test_hashing_timeout(client, app):
+    # A hash that doesn't come back in time is a 503, not a 500.
+    app.config['PASSWORD_HASH_TIMEOUT'] = 0
+    response = client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_hashing_queue_full(client, app):
+    # When no hashing slot is free the login is rejected straight away.
+    app.config['PASSWORD_HASH_QUEUE'] = 0
+    response = client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
@@ -0,0 +1,45 @@
+import logging
+
+from flaskr.db import get_db
+from flaskr.instrument import find_table_scans, get_queries
+
+
+def test_queries_recorded(app):
+    # Statements run through get_db are recorded with their fetched rows.
+    with app.app_context():
+        db = get_db()
+        db.execute('SELECT * FROM post').fetchall()
+        for _ in db.execute('SELECT * FROM user'):
+            pass
+
+        queries = get_queries()
+        assert [q.rows for q in queries] == [1, 2]
+        assert all(q.duration > 0 for q in queries)
+
+
+def test_server_timing_header(client, app):
+    # The first request also checks the schema for post.author_name, once.
+    app.config['PAGE_CACHE'] = None
+    client.get('/')
+    response = client.get('/')
+    timings = response.headers.getlist('Server-Timing')
+    assert timings[0].startswith('db;dur=')
+    assert '1 queries' in timings[0]
+    assert timings[1].startswith('total;dur=')
+
+
+def test_slow_query_log(client, app, caplog):
+    # With a zero threshold every query is logged, and full scans are flagged.
+    app.config['SLOW_QUERY_MS'] = 0
+    with caplog.at_level(logging.WARNING):
+        client.get('/search?q=body')
+    assert 'Slow query' in caplog.text
+    assert 'post_fts MATCH' in caplog.text
+
+
+def test_find_table_scans(app):
+    with app.app_context():
+        db = get_db()
+        assert find_table_scans(db, 'SELECT * FROM post WHERE body = ?', ('x',)) == ['SCAN post']
+        assert find_table_scans(db, 'SELECT * FROM post WHERE id = ?', (1,)) == []
+        assert find_table_scans(db, 'INSERT INTO post DEFAULT VALUES', ()) == []
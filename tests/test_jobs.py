@@ -0,0 +1,173 @@
+import pytest
+import time
+
+from flaskr.db import get_db
+from flaskr.jobs import SQLiteJobQueue, Worker, enqueue, get_job_queue, get_task, task
+
+calls = []
+
+
+@task(retries=1)
+def record(value, twice=False):
+    calls.append(value * 2 if twice else value)
+
+
+@task(retries=2)
+def flaky():
+    calls.append('flaky')
+    if len(calls) < 3:
+        raise RuntimeError('not yet')
+
+
+@task(retries=1)
+def broken():
+    raise RuntimeError('broken')
+
+
+def not_a_task():
+    pass
+
+
+@pytest.fixture
+def jobs_app(app, tmp_path):
+    app.config['JOBS_BACKEND'] = 'sqlite'
+    app.config['JOBS_DATABASE'] = str(tmp_path / 'jobs.sqlite')
+    app.config['JOBS_WORKERS'] = 0  # The tests run the jobs themselves.
+    app.config['JOBS_RETRY_BACKOFF'] = 0
+    calls.clear()
+    return app
+
+
+def test_enqueue_without_backend(app):
+    calls.clear()
+    with app.app_context():
+        assert enqueue(record, 1) is None
+    assert calls == [1]
+
+
+def test_get_task():
+    assert get_task(record.task_name) is record
+    with pytest.raises(LookupError):
+        get_task(f'{__name__}:not_a_task')
+
+
+def test_enqueue_and_run(jobs_app):
+    with jobs_app.app_context():
+        queue = get_job_queue()
+        id = enqueue(record, 2, twice=True)
+        assert calls == []
+        assert queue.get(id)['status'] == 'queued'
+
+        assert Worker(jobs_app, queue).run_until_empty() == 1
+        assert calls == [4]
+        job = queue.get(id)
+        assert job['status'] == 'done'
+        assert job['attempts'] == 1
+        assert queue.counts() == {'done': 1}
+
+
+def test_retries(jobs_app):
+    with jobs_app.app_context():
+        queue = get_job_queue()
+        id = enqueue(flaky)
+        worker = Worker(jobs_app, queue)
+
+        assert worker.run_until_empty() == 3
+        job = queue.get(id)
+        assert job['status'] == 'done'
+        assert job['attempts'] == 3
+
+        # Jobs out of retries are marked failed, with the error kept.
+        id = enqueue(broken)
+        assert worker.run_until_empty() == 2
+        job = queue.get(id)
+        assert job['status'] == 'failed'
+        assert 'RuntimeError: broken' in job['error']
+
+
+def test_retry_backoff(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'))
+    id = queue.put(record.task_name, (1,), max_attempts=2)
+    job = queue.claim()
+    assert job.id == id and job.args == [1] and job.attempts == 1
+    queue.fail(id, 'error', retry_delay=60)
+    # Not due again for a minute.
+    assert queue.claim() is None
+    assert queue.get(id)['status'] == 'queued'
+
+
+def test_abandoned_jobs_are_claimed_again(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'), lease=0)
+    id = queue.put(record.task_name, max_attempts=2)
+    assert queue.claim().id == id
+    time.sleep(0.01)
+    job = queue.claim()
+    assert job.id == id and job.attempts == 2
+
+    # The last attempt ran out of its lease too, so the job has failed.
+    time.sleep(0.01)
+    assert queue.claim() is None
+    job = queue.get(id)
+    assert job['status'] == 'failed' and 'Lease expired' in job['error']
+
+
+def test_purge(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / 'jobs.sqlite'), keep=0, purge_batch=2)
+    for _ in range(5):
+        queue.complete(queue.put(record.task_name))
+    queue.put(record.task_name)
+    time.sleep(0.01)
+    assert queue.purge() == 5
+    assert queue.counts() == {'queued': 1}
+
+
+def test_worker_threads(jobs_app):
+    jobs_app.config['JOBS_WORKERS'] = 2
+    client = jobs_app.test_client()
+    client.get('/')  # Starts the worker threads.
+    with jobs_app.app_context():
+        id = enqueue(record, 5)
+        queue = get_job_queue()
+        for _ in range(100):
+            if queue.get(id)['status'] == 'done':
+                break
+            time.sleep(0.02)
+        assert queue.get(id)['status'] == 'done'
+    jobs_app.extensions['flaskr.job_worker'][1].stop()
+    assert calls == [5]
+
+
+def test_render_deferred(jobs_app, client, auth):
+    jobs_app.config['MARKDOWN'] = True
+    auth.login()
+    client.post('/create', data={'title': 'md', 'body': '*hi*'})
+
+    with jobs_app.app_context():
+        assert get_db().execute(
+            'SELECT body_html FROM post WHERE id = 2'
+        ).fetchone()[0] is None
+        assert b'<p class="body">*hi*</p>' in client.get('/').data
+
+        Worker(jobs_app, get_job_queue()).run_until_empty()
+        assert get_db().execute(
+            'SELECT body_html FROM post WHERE id = 2'
+        ).fetchone()[0] == '<p><em>hi</em></p>'
+    assert b'<p class="body">hi</p>' in client.get('/').data
+
+
+def test_worker_command(runner, jobs_app):
+    assert 'Ran 0 jobs' in runner.invoke(args=['worker', '--burst']).output
+
+    with jobs_app.app_context():
+        id = enqueue(flaky)
+    result = runner.invoke(args=['worker', '--burst'])
+    assert 'Ran 3 jobs' in result.output
+
+    result = runner.invoke(args=['jobs'])
+    assert 'done: 1' in result.output
+    assert 'status: done' in runner.invoke(args=['jobs', str(id)]).output
+
+
+def test_commands_need_backend(runner):
+    assert 'JOBS_BACKEND is not set' in runner.invoke(args=['worker']).output
+    assert 'JOBS_BACKEND is not set' in runner.invoke(args=['jobs']).output
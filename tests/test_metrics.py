@@ -0,0 +1,86 @@
+import sqlite3
+
+from flaskr.db import db_stats, get_db, run_write
+from flaskr.metrics import Registry, SQLiteMetricsStore, render
+
+
+def test_registry_histogram():
+    registry = Registry()
+    for value in (0.001, 0.02, 0.02, 20):
+        registry.observe('flaskr_request_duration_seconds', value, endpoint='blog.index')
+    text = render(registry.samples())
+
+    assert '# TYPE flaskr_request_duration_seconds histogram' in text
+    labels = 'endpoint="blog.index"'
+    assert f'flaskr_request_duration_seconds_bucket{{{labels},le="0.005"}} 1' in text
+    assert f'flaskr_request_duration_seconds_bucket{{{labels},le="0.025"}} 3' in text
+    assert f'flaskr_request_duration_seconds_bucket{{{labels},le="+Inf"}} 4' in text
+    assert f'flaskr_request_duration_seconds_count{{{labels}}} 4' in text
+    # Buckets come in order of their bounds.
+    assert text.index('le="0.005"') < text.index('le="0.01"') < text.index('le="+Inf"')
+
+
+def test_metrics_endpoint(client, auth, app):
+    app.config['METRICS_ALLOWED_IPS'] = ('127.0.0.1',)
+    client.get('/')
+    client.get('/')
+    client.get('/no-such-page')
+    auth.login()
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_requests_total{endpoint="blog.index",method="GET",status="200"} 2' in text
+    assert 'flaskr_requests_total{endpoint="unmatched",method="GET",status="404"} 1' in text
+    assert 'flaskr_requests_total{endpoint="auth.login",method="POST",status="302"} 1' in text
+    assert 'flaskr_request_duration_seconds_count{endpoint="blog.index"} 2' in text
+    # The scrape itself is the only request in flight.
+    assert 'flaskr_requests_in_flight 1' in text
+    assert 'flaskr_db_pool_connections{pool="write",state="open"}' in text
+    assert 'flaskr_cache_requests_total{cache="page",result="hit"} 1' in text
+
+
+def test_metrics_private_by_default(client, app):
+    assert client.get('/metrics').status_code == 403
+    app.config['METRICS_ALLOWED_IPS'] = ('10.0.0.1',)
+    assert client.get('/metrics').status_code == 403
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert response.status_code == 200
+
+
+def test_metrics_aggregated_across_processes(client, app, tmp_path):
+    app.config['METRICS_DATABASE'] = str(tmp_path / 'metrics.sqlite')
+    app.config['METRICS_ALLOWED_IPS'] = ('127.0.0.1',)
+
+    # Another worker's samples, as its last flush left them.
+    other = Registry()
+    other.inc('flaskr_requests_total', 3, endpoint='blog.index', method='GET', status='200')
+    other.inc('flaskr_requests_in_flight', 5)
+    SQLiteMetricsStore(app.config['METRICS_DATABASE']).flush(other.samples(), 'other')
+
+    client.get('/')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_requests_total{endpoint="blog.index",method="GET",status="200"} 4' in text
+    # Both rows carry this process's pid here; an exited worker's gauges are dropped.
+    assert 'flaskr_requests_in_flight 6' in text
+
+
+def test_lock_retries(app, monkeypatch):
+    attempts = []
+
+    def write(db):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise sqlite3.OperationalError('database is locked')
+        db.execute("UPDATE user SET username = 'retried' WHERE id = 1")
+
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    app.config['METRICS_ALLOWED_IPS'] = ('127.0.0.1',)
+    with app.app_context():
+        run_write(write)
+        assert db_stats()['lock_retries'] == 2
+        assert get_db().execute(
+            'SELECT username FROM user WHERE id = 1'
+        ).fetchone()[0] == 'retried'
+
+    with app.test_client() as client:
+        text = client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_db_lock_retries_total 2' in text
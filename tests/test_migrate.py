@@ -0,0 +1,124 @@
+import pytest
+
+from flaskr.db import get_db
+from flaskr.migrate import applied_versions, find_migrations, pending_migrations, upgrade
+from flaskr.startup import preload
+
+
+def _downgrade_to_original_schema(db):
+    # The schema of the original tutorial: no indexes, search, author_name,
+    # change counters, rendered bodies or author stats, and no record of migrations.
+    db.executescript(
+        'DROP TABLE schema_version;'
+        ' DROP TABLE author_stats;'
+        ' DROP TRIGGER author_stats_insert;'
+        ' DROP TRIGGER author_stats_update;'
+        ' DROP TRIGGER author_stats_delete;'
+        ' DROP TABLE post_change;'
+        ' DROP TRIGGER post_change_insert;'
+        ' DROP TRIGGER post_change_update;'
+        ' DROP TRIGGER post_change_delete;'
+        ' DROP TRIGGER post_rendered_stale;'
+        ' DROP TABLE post_fts;'
+        ' DROP TRIGGER post_fts_insert;'
+        ' DROP TRIGGER post_fts_update;'
+        ' DROP TRIGGER post_fts_delete;'
+        ' DROP TRIGGER post_author_name_insert;'
+        ' DROP TRIGGER post_author_name_update;'
+        ' DROP TRIGGER user_username_update;'
+        ' DROP INDEX post_created_id;'
+        ' DROP INDEX post_author_created;'
+        ' ALTER TABLE post DROP COLUMN author_name;'
+        ' ALTER TABLE post DROP COLUMN body_html;'
+        ' ALTER TABLE post DROP COLUMN excerpt;'
+        ' ALTER TABLE post DROP COLUMN render_version;'
+    )
+
+
+def test_init_db_stamps_migrations(app):
+    with app.app_context():
+        db = get_db()
+        assert applied_versions(db) == {m.version for m in find_migrations()}
+        assert pending_migrations(db) == []
+
+
+def test_db_status(runner, app):
+    result = runner.invoke(args=['db-status'])
+    assert '0001 post_created_index' in result.output
+    assert 'pending' not in result.output
+
+    with app.app_context():
+        get_db().execute('DELETE FROM schema_version WHERE version = 3')
+        get_db().commit()
+    result = runner.invoke(args=['db-status'])
+    assert result.output.count('pending') == 1
+    assert '0003 author_name' in result.output.splitlines()[2]
+    assert 'pending' in result.output.splitlines()[2]
+    assert 'Current version: 0006' in result.output
+
+
+def test_db_upgrade(runner, app):
+    with app.app_context():
+        db = get_db()
+        _downgrade_to_original_schema(db)
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 2)',
+            [(f'post {n}', '') for n in range(4)]
+        )
+        db.commit()
+
+    # Pages still show authors while the upgrade hasn't run, by joining.
+    assert app.config['DENORMALIZED_AUTHOR']
+    client = app.test_client()
+    assert b'by other' in client.get('/').data
+    # Pages reading the new tables ask for the upgrade instead of failing.
+    for path in ('/feed.xml', '/api/posts', '/search?q=post', '/authors/2'):
+        response = client.get(path)
+        assert response.status_code == 503
+        assert b'flask db-upgrade' in response.data
+    # A server refuses to start on it.
+    with pytest.raises(RuntimeError, match='flask db-upgrade'):
+        preload(app)
+
+    result = runner.invoke(args=['db-upgrade', '--target', '2', '--batch-size', '2'])
+    assert 'Applying 0001 post_created_index' in result.output
+    assert 'Applying 0002 search_index' in result.output
+    assert '2 rows done.' in result.output
+    assert '0003' not in result.output
+
+    result = runner.invoke(args=['db-upgrade', '--batch-size', '2'])
+    assert 'Applying 0003 author_name' in result.output
+    assert 'Applied 4 migrations' in result.output
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute(
+            'SELECT COUNT(*) FROM post WHERE author_name IS NULL'
+        ).fetchone()[0] == 0
+        assert db.execute('SELECT COUNT(*) FROM post_fts').fetchone()[0] == 5
+        assert [row['author_id'] for row in db.execute(
+            'SELECT author_id FROM post_change ORDER BY author_id'
+        )] == [0, 1, 2]
+        assert [tuple(row) for row in db.execute(
+            'SELECT author_id, post_count FROM author_stats ORDER BY author_id'
+        )] == [(1, 1), (2, 4)]
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('new', '', 1)")
+        assert db.execute(
+            "SELECT author_name FROM post WHERE title = 'new'"
+        ).fetchone()[0] == 'test'
+        db.rollback()
+
+    # Running it again finds nothing left to do.
+    assert 'up to date' in runner.invoke(args=['db-upgrade']).output
+    for path in ('/feed.xml', '/api/posts', '/search?q=post', '/authors/2'):
+        assert client.get(path).status_code == 200
+
+
+def test_migrations_are_idempotent(app):
+    # A database that predates the version table already has every change.
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TABLE schema_version')
+        db.commit()
+        assert len(upgrade()) == len(find_migrations())
+        assert db.execute('SELECT COUNT(*) FROM post_fts').fetchone()[0] == 1
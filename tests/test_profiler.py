@@ -0,0 +1,118 @@
+import pytest
+import sys
+import time
+
+from flaskr import create_app
+from flaskr.profiler import (
+    Profiler, collapse, format_collapsed, load_profiles, to_speedscope, write_profiles
+)
+
+
+@pytest.fixture
+def profiled_app(app, tmp_path):
+    app = create_app(dict(
+        app.config, PROFILING=True, PROFILE_SAMPLE_RATE=0, PROFILE_INTERVAL=0.001,
+        PROFILE_FLUSH_INTERVAL=0, PROFILE_DIR=str(tmp_path), PROFILE_ADMINS=('test',),
+        PROFILE_ALLOWED_IPS=('127.0.0.1',),
+    ))
+
+    @app.route('/slow')
+    def slow():
+        time.sleep(0.05)
+        return 'done'
+
+    return app
+
+
+def test_collapse():
+    stack = collapse(sys._getframe())
+    assert stack.split(';')[-1].startswith('test_collapse (')
+    assert 'test_profiler.py:' in stack
+
+
+def test_profiler_samples_registered_threads():
+    profiler = Profiler()
+    profiler.start('test')
+    profiler.sample()
+    profiler.stop()
+    profiler.sample()  # Not registered any more.
+
+    stacks = profiler.take()
+    assert list(stacks) == ['test']
+    assert sum(stacks['test'].values()) == 1
+    assert profiler.take() == {}
+
+
+def test_write_and_load_profiles(tmp_path):
+    write_profiles(str(tmp_path), {'blog.index': {'a;b': 2, 'a;c': 1}})
+    write_profiles(str(tmp_path), {'blog.index': {'a;b': 1}})
+    (tmp_path / 'blog.index@other.collapsed').write_text('a;b 4\n')
+
+    profiles = load_profiles(str(tmp_path))
+    assert profiles == {'blog.index': {'a;b': 7, 'a;c': 1}}
+    assert format_collapsed(profiles['blog.index']) == 'a;b 7\na;c 1\n'
+
+
+def test_to_speedscope():
+    profile = to_speedscope('blog.index', {'a;b': 2, 'a;c': 1}, 0.5)
+    assert [frame['name'] for frame in profile['shared']['frames']] == ['a', 'b', 'c']
+    assert profile['profiles'][0]['samples'] == [[0, 1], [0, 2]]
+    assert profile['profiles'][0]['weights'] == [1.0, 0.5]
+    assert profile['profiles'][0]['endValue'] == 1.5
+
+
+def test_profile_requested_by_header(profiled_app, tmp_path):
+    client = profiled_app.test_client()
+    client.get('/slow')
+    assert load_profiles(str(tmp_path)) == {}
+
+    # Only honoured from the allowed addresses.
+    client.get('/slow', headers={'X-Flaskr-Profile': '1'},
+               environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert load_profiles(str(tmp_path)) == {}
+
+    client.get('/slow', headers={'X-Flaskr-Profile': '1'})
+    stacks = load_profiles(str(tmp_path))['slow']
+    assert any(stack.split(';')[-1].startswith('slow (') for stack in stacks)
+
+
+def test_sample_rate(profiled_app, tmp_path):
+    profiled_app.config['PROFILE_SAMPLE_RATE'] = 1
+    profiled_app.test_client().get('/slow')
+    assert 'slow' in load_profiles(str(tmp_path))
+
+
+def test_profiles_admin_only(profiled_app):
+    client = profiled_app.test_client()
+    assert client.get('/admin/profiles').status_code == 403
+
+    client.post('/auth/login', data={'username': 'other', 'password': 'other'})
+    assert client.get('/admin/profiles').status_code == 403
+    assert client.get('/admin/profiles/slow.collapsed.txt').status_code == 403
+
+
+def test_download_profiles(profiled_app):
+    client = profiled_app.test_client()
+    client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+    assert client.get('/admin/profiles/slow.collapsed.txt').status_code == 404
+
+    client.get('/slow', headers={'X-Flaskr-Profile': '1'})
+    assert client.get('/admin/profiles').json['slow'] > 0
+
+    response = client.get('/admin/profiles/slow.collapsed.txt')
+    assert response.mimetype == 'text/plain'
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert ' (' in response.get_data(as_text=True)
+
+    response = client.get('/admin/profiles/slow.speedscope.json')
+    assert response.json['profiles'][0]['type'] == 'sampled'
+
+
+def test_profile_header_ignored_by_default(profiled_app, tmp_path):
+    profiled_app.config['PROFILE_ALLOWED_IPS'] = ()
+    profiled_app.test_client().get('/slow', headers={'X-Flaskr-Profile': '1'})
+    assert load_profiles(str(tmp_path)) == {}
+
+
+def test_profiling_off_by_default(client):
+    assert client.get('/admin/profiles').status_code == 404
@@ -0,0 +1,87 @@
+import pytest
+
+from flaskr.ratelimit import MemoryBuckets, SQLiteBuckets, get_limiter, parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate('10/minute') == (10, 60)
+    assert parse_rate('100 / 15 minutes') == (100, 900)
+    with pytest.raises(ValueError):
+        parse_rate('often')
+
+
+@pytest.mark.parametrize('backend', ('memory', 'sqlite'))
+def test_token_bucket(backend, tmp_path):
+    if backend == 'sqlite':
+        buckets = SQLiteBuckets(str(tmp_path / 'ratelimit.sqlite'))
+    else:
+        buckets = MemoryBuckets()
+
+    # A burst up to the capacity, then one token a second.
+    assert [buckets.hit('a', 3, 1.0) for _ in range(3)] == [0, 0, 0]
+    assert 0 < buckets.hit('a', 3, 1.0) <= 1
+    assert buckets.hit('b', 3, 1.0) == 0
+
+
+def test_sqlite_buckets_purged(tmp_path):
+    buckets = SQLiteBuckets(
+        str(tmp_path / 'ratelimit.sqlite'), max_age=0, purge_interval=0, purge_batch=2
+    )
+    for n in range(5):
+        buckets.hit(f'login:username:{n}', 3, 1.0)
+    # Each hit purges the buckets idle for longer than max_age: all of them here.
+    count = buckets._connect().execute('SELECT COUNT(*) FROM rate_bucket').fetchone()[0]
+    assert count == 0
+
+
+def test_sqlite_limiter_max_age(app, tmp_path):
+    app.config.update(
+        RATELIMIT_BACKEND='sqlite', RATELIMIT_DATABASE=str(tmp_path / 'rl.sqlite')
+    )
+    assert get_limiter(app).max_age == 3600  # The longest default, '10/hour'.
+
+
+def test_login_throttled(client, app):
+    app.config['RATELIMITS'] = dict(app.config['RATELIMITS'], login='2/minute')
+    data = {'username': 'test', 'password': 'wrong'}
+    assert client.post('/auth/login', data=data).status_code == 200
+    assert client.post('/auth/login', data=data).status_code == 200
+
+    response = client.post('/auth/login', data=data)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+    # Viewing the form isn't limited.
+    assert client.get('/auth/login').status_code == 200
+
+
+def test_login_throttled_per_username(client, app):
+    app.config['RATELIMITS'] = dict(app.config['RATELIMITS'], login='2/minute')
+    for n in range(2):
+        client.post('/auth/login', data={'username': 'Test', 'password': 'a'},
+                    environ_base={'REMOTE_ADDR': f'10.0.0.{n}'})
+
+    # A new address doesn't help against an account already being guessed.
+    response = client.post('/auth/login', data={'username': 'test', 'password': 'a'},
+                           environ_base={'REMOTE_ADDR': '10.0.0.9'})
+    assert response.status_code == 429
+    response = client.post('/auth/login', data={'username': 'other', 'password': 'a'},
+                           environ_base={'REMOTE_ADDR': '10.0.0.9'})
+    assert response.status_code == 200
+
+
+def test_create_throttled_per_user(client, auth, app):
+    app.config['RATELIMITS'] = dict(app.config['RATELIMITS'], create='1/hour')
+    auth.login()
+    assert client.post('/create', data={'title': 'a', 'body': ''}).status_code == 302
+    assert client.post('/create', data={'title': 'b', 'body': ''}).status_code == 429
+
+
+def test_disabled(client, app):
+    app.config['RATELIMIT_BACKEND'] = None
+    app.config['RATELIMITS'] = dict(app.config['RATELIMITS'], register='1/hour')
+    with app.app_context():
+        assert get_limiter() is None
+    for n in range(3):
+        response = client.post('/auth/register', data={'username': f'u{n}', 'password': 'a'})
+        assert response.status_code == 302
@@ -0,0 +1,137 @@
+import flaskr.rendering
+import pytest
+
+from flaskr.db import get_db
+from flaskr.rendering import (
+    RENDERER_VERSION, make_excerpt, render_markdown, render_post, rerender_posts
+)
+
+
+@pytest.mark.parametrize(('text', 'expected'), (
+    ('Hello *world*', '<p>Hello <em>world</em></p>'),
+    ('**bold** and `a*b*c`', '<p><strong>bold</strong> and <code>a*b*c</code></p>'),
+    ('# Title', '<h2>Title</h2>'),
+    ('- one\n- two', '<ul><li>one</li><li>two</li></ul>'),
+    ('1. one\n2. two', '<ol><li>one</li><li>two</li></ol>'),
+    ('> quoted', '<blockquote><p>quoted</p></blockquote>'),
+    ('```\n<b>&\n```', '<pre><code>&lt;b&gt;&amp;</code></pre>'),
+    ('[site](https://example.com)',
+     '<p><a href="https://example.com" rel="nofollow">site</a></p>'),
+))
+def test_render_markdown(text, expected):
+    assert render_markdown(text) == expected
+
+
+@pytest.mark.parametrize('text', (
+    '<script>alert(1)</script>',
+    '[x](javascript:alert(1))',
+    '[x](" onmouseover="alert(1))',
+))
+def test_render_markdown_is_safe(text):
+    html = render_markdown(text)
+    assert '<script' not in html
+    assert 'href' not in html
+
+
+def test_make_excerpt():
+    assert make_excerpt('<p>a &amp; <em>b</em></p>\n<p>c</p>') == 'a & b c'
+    assert make_excerpt('<p>one two three</p>', length=10) == 'one two…'
+
+
+def test_markdown_saved_with_post(client, auth, app):
+    app.config['MARKDOWN'] = True
+    auth.login()
+    client.post('/create', data={'title': 'md', 'body': '*hi* there'})
+
+    with app.app_context():
+        post = get_db().execute(
+            "SELECT body_html, excerpt, render_version FROM post WHERE title = 'md'"
+        ).fetchone()
+    assert tuple(post) == ('<p><em>hi</em> there</p>', 'hi there', RENDERER_VERSION)
+
+    response = client.get('/2')
+    assert b'<em>hi</em> there' in response.data
+    assert b'<p class="body">hi there</p>' in client.get('/').data
+
+    # Edits with MARKDOWN off leave the HTML alone but mark it as stale.
+    app.config['MARKDOWN'] = False
+    client.post('/2/update', data={'title': 'md', 'body': '*bye*'})
+    assert b'<p class="body">*bye*</p>' in client.get('/2').data
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT render_version FROM post WHERE id = 2'
+        ).fetchone()[0] is None
+
+    app.config['MARKDOWN'] = True
+    assert b'<em>bye</em>' in client.get('/2').data
+    with app.app_context():
+        assert rerender_posts(workers=0) == 2
+
+
+def test_markdown_off_without_rendered_columns(client, auth, app):
+    # A database that hasn't run migration 0005 can be written to.
+    with app.app_context():
+        db = get_db()
+        db.executescript(
+            'DROP TRIGGER post_rendered_stale;'
+            ' ALTER TABLE post DROP COLUMN body_html;'
+            ' ALTER TABLE post DROP COLUMN excerpt;'
+            ' ALTER TABLE post DROP COLUMN render_version;'
+        )
+    auth.login()
+    assert client.post('/create', data={'title': 'new', 'body': 'x'}).status_code == 302
+    assert client.post('/1/update', data={'title': 't', 'body': 'y'}).status_code == 302
+    assert b'new' in client.get('/').data
+
+
+def test_post_rendered_on_the_fly(client, app):
+    # The fixture's post predates MARKDOWN, so nothing is stored for it yet.
+    app.config['MARKDOWN'] = True
+    assert b'<p>test\nbody</p>' in client.get('/1').data
+    assert client.get('/2').status_code == 404
+
+
+@pytest.mark.parametrize('workers', (0, 2))
+def test_rerender_posts(app, workers):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [('t', f'**{n}**') for n in range(5)]
+        )
+        db.execute('UPDATE post SET render_version = ? WHERE id = 2', (RENDERER_VERSION,))
+        db.commit()
+
+        done = []
+        assert rerender_posts(batch_size=2, workers=workers, progress=done.append) == 5
+        assert done == [2, 4, 5]
+        assert db.execute(
+            'SELECT body_html FROM post WHERE id = 3'
+        ).fetchone()[0] == render_post('**1**')[0]
+        assert rerender_posts(workers=workers) == 0
+        assert rerender_posts(workers=workers, full=True) == 6
+
+
+def test_rerender_posts_command(runner, app):
+    result = runner.invoke(args=['rerender-posts', '--workers', '0'])
+    assert 'Rendered 1 rows' in result.output
+    with app.app_context():
+        assert get_db().execute('SELECT excerpt FROM post').fetchone()[0] == 'test body'
+
+
+def test_rerender_skips_edited_posts(app, monkeypatch):
+    def render_then_edit(rows, excerpt_length):
+        # The post is edited while its old body is being rendered.
+        result = render_batch(rows, excerpt_length)
+        with app.app_context():
+            db = get_db()
+            db.execute("UPDATE post SET body = 'edited' WHERE id = 1")
+            db.commit()
+        return result
+
+    render_batch = flaskr.rendering._render_batch
+    monkeypatch.setattr(flaskr.rendering, '_render_batch', render_then_edit)
+    with app.app_context():
+        assert rerender_posts(workers=0) == 0
+        post = get_db().execute('SELECT body_html, render_version FROM post').fetchone()
+        assert tuple(post) == (None, None)
@@ -0,0 +1,86 @@
+import pytest
+from flask import session
+
+from flaskr import create_app
+from flaskr.db import close_pool
+from flaskr.sessions import SQLiteSessionStore, get_session_store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def session_app(app, tmp_path, request):
+    # The same app as the `app` fixture, with server-side sessions.
+    app = create_app(dict(
+        app.config,
+        SESSION_BACKEND=request.param,
+        SESSION_DATABASE=str(tmp_path / 'sessions.sqlite'),
+    ))
+    yield app
+    close_pool(app)
+
+
+def _login(client):
+    return client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+
+
+def test_cookie_carries_only_an_id(session_app):
+    client = session_app.test_client()
+    _login(client)
+
+    cookie = client.get_cookie('session')
+    sid, _, signature = cookie.value.rpartition('.')
+    assert len(cookie.value) < 60
+    with session_app.app_context():
+        assert 'user_id' in get_session_store().get(sid)
+
+    with client:
+        client.get('/')
+        assert session['user_id'] == 1
+
+
+def test_logout_revokes_the_session(session_app):
+    client = session_app.test_client()
+    _login(client)
+    stolen = client.get_cookie('session').value
+
+    client.get('/auth/logout')
+    assert client.get_cookie('session') is None
+
+    # The old cookie no longer logs anyone in.
+    client.set_cookie('session', stolen)
+    assert b'Log Out' not in client.get('/').data
+
+
+def test_login_changes_the_session_id(session_app):
+    client = session_app.test_client()
+    # An id obtained before logging in, e.g. one planted by an attacker.
+    with client.session_transaction() as sess:
+        sess['theme'] = 'dark'
+    before = client.get_cookie('session').value
+
+    _login(client)
+    assert client.get_cookie('session').value != before
+
+
+def test_tampered_id_is_rejected(session_app):
+    client = session_app.test_client()
+    _login(client)
+    sid = client.get_cookie('session').value.rpartition('.')[0]
+
+    client.set_cookie('session', sid + '.forged')
+    assert b'Log Out' not in client.get('/').data
+
+
+def test_sqlite_sweep(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / 'sessions.sqlite'), ttl=-1, cache_ttl=0,
+                               sweep_batch=2)
+    for n in range(5):
+        store.set(f'sid{n}', '{}')
+    assert store.get('sid0') is None
+    assert store.sweep() == 5
+    assert store.sweep() == 0
+
+
+def test_cookie_sessions_by_default(client, app):
+    _login(client)
+    with app.app_context():
+        assert 'flaskr.session_store' not in app.extensions
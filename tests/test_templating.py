@@ -0,0 +1,27 @@
+import os
+
+from flaskr import create_app
+
+
+def test_precompile_templates(app, tmp_path):
+    cache_dir = str(tmp_path / 'jinja')
+    app = create_app(dict(app.config, TEMPLATE_CACHE_DIR=cache_dir))
+
+    result = app.test_cli_runner().invoke(args=['precompile-templates'])
+    assert 'Compiled' in result.output
+    assert len(os.listdir(cache_dir)) >= 6
+
+    # A fresh app (like a newly started worker) renders from the shared cache.
+    fresh = create_app(dict(app.config))
+    bcc = fresh.jinja_env.bytecode_cache
+    loaded = []
+    original = bcc.load_bytecode
+    bcc.load_bytecode = lambda bucket: (original(bucket), loaded.append(bucket.code))[0]
+
+    assert b'test title' in fresh.test_client().get('/').data
+    assert loaded and all(code is not None for code in loaded)
+
+
+def test_precompile_templates_disabled(runner):
+    result = runner.invoke(args=['precompile-templates'])
+    assert 'TEMPLATE_CACHE_DIR is not set' in result.output